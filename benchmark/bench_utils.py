@@ -0,0 +1,21 @@
+"""Helpers shared by the distributed benchmarks."""
+import time
+
+import torch
+import torch.distributed as dist
+
+
+def timeit(fn, warmup, iters, device):
+    """Mean time of `fn` in ms over `iters` runs after `warmup` ones, synchronized across ranks, and its last output."""
+    for _ in range(warmup):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    dist.barrier()
+    start = time.perf_counter()
+    for _ in range(iters):
+        out = fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    dist.barrier()
+    return (time.perf_counter() - start) / iters * 1000, out
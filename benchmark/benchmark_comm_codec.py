@@ -0,0 +1,95 @@
+"""
+Error and throughput benchmark of the compressed sequence parallel collectives (`stepvideo.comm_codec`).
+
+Times the ulysses all-to-all of a (b, s/n, h, d) activation and the all-gather of the (b, s/n, c) transformer
+output, uncompressed and with every codec, and reports the error against the uncompressed result. Runs on
+plain torch.distributed, e.g. on CPU processes under gloo:
+
+    torchrun --nproc_per_node 4 benchmark/benchmark_comm_codec.py --backend gloo
+"""
+import argparse
+import json
+import os
+
+import torch
+import torch.distributed as dist
+
+from bench_utils import timeit
+from stepvideo.comm_codec import comm_codecs, compressed_all_gather
+from stepvideo.parallel import initialize_parall_group, get_sp_group
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compressed collectives benchmark")
+    parser.add_argument("--backend", type=str, default=None, help="gloo or nccl, nccl if cuda is available.")
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--seq_len", type=int, default=8192)
+    parser.add_argument("--num_heads", type=int, default=48)
+    parser.add_argument("--head_dim", type=int, default=128)
+    parser.add_argument("--out_channels", type=int, default=64)
+    parser.add_argument("--dtype", type=str, default="bfloat16", choices=["float32", "bfloat16", "float16"])
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--iters", type=int, default=10)
+    parser.add_argument("--output", type=str, default=None, help="Append the results as JSON lines to this file.")
+    return parser.parse_args()
+
+
+def sent_bytes(x, codec):
+    if codec is None:
+        return x.numel() * x.element_size()
+    payload, scale = codec.encode(x)
+    return payload.numel() * payload.element_size() + scale.numel() * scale.element_size()
+
+
+def errors(out, ref):
+    diff = (out.float() - ref.float())
+    return {
+        'max_abs_err': diff.abs().max().item(),
+        'rel_rms_err': (diff.pow(2).mean().sqrt() / ref.float().pow(2).mean().sqrt().clamp(min=1e-12)).item(),
+    }
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    ## one ulysses group over all ranks
+    initialize_parall_group(ring_degree=1, ulysses_degree=int(os.environ["WORLD_SIZE"]), engine="native", backend=args.backend)
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    device = torch.device(f"cuda:{torch.cuda.current_device()}") if dist.get_backend() == "nccl" else torch.device("cpu")
+    dtype = getattr(torch, args.dtype)
+    group = get_sp_group()
+
+    torch.manual_seed(rank)
+    local_len = args.seq_len // world_size
+    activation = torch.randn(args.batch_size, local_len, args.num_heads, args.head_dim, dtype=dtype).to(device)
+    output = torch.randn(args.batch_size, local_len, args.out_channels, dtype=dtype).to(device)
+
+    collectives = {
+        'all_to_all': (activation, lambda codec: group.all_to_all(activation, scatter_dim=2, gather_dim=1, codec=codec)),
+        'all_gather': (output, lambda codec: compressed_all_gather(group, output, dim=-2, codec=codec)),
+    }
+    for collective, (x, fn) in collectives.items():
+        ref_ms, ref = timeit(lambda: fn(None), args.warmup, args.iters, device)
+        for name in [None] + list(comm_codecs):
+            codec = comm_codecs[name]() if name is not None else None
+            ms, out = (ref_ms, ref) if codec is None else timeit(lambda: fn(codec), args.warmup, args.iters, device)
+            result = {
+                'backend': dist.get_backend(),
+                'world_size': world_size,
+                'collective': collective,
+                'codec': name or 'none',
+                'shape': list(x.shape),
+                'dtype': args.dtype,
+                'sent_bytes_per_rank': sent_bytes(x, codec),
+                'ms': ms,
+                'speedup': ref_ms / ms,
+                ## uncompressed activation bytes moved per second, comparable across codecs
+                'GB_per_s': x.numel() * x.element_size() / ms / 1e6,
+                **errors(out, ref),
+            }
+            if rank == 0:
+                print(json.dumps(result))
+                if args.output is not None:
+                    with open(args.output, "a") as f:
+                        f.write(json.dumps(result) + "\n")
+
+    dist.destroy_process_group()
@@ -0,0 +1,80 @@
+"""
+Correctness and scaling benchmark of the native sequence parallel attention (ulysses all-to-all + ring).
+
+Runs on plain torch.distributed, e.g. on CPU processes under gloo:
+
+    torchrun --nproc_per_node 4 benchmark/benchmark_sp_attention.py --ulysses_degree 2 --ring_degree 2 --backend gloo
+
+`--seq_len` does not have to be divisible by the degree, uneven sequences are padded and masked as in the model.
+"""
+import argparse
+import json
+
+import torch
+import torch.distributed as dist
+
+from bench_utils import timeit
+from stepvideo.modules.attentions import Attention, SequenceParallelAttention
+from stepvideo.parallel import initialize_parall_group, get_sequence_parallel_valid_mask, shard_sequence, gather_sequence
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Sequence parallel attention benchmark")
+    parser.add_argument("--ulysses_degree", type=int, default=2)
+    parser.add_argument("--ring_degree", type=int, default=1)
+    parser.add_argument("--backend", type=str, default=None, help="gloo or nccl, nccl if cuda is available.")
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--seq_len", type=int, default=2048)
+    parser.add_argument("--num_heads", type=int, default=48)
+    parser.add_argument("--head_dim", type=int, default=128)
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "bfloat16", "float16"])
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--iters", type=int, default=5)
+    parser.add_argument("--output", type=str, default=None, help="Append the results as a JSON line to this file.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    initialize_parall_group(args.ring_degree, args.ulysses_degree, engine="native", backend=args.backend)
+    rank = dist.get_rank()
+    device = torch.device(f"cuda:{torch.cuda.current_device()}") if dist.get_backend() == "nccl" else torch.device("cpu")
+    dtype = getattr(torch, args.dtype)
+
+    ## identical full inputs on every rank, each rank keeps its (padded) sequence shard
+    torch.manual_seed(0)
+    shape = (args.batch_size, args.seq_len, args.num_heads, args.head_dim)
+    q, k, v = (torch.randn(shape, dtype=dtype).to(device) for _ in range(3))
+    local_q, local_k, local_v = (shard_sequence(x, args.seq_len, dim=1) for x in (q, k, v))
+    valid_mask = get_sequence_parallel_valid_mask(args.seq_len, device=device)
+
+    local_attn = Attention().torch_attn_func
+    sp_attn = SequenceParallelAttention(local_attn)
+    sp_time, local_out = timeit(lambda: sp_attn(local_q, local_k, local_v, attn_mask=valid_mask), args.warmup, args.iters, device)
+    out = gather_sequence(local_out, args.seq_len, dim=1)
+
+    if rank == 0:
+        ref_time, ref = timeit(lambda: local_attn(q, k, v), args.warmup, args.iters, device)
+    else:
+        ## keep the barriers of timeit matched
+        timeit(lambda: None, args.warmup, args.iters, device)
+
+    if rank == 0:
+        result = {
+            'backend': dist.get_backend(),
+            'world_size': dist.get_world_size(),
+            'ulysses_degree': args.ulysses_degree,
+            'ring_degree': args.ring_degree,
+            'shape': list(shape),
+            'dtype': args.dtype,
+            'max_abs_err': (out.float() - ref.float()).abs().max().item(),
+            'sp_ms': sp_time,
+            'single_rank_ms': ref_time,
+            'speedup': ref_time / sp_time,
+        }
+        print(json.dumps(result))
+        if args.output is not None:
+            with open(args.output, "a") as f:
+                f.write(json.dumps(result) + "\n")
+
+    dist.destroy_process_group()
@@ -0,0 +1,97 @@
+"""
+Overlap benchmark of the pipelined sequence parallel self-attention (ulysses all-to-alls over groups of heads).
+
+Runs one `SelfAttention` layer with the serial schedule and with `--head_groups` groups, checks that both give
+the same output and reports how much of the exposed all-to-all time the pipelining hides, e.g. under gloo:
+
+    torchrun --nproc_per_node 4 benchmark/benchmark_sp_overlap.py --ulysses_degree 4 --head_groups 4 --backend gloo
+"""
+import argparse
+import json
+
+import torch
+import torch.distributed as dist
+
+from stepvideo.modules.attentions import AttentionTimer
+from stepvideo.modules.blocks import SelfAttention
+from stepvideo.parallel import initialize_parall_group, get_sequence_parallel_valid_mask, shard_sequence
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Pipelined sequence parallel attention benchmark")
+    parser.add_argument("--ulysses_degree", type=int, default=2)
+    parser.add_argument("--ring_degree", type=int, default=1)
+    parser.add_argument("--head_groups", type=int, default=4)
+    parser.add_argument("--backend", type=str, default=None, help="gloo or nccl, nccl if cuda is available.")
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--frames", type=int, default=3)
+    parser.add_argument("--height", type=int, default=16)
+    parser.add_argument("--width", type=int, default=32)
+    parser.add_argument("--num_heads", type=int, default=48)
+    parser.add_argument("--dtype", type=str, default="float32", choices=["float32", "bfloat16", "float16"])
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--iters", type=int, default=5)
+    parser.add_argument("--output", type=str, default=None, help="Append the results as a JSON line to this file.")
+    return parser.parse_args()
+
+
+def run(attn, x, rope_positions, valid_mask, num_head_groups, warmup, iters):
+    attn.core_attention.num_head_groups = num_head_groups
+    attn.core_attention.timer = None
+    for _ in range(warmup):
+        attn(x, rope_positions=rope_positions, attn_mask=valid_mask)
+    attn.core_attention.timer = AttentionTimer()
+    dist.barrier()
+    for _ in range(iters):
+        out = attn(x, rope_positions=rope_positions, attn_mask=valid_mask)
+    stats = attn.core_attention.timer.stats()
+    attn.core_attention.timer = None
+    return out, stats
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    initialize_parall_group(args.ring_degree, args.ulysses_degree, engine="native", backend=args.backend)
+    rank = dist.get_rank()
+    device = torch.device(f"cuda:{torch.cuda.current_device()}") if dist.get_backend() == "nccl" else torch.device("cpu")
+    dtype = getattr(torch, args.dtype)
+
+    ## identical weights and inputs on every rank, each rank keeps its (padded) sequence shard
+    torch.manual_seed(0)
+    ## the head dim is fixed by the RoPE channel split of `SelfAttention`
+    head_dim = 128
+    hidden_dim = args.num_heads * head_dim
+    attn = SelfAttention(hidden_dim, head_dim, attn_type='parallel').to(device=device, dtype=dtype)
+    seq_len = args.frames * args.height * args.width
+    x = torch.randn(args.batch_size, seq_len, hidden_dim, dtype=dtype).to(device)
+    x = shard_sequence(x, seq_len)
+    valid_mask = get_sequence_parallel_valid_mask(seq_len, device=device)
+    rope_positions = [args.frames, args.height, args.width]
+
+    with torch.no_grad():
+        serial_out, serial = run(attn, x, rope_positions, valid_mask, 1, args.warmup, args.iters)
+        pipelined_out, pipelined = run(attn, x, rope_positions, valid_mask, args.head_groups, args.warmup, args.iters)
+    if not attn.core_attention.can_pipeline(args.num_heads):
+        print(f"rank {rank}: {args.head_groups} head groups do not fit {args.num_heads} heads, ran the serial schedule")
+
+    if rank == 0:
+        result = {
+            'backend': dist.get_backend(),
+            'world_size': dist.get_world_size(),
+            'ulysses_degree': args.ulysses_degree,
+            'ring_degree': args.ring_degree,
+            'head_groups': args.head_groups,
+            'seq_len': seq_len,
+            'dtype': args.dtype,
+            'max_abs_err': (pipelined_out.float() - serial_out.float()).abs().max().item(),
+            'serial': serial,
+            'pipelined': pipelined,
+            'hidden_comm_fraction': 1 - pipelined['exposed_comm_ms'] / serial['exposed_comm_ms'] if serial['exposed_comm_ms'] > 0 else 0.0,
+            'speedup': serial['total_ms'] / pipelined['total_ms'],
+        }
+        print(json.dumps(result))
+        if args.output is not None:
+            with open(args.output, "a") as f:
+                f.write(json.dumps(result) + "\n")
+
+    dist.destroy_process_group()
@@ -0,0 +1,146 @@
+from stepvideo.diffusion.video_pipeline import StepVideoPipeline
+from stepvideo.serving import GenerationRequest, PipelinedJobRunner
+from stepvideo.serving.manifest import load_manifest
+from stepvideo.serving.adaptive import AdaptiveParallelScheduler
+import torch.distributed as dist
+import torch
+import dataclasses
+import glob
+import json
+import os
+import threading
+from stepvideo.config import parse_args, build_denoise_kwargs
+from stepvideo.parallel import initialize_parall_group, get_parallel_group, get_data_parallel_rank, get_data_parallel_world_size, is_sequence_parallel_leader
+from stepvideo.utils import setup_seed
+
+
+def load_finished(save_path):
+    ## results of every replica of previous runs, so that resuming works with a different number of replicas
+    finished = {}
+    for path in glob.glob(os.path.join(save_path, "batch_results-*.jsonl")):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:   ## a line cut by an interrupted run
+                    continue
+                if all(os.path.exists(v) for v in result['outputs']):
+                    finished[result['name']] = result
+    return finished
+
+
+def build_request(job, args):
+    fields = {f.name for f in dataclasses.fields(GenerationRequest)}
+    request = GenerationRequest(
+        prompt=job['prompt'],
+        first_image=job['first_image'],
+        num_frames=args.num_frames,
+        height=args.height,
+        width=args.width,
+        num_inference_steps=args.infer_steps,
+        guidance_scale=args.cfg_scale,
+        time_shift=args.time_shift,
+        motion_score=args.motion_score,
+        seed=args.seed,
+        pos_magic=args.pos_magic,
+        neg_magic=args.neg_magic,
+        output_file_name=job['name'],
+        request_id=job['name'],
+    )
+    return dataclasses.replace(request, **{k: v for k, v in job.items() if k in fields and k != 'request_id'})
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    initialize_parall_group(ring_degree=args.ring_degree, ulysses_degree=args.ulysses_degree, data_parallel_degree=args.data_parallel_degree, engine=args.sp_engine, cfg_degree=args.cfg_degree)
+    
+    local_rank = get_parallel_group().local_rank
+    device = torch.device(f"cuda:{local_rank}")
+    
+    setup_seed(args.seed)
+        
+    pipeline = StepVideoPipeline.from_pretrained(args.model_dir).to(dtype=torch.bfloat16, device="cpu")
+
+    pipeline.transformer = pipeline.transformer.to(device)
+    pipeline.setup_pipeline(args)
+    
+    
+    denoise_kwargs = build_denoise_kwargs(args)
+    
+    ## shard before skipping finished jobs, so all ranks of a replica agree on its jobs
+    ## with adaptive sub-groups, every rank plans all jobs and runs its own share of them
+    adaptive = args.adaptive_tokens_per_rank is not None
+    dp_rank, dp_world_size = (0, 1) if adaptive else (get_data_parallel_rank(), get_data_parallel_world_size())
+    jobs, missing = load_manifest(args.manifest)
+    shard = jobs[dp_rank::dp_world_size]
+    finished = load_finished(args.save_path)
+    todo = [job for job in shard if job['name'] not in finished]
+    dist.barrier()
+    if dist.get_rank() == 0:
+        print(f"{len(jobs)} jobs over {'adaptive sub-groups' if adaptive else f'{dp_world_size} replicas'}, {len(finished)} already finished, {len(missing)} without a first image")
+    
+    os.makedirs(args.save_path, exist_ok=True)
+    results_path = os.path.join(args.save_path, f"batch_results-{'rank' if adaptive else 'dp'}{dist.get_rank() if adaptive else dp_rank}.jsonl")
+    results_lock = threading.Lock()
+    
+    def record(result):
+        outputs = result['video'] if isinstance(result['video'], list) else [result['video']]
+        row = {
+            'name': result['request_id'],
+            'outputs': outputs,
+            'conditioning_time': result['stats']['conditioning_time'],
+            'num_cfg_steps': result['stats']['num_cfg_steps'],
+        }
+        with results_lock, open(results_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+    
+    requests = [build_request(job, args) for job in todo]
+    if adaptive:
+        runner = AdaptiveParallelScheduler(tokens_per_rank=args.adaptive_tokens_per_rank)
+        results = runner.run(pipeline, requests, on_result=record, **denoise_kwargs)
+        num_runs = sum(runner.degree_counts.values())
+    else:
+        runner = PipelinedJobRunner(pipeline, prefetch_depth=args.prefetch_depth, on_result=record, **denoise_kwargs)
+        results = runner.run(requests)
+        num_runs = len(requests)
+    
+    stats = runner.stats()
+    num_generated = len([r for r in results if r is not None])
+    summary = {
+        'rank': dist.get_rank(),
+        'dp_rank': dp_rank,
+        'num_jobs': len(shard),
+        'num_runs': num_runs,
+        'num_generated': num_generated,
+        'num_skipped': len(shard) - len(todo),
+        'videos_per_hour': num_generated / stats['wall_time'] * 3600 if stats['wall_time'] > 0 else 0.0,
+        **stats,
+    }
+    summaries = [None] * dist.get_world_size()
+    dist.all_gather_object(summaries, summary if adaptive or is_sequence_parallel_leader() else None)
+    if dist.get_rank() == 0:
+        reports = [s for s in summaries if s is not None]
+        num_generated = sum(s['num_generated'] for s in reports)
+        wall_time = max(s['wall_time'] for s in reports)
+        ## seconds per video of a stage, as seen by the ranks running it
+        busy = [s for s in reports if s['num_runs'] > 0]
+        total = {
+            'num_jobs': len(jobs),
+            'num_missing_first_image': len(missing),
+            'mode': 'adaptive' if adaptive else 'data_parallel',
+            'num_replicas': dp_world_size,
+            'num_generated': num_generated,
+            'num_skipped': len(jobs) - len(todo) if adaptive else sum(s['num_skipped'] for s in reports),
+            'wall_time': wall_time,
+            'videos_per_hour': num_generated / wall_time * 3600 if wall_time > 0 else 0.0,
+            'stage_seconds': {
+                stage: sum(s[stage]['busy_time'] / s['num_runs'] for s in busy) / max(len(busy), 1)
+                for stage in ['conditioning', 'denoise', 'decode']
+            },
+            'ranks' if adaptive else 'replicas': reports,
+        }
+        with open(os.path.join(args.save_path, "batch_summary.json"), "w", encoding="utf-8") as f:
+            json.dump(total, f, indent=2, ensure_ascii=False)
+        print(f"Generated {num_generated} videos at {total['videos_per_hour']:.1f} videos/hour, seconds per video and stage: {total['stage_seconds']}")
+    
+    dist.destroy_process_group()
@@ -1,14 +1,14 @@
 from stepvideo.diffusion.video_pipeline import StepVideoPipeline
 import torch.distributed as dist
 import torch
-from stepvideo.config import parse_args
+from stepvideo.config import parse_args, build_denoise_kwargs
 from stepvideo.parallel import initialize_parall_group, get_parallel_group
 from stepvideo.utils import setup_seed
 
 
 if __name__ == "__main__":
     args = parse_args()
-    initialize_parall_group(ring_degree=args.ring_degree, ulysses_degree=args.ulysses_degree)
+    initialize_parall_group(ring_degree=args.ring_degree, ulysses_degree=args.ulysses_degree, engine=args.sp_engine, cfg_degree=args.cfg_degree)
     
     local_rank = get_parallel_group().local_rank
     device = torch.device(f"cuda:{local_rank}")
@@ -21,6 +21,8 @@ if __name__ == "__main__":
     pipeline.setup_pipeline(args)
     
     
+    denoise_kwargs = build_denoise_kwargs(args)
+    
     prompt = args.prompt
     videos = pipeline(
         prompt=prompt, 
@@ -30,11 +32,26 @@ if __name__ == "__main__":
         width=args.width,
         num_inference_steps = args.infer_steps,
         guidance_scale=args.cfg_scale,
+        num_videos_per_prompt=args.num_videos,
+        seed=args.seed,
         time_shift=args.time_shift,
         pos_magic=args.pos_magic,
         neg_magic=args.neg_magic,
         output_file_name=args.output_file_name or prompt[:50],
         motion_score=args.motion_score,
+        **denoise_kwargs,
     )
+    if videos is not None:
+        print(f"Classifier free guidance ran on {videos.stats['num_cfg_steps']}/{videos.stats['num_steps']} steps")
+    if videos is not None and videos.stats.get('step_cache') is not None:
+        print(f"Step cache: {videos.stats['step_cache']}")
+    if videos is not None and videos.stats.get('block_cache') is not None:
+        print(f"Block cache: {videos.stats['block_cache']}")
+    if videos is not None and args.sp_attention_timing:
+        for timing in pipeline.transformer.sequence_parallel_attention_timings():
+            print(
+                f"Block {timing['block']:2d}: attention {timing['total_ms']:.2f} ms, "
+                f"exposed all-to-all {timing['exposed_comm_ms']:.2f} ms, compute {timing['compute_ms']:.2f} ms"
+            )
     
     dist.destroy_process_group()
\ No newline at end of file
@@ -0,0 +1,34 @@
+from stepvideo.diffusion.video_pipeline import StepVideoPipeline
+from stepvideo.serving.server import InferenceServer
+import torch.distributed as dist
+import torch
+from stepvideo.config import parse_args, build_denoise_kwargs
+from stepvideo.parallel import initialize_parall_group, get_parallel_group
+from stepvideo.utils import setup_seed
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    initialize_parall_group(ring_degree=args.ring_degree, ulysses_degree=args.ulysses_degree, engine=args.sp_engine, cfg_degree=args.cfg_degree)
+    
+    local_rank = get_parallel_group().local_rank
+    device = torch.device(f"cuda:{local_rank}")
+    
+    setup_seed(args.seed)
+        
+    pipeline = StepVideoPipeline.from_pretrained(args.model_dir).to(dtype=torch.bfloat16, device="cpu")
+
+    pipeline.transformer = pipeline.transformer.to(device)
+    pipeline.setup_pipeline(args)
+    
+    
+    denoise_kwargs = build_denoise_kwargs(args)
+    
+    server = InferenceServer(
+        pipeline,
+        args,
+        denoise_kwargs=denoise_kwargs,
+    )
+    server.serve()
+    
+    dist.destroy_process_group()
@@ -0,0 +1,94 @@
+import abc
+from typing import Dict, List, Optional
+
+import torch
+
+
+class CommCodec(abc.ABC):
+    """
+    Lossy encoding of the activations sent by a collective. `encode` returns a payload and the scales needed
+    to decode it; both are sent, and `decode` restores the activations in `dtype` on the receiving rank.
+    """
+
+    name = None
+
+    @abc.abstractmethod
+    def encode(self, x: torch.Tensor):
+        pass
+
+    @abc.abstractmethod
+    def decode(self, payload: torch.Tensor, scale: torch.Tensor, dtype: torch.dtype):
+        pass
+
+
+class Fp8Codec(CommCodec):
+    """
+    float8 e4m3 with one scale per token (and head), i.e. over the last dim. The payload travels as uint8, so
+    the backend does not need to support float8. With 3 mantissa bits, the error of an element is at most
+    2^-4 of the largest magnitude of its token.
+    """
+
+    name = "fp8"
+    max_value = 448.0
+
+    def encode(self, x):
+        scale = x.abs().amax(dim=-1, keepdim=True).float().clamp(min=1e-12) / self.max_value
+        payload = (x.float() / scale).to(torch.float8_e4m3fn).view(torch.uint8)
+        return payload, scale
+
+    def decode(self, payload, scale, dtype):
+        return (payload.view(torch.float8_e4m3fn).float() * scale).to(dtype)
+
+
+class Int8Codec(CommCodec):
+    """
+    Symmetric int8 with one scale per head of a (b, s, h, d) tensor, taken over its tokens and channels, or
+    one scale per channel of a (b, s, c) tensor. The error of an element is at most half a step, i.e. 1/254 of
+    the largest magnitude of its head or channel.
+    """
+
+    name = "int8"
+    max_value = 127.0
+
+    def encode(self, x):
+        dims = (1, 3) if x.ndim == 4 else (1,)
+        scale = x.abs().amax(dim=dims, keepdim=True).float().clamp(min=1e-12) / self.max_value
+        payload = (x.float() / scale).round().clamp(-self.max_value, self.max_value).to(torch.int8)
+        return payload, scale
+
+    def decode(self, payload, scale, dtype):
+        return (payload.float() * scale).to(dtype)
+
+
+comm_codecs = {
+    Fp8Codec.name: Fp8Codec,
+    Int8Codec.name: Int8Codec,
+}
+
+## `qkv`: the ulysses all-to-all of q, k and v, `attn_out`: the one of the attention output back,
+## `gather`: the all-gather of the transformer output
+comm_collectives = ["qkv", "attn_out", "gather"]
+
+
+def parse_comm_codecs(specs: Optional[List[str]]) -> Dict[str, Optional[CommCodec]]:
+    """Codec of every collective from `collective=codec` specs, e.g. `["qkv=fp8", "gather=int8"]`; `none` by default."""
+    codecs = {collective: None for collective in comm_collectives}
+    for spec in specs or []:
+        collective, _, name = spec.partition("=")
+        if collective not in codecs:
+            raise ValueError(f"Unknown collective {collective}, should be one of {comm_collectives}")
+        if name != "none" and name not in comm_codecs:
+            raise ValueError(f"Unknown codec {name}, should be one of {['none'] + list(comm_codecs)}")
+        codecs[collective] = comm_codecs[name]() if name != "none" else None
+    return codecs
+
+
+def compressed_all_gather(group, input_: torch.Tensor, dim: int = -1, codec: Optional[CommCodec] = None):
+    """`group.all_gather(input_, dim)` that sends the encoded payload and scales instead of `input_`."""
+    if codec is None or group.world_size == 1:
+        return group.all_gather(input_.contiguous(), dim=dim)
+    payload, scale = codec.encode(input_)
+    ## gathered along a new leading dim, so every rank's shard is decoded with its own scales
+    payload = group.all_gather(payload.contiguous()[None], dim=0)
+    scale = group.all_gather(scale.contiguous()[None], dim=0)
+    return torch.cat(codec.decode(payload, scale, input_.dtype).unbind(0), dim=dim)
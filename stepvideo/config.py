@@ -1,5 +1,7 @@
 import argparse
 
+from stepvideo.modules.cache import TeaCache, BlockCache
+
 def parse_args(namespace=None):
     parser = argparse.ArgumentParser(description="StepVideo inference script")
 
@@ -7,12 +9,38 @@ def parse_args(namespace=None):
     parser = add_denoise_schedule_args(parser)
     parser = add_inference_args(parser)
     parser = add_parallel_args(parser)
+    parser = add_server_args(parser)
+    parser = add_batch_args(parser)
 
     args = parser.parse_args(namespace=namespace)
 
     return args
 
 
+def build_denoise_kwargs(args):
+    """
+    Keyword arguments of `StepVideoPipeline.denoise` from the inference args: the guidance schedule, the K/V cache
+    budget and the step and block caches, if enabled.
+    """
+    step_cache = TeaCache(
+        threshold=args.teacache_threshold,
+        error_budget=args.teacache_error_budget,
+        max_skip_steps=args.teacache_max_skip_steps,
+        mode=args.teacache_mode,
+    ) if args.teacache_threshold > 0 else None
+    block_cache = BlockCache(
+        num_head_blocks=args.deepcache_head_blocks,
+        num_tail_blocks=args.deepcache_tail_blocks,
+        interval=args.deepcache_interval,
+    ) if args.deepcache_interval > 0 else None
+    return dict(
+        cfg_interval=args.cfg_interval,
+        cfg_truncation=args.cfg_truncation,
+        max_kv_cache_bytes=None if args.kv_cache_gb is None else int(args.kv_cache_gb * 1024**3),
+        step_cache=step_cache,
+        block_cache=block_cache,
+    )
+
 
 def add_extra_models_args(parser: argparse.ArgumentParser):
     group = parser.add_argument_group(
@@ -54,7 +82,8 @@ def add_denoise_schedule_args(parser: argparse.ArgumentParser):
         "--flow_solver",
         type=str,
         default="euler",
-        help="Solver for flow matching.",
+        choices=["euler", "heun", "midpoint", "dpmsolver++", "unipc"],
+        help="Solver for flow matching. Heun and midpoint evaluate the model twice per step.",
     )
 
     return parser
@@ -164,9 +193,51 @@ def add_inference_args(parser: argparse.ArgumentParser):
     group.add_argument(
         "--cfg_scale", type=float, default=9.0, help="Classifier free guidance scale."
     )
+    group.add_argument(
+        "--cfg_interval", type=float, nargs=2, default=None, help="Only apply classifier free guidance on steps whose timestep lies in [low, high]."
+    )
+    group.add_argument(
+        "--cfg_truncation", type=float, default=1.0, help="Only apply classifier free guidance on the first fraction of the denoising steps."
+    )
     group.add_argument(
         "--motion_score", type=float, default=5, help="Score to control the motion level of the video."
     )
+    group.add_argument(
+        "--teacache_threshold", type=float, default=0.0, help="Accumulated relative L1 distance below which a denoising step reuses the previous transformer residual. 0 disables step caching."
+    )
+    group.add_argument(
+        "--teacache_error_budget", type=float, default=None, help="Upper bound for the accumulated distance of all skipped steps of a request."
+    )
+    group.add_argument(
+        "--teacache_max_skip_steps", type=int, default=3, help="Maximum number of consecutive skipped steps."
+    )
+    group.add_argument(
+        "--teacache_mode", type=str, default="reuse", choices=["reuse", "extrapolate"], help="Reuse or extrapolate the cached residual on skipped steps."
+    )
+    group.add_argument(
+        "--deepcache_interval", type=int, default=0, help="Recompute the middle transformer blocks every N steps and reuse their cached residual in between. 0 disables block caching."
+    )
+    group.add_argument(
+        "--deepcache_head_blocks", type=int, default=8, help="Number of leading blocks computed at every step when block caching is enabled."
+    )
+    group.add_argument(
+        "--deepcache_tail_blocks", type=int, default=8, help="Number of trailing blocks computed at every step when block caching is enabled."
+    )
+    group.add_argument(
+        "--kv_cache_gb", type=float, default=None, help="Memory budget (GB) for cross-attention K/V reused across denoising steps. Cache all blocks if not set."
+    )
+    group.add_argument(
+        "--prompt_cache_size", type=int, default=256, help="Number of prompt embeddings kept in the client-side LRU cache. 0 disables the cache."
+    )
+    group.add_argument(
+        "--latent_cache_size", type=int, default=64, help="Number of first-image VAE latents kept in memory."
+    )
+    group.add_argument(
+        "--latent_cache_dir", type=str, default=None, help="Directory of the on-disk first-image latent cache. No disk cache if not set."
+    )
+    group.add_argument(
+        "--latent_cache_disk_gb", type=float, default=None, help="Size limit (GB) of the on-disk first-image latent cache."
+    )
 
 
     return parser
@@ -189,6 +260,50 @@ def add_parallel_args(parser: argparse.ArgumentParser):
         help="Ulysses degree.",
     )
 
+    group.add_argument(
+        "--cfg_degree",
+        type=int,
+        default=1,
+        choices=[1, 2],
+        help="2 runs the conditional and unconditional guidance branches on two sequence parallel groups of "
+        "ulysses_degree * ring_degree ranks each, exchanging only their noise predictions.",
+    )
+
+    group.add_argument(
+        "--sp_engine",
+        type=str,
+        default="xfuser",
+        choices=["xfuser", "native"],
+        help="Sequence parallel engine, xfuser or the native torch.distributed ulysses/ring implementation.",
+    )
+    group.add_argument(
+        "--sp_head_groups",
+        type=int,
+        default=1,
+        help="Pipelines the native sequence parallel attention over this many groups of heads, overlapping the "
+        "ulysses all-to-alls with the projections and the attention. Has no effect with xfuser.",
+    )
+    group.add_argument(
+        "--sp_attention_timing",
+        action="store_true",
+        help="Records and prints the per-block timing of the sequence parallel attention.",
+    )
+    group.add_argument(
+        "--sp_comm_codec",
+        type=str,
+        nargs="*",
+        default=[],
+        help="Lossy compression of sequence parallel collectives, as `collective=codec` with the collectives qkv, "
+        "attn_out (ulysses all-to-alls, native engine only) and gather (transformer output) and the codecs "
+        "fp8 (per-token scales), int8 (per-head scales) or none, e.g. `--sp_comm_codec qkv=fp8 attn_out=fp8`.",
+    )
+    group.add_argument(
+        "--data_parallel_degree",
+        type=int,
+        default=1,
+        help="Number of independent sequence parallel replicas, each generating its own share of the videos.",
+    )
+
     group.add_argument(
         "--tensor_parallel_degree",
         type=int,
@@ -196,3 +311,75 @@ def add_parallel_args(parser: argparse.ArgumentParser):
         help="Tensor parallel degree.",
     )
     return parser
+
+
+def add_server_args(parser: argparse.ArgumentParser):
+    group = parser.add_argument_group(title="Server args")
+
+    group.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="Host the job intake of the inference server listens on.",
+    )
+    group.add_argument(
+        "--port",
+        type=int,
+        default=8090,
+        help="Port the job intake of the inference server listens on.",
+    )
+    group.add_argument(
+        "--max_queued_jobs",
+        type=int,
+        default=64,
+        help="Maximum number of jobs waiting in the inference server.",
+    )
+    group.add_argument(
+        "--finished_job_ttl",
+        type=float,
+        default=3600.0,
+        help="Seconds the inference server keeps the status of a done or failed job.",
+    )
+    group.add_argument(
+        "--max_finished_jobs",
+        type=int,
+        default=1024,
+        help="Maximum number of done or failed jobs whose status the inference server keeps.",
+    )
+    group.add_argument(
+        "--continuous_batching",
+        action="store_true",
+        help="Denoise the jobs of the inference server in continuous batches, admitting new jobs at step boundaries. Requires the euler solver and no step/block caches or guidance schedule.",
+    )
+    group.add_argument(
+        "--max_batch_jobs",
+        type=int,
+        default=4,
+        help="Maximum number of jobs denoised together per latent shape and schedule with --continuous_batching.",
+    )
+    return parser
+
+
+def add_batch_args(parser: argparse.ArgumentParser):
+    group = parser.add_argument_group(title="Batch args")
+
+    group.add_argument(
+        "--manifest",
+        type=str,
+        nargs="+",
+        default=["benchmark/Step-Video-TI2V-Eval"],
+        help="Benchmark directories of NNN.png/NNN.txt pairs or JSONL files of jobs for run_batch.py.",
+    )
+    group.add_argument(
+        "--prefetch_depth",
+        type=int,
+        default=1,
+        help="Number of jobs whose conditioning is prepared while another one denoises.",
+    )
+    group.add_argument(
+        "--adaptive_tokens_per_rank",
+        type=int,
+        default=None,
+        help="Run every job on a sequence parallel sub-group sized to about this many video tokens per rank, instead of data parallel replicas.",
+    )
+    return parser
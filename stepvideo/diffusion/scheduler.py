@@ -1,5 +1,6 @@
 from dataclasses import dataclass
 from typing import Optional, Tuple, Union
+import math
 
 import numpy as np
 import torch
@@ -28,7 +29,11 @@ class FlowMatchDiscreteSchedulerOutput(BaseOutput):
 
 class FlowMatchDiscreteScheduler(SchedulerMixin, ConfigMixin):
     """
-    Euler scheduler.
+    Flow matching scheduler with Euler, Heun, midpoint, DPM-Solver++(2M) and UniPC (bh2) solvers.
+
+    Heun and midpoint evaluate the model twice per step, so their `timesteps` interleave the extra evaluation
+    points. DPM-Solver++ and UniPC are multistep solvers on the data prediction `x - noise_level * velocity`;
+    their coefficients are precomputed on the host in `set_timesteps`, so `step` only combines device tensors.
 
     This model inherits from [`SchedulerMixin`] and [`ConfigMixin`]. Check the superclass documentation for the generic
     methods the library implements for all schedulers such as loading and saving.
@@ -41,6 +46,8 @@ class FlowMatchDiscreteScheduler(SchedulerMixin, ConfigMixin):
             Sample Steps are Flawed](https://huggingface.co/papers/2305.08891) for more information.
         reverse (`bool`, defaults to `True`):
             Whether to reverse the timestep schedule.
+        solver (`str`, defaults to `"euler"`):
+            One of `"euler"`, `"heun"`, `"midpoint"`, `"dpmsolver++"` and `"unipc"`.
     """
 
     _compatibles = []
@@ -65,10 +72,11 @@ class FlowMatchDiscreteScheduler(SchedulerMixin, ConfigMixin):
 
         self._step_index = None
         self._begin_index = None
+        self.reset_solver_state()
         
         self.device = device
 
-        self.supported_solver = ["euler"]
+        self.supported_solver = ["euler", "heun", "midpoint", "dpmsolver++", "unipc"]
         if solver not in self.supported_solver:
             raise ValueError(
                 f"Solver {solver} not supported. Supported solvers: {self.supported_solver}"
@@ -131,8 +139,121 @@ class FlowMatchDiscreteScheduler(SchedulerMixin, ConfigMixin):
         self.sigmas = sigmas
         self.timesteps = sigmas[:-1]
 
+        if self.config.solver in ["heun", "midpoint"]:
+            self.set_two_stage_timesteps()
+        elif self.config.solver in ["dpmsolver++", "unipc"]:
+            self.set_multistep_coefficients()
+
         # Reset step index
         self._step_index = None
+        self.reset_solver_state()
+
+    def reset_solver_state(self):
+        self.prev_derivative = None
+        self.prev_sample = None
+        self.model_outputs = []
+
+    def set_two_stage_timesteps(self):
+        """
+        Interleaves the second model evaluation of every step into `timesteps`. Heun evaluates again at the end of
+        the step (except for the last step, which falls back to Euler), midpoint at the middle of the step.
+        """
+        num_steps = len(self.sigmas) - 1
+        timesteps, self.stage_plan = [], []
+        for i in range(num_steps):
+            timesteps.append(self.sigmas[i])
+            self.stage_plan.append((i, 0))
+            if self.config.solver == "heun" and i < num_steps - 1:
+                timesteps.append(self.sigmas[i + 1])
+                self.stage_plan.append((i, 1))
+            elif self.config.solver == "midpoint":
+                timesteps.append((self.sigmas[i] + self.sigmas[i + 1]) / 2)
+                self.stage_plan.append((i, 1))
+        self.timesteps = torch.stack(timesteps)
+
+    def solver_step_indices(self):
+        """Index of the solver step each entry of `timesteps` belongs to: two-stage solvers evaluate twice per step."""
+        if self.config.solver in ["heun", "midpoint"]:
+            return [i for i, _ in self.stage_plan]
+        return list(range(len(self.timesteps)))
+
+    def noise_level(self, sigma):
+        return sigma if self.config.reverse else 1 - sigma
+
+    @staticmethod
+    def log_snr(noise_level):
+        ## lambda = log(alpha / sigma) of the linear interpolation path x = (1 - n) * x0 + n * noise
+        if noise_level >= 1:
+            return -math.inf
+        if noise_level <= 0:
+            return math.inf
+        return math.log(1 - noise_level) - math.log(noise_level)
+
+    def set_multistep_coefficients(self):
+        """
+        Precomputes, for every step, the coefficients of the multistep update as a linear combination of the current
+        sample and the data predictions in the history. The last step is always first order.
+        """
+        self.sigmas_host = self.sigmas.tolist()
+        noise_levels = [self.noise_level(s) for s in self.sigmas_host]
+        lambdas = [self.log_snr(n) for n in noise_levels]
+        num_steps = len(noise_levels) - 1
+
+        self.multistep_coefficients = []
+        for i in range(num_steps):
+            n_s, n_t = noise_levels[i], noise_levels[i + 1]
+            alpha_s, alpha_t = 1 - n_s, 1 - n_t
+            h = lambdas[i + 1] - lambdas[i]
+            exp_neg_h = (alpha_s * n_t) / (n_s * alpha_t)  ## exp(-h), exact at both ends of the schedule
+
+            order = 2 if i > 0 and i < num_steps - 1 and math.isfinite(lambdas[i - 1]) else 1
+            rk = (lambdas[i - 1] - lambdas[i]) / h if order == 2 else None
+
+            if self.config.solver == "dpmsolver++":
+                ## x_t = n_t / n_s * x - alpha_t * (exp(-h) - 1) * D,  D = (1 + 1/(2r)) * D_n - 1/(2r) * D_{n-1}
+                c_d = alpha_t * (1 - exp_neg_h)
+                if order == 2:
+                    r = -rk
+                    coeffs = {'sample': n_t / n_s, 'model_output': c_d * (1 + 0.5 / r), 'prev_model_output': -c_d * 0.5 / r}
+                else:
+                    coeffs = {'sample': n_t / n_s, 'model_output': c_d}
+            else:
+                coeffs = self.unipc_coefficients(n_s, n_t, exp_neg_h, h, order, rk)
+            coeffs['order'] = order
+            self.multistep_coefficients.append(coeffs)
+
+    @staticmethod
+    def unipc_coefficients(n_s, n_t, exp_neg_h, h, order, rk):
+        """UniP predictor and UniC corrector (B(h) = exp(-h) - 1) coefficients of one step."""
+        alpha_t = 1 - n_t
+        hh = -h
+        h_phi_1 = exp_neg_h - 1
+        b_h = exp_neg_h - 1
+
+        rks = [rk, 1.0] if order == 2 else [1.0]
+        h_phi_k = h_phi_1 / hh - 1
+        factorial_i = 1
+        b = []
+        for i in range(1, order + 1):
+            b.append(h_phi_k * factorial_i / b_h)
+            factorial_i *= i + 1
+            h_phi_k = h_phi_k / hh - 1 / factorial_i
+
+        predictor = {'sample': n_t / n_s, 'model_output': -alpha_t * h_phi_1}
+        corrector = {'sample': n_t / n_s, 'model_output': -alpha_t * h_phi_1}
+        if order == 2:
+            ## D1 = (m_prev - m0) / rk
+            predictor['model_output'] += alpha_t * b_h * 0.5 / rk
+            predictor['prev_model_output'] = -alpha_t * b_h * 0.5 / rk
+            ## solve [[1, 1], [rk, 1]] @ rhos = b
+            rhos_c = [(b[0] - b[1]) / (1 - rk), (b[1] - rk * b[0]) / (1 - rk)]
+            corrector['model_output'] += alpha_t * b_h * rhos_c[0] / rk
+            corrector['prev_model_output'] = -alpha_t * b_h * rhos_c[0] / rk
+        else:
+            rhos_c = [0.5]
+        corrector['model_output'] += alpha_t * b_h * rhos_c[-1]
+        corrector['next_model_output'] = -alpha_t * b_h * rhos_c[-1]
+        return dict(predictor, corrector=corrector)
 
     def index_for_timestep(self, timestep, schedule_timesteps=None):
         if schedule_timesteps is None:
@@ -170,6 +291,7 @@ class FlowMatchDiscreteScheduler(SchedulerMixin, ConfigMixin):
         timestep: Union[float, torch.FloatTensor],
         sample: torch.FloatTensor,
         return_dict: bool = False,
+        step_index: Optional[torch.LongTensor] = None,
     ) -> Union[FlowMatchDiscreteSchedulerOutput, Tuple]:
         """
         Predict the sample from the previous timestep by reversing the SDE. This function propagates the diffusion
@@ -189,6 +311,9 @@ class FlowMatchDiscreteScheduler(SchedulerMixin, ConfigMixin):
             return_dict (`bool`):
                 Whether or not to return a [`~schedulers.scheduling_euler_discrete.EulerDiscreteSchedulerOutput`] or
                 tuple.
+            step_index (`torch.LongTensor`, *optional*):
+                Per-sample indices into the schedule, for batches whose samples are at different steps (continuous
+                batching). The scheduler's own step counter is left untouched. Only supported by the euler solver.
 
         Returns:
             [`~schedulers.scheduling_euler_discrete.EulerDiscreteSchedulerOutput`] or `tuple`:
@@ -209,16 +334,32 @@ class FlowMatchDiscreteScheduler(SchedulerMixin, ConfigMixin):
                 ),
             )
 
+        if step_index is not None:
+            if self.config.solver != "euler":
+                raise ValueError(
+                    f"Per-sample step indices are only supported by the euler solver, got {self.config.solver}"
+                )
+            step_index = step_index.to(self.sigmas.device)
+            dt = self.sigmas[step_index + 1] - self.sigmas[step_index]
+            dt = dt.view(-1, *[1] * (sample.ndim - 1))
+            prev_sample = sample.to(torch.float32) + model_output.to(torch.float32) * dt
+            if not return_dict:
+                return prev_sample
+            return FlowMatchDiscreteSchedulerOutput(prev_sample=prev_sample)
+
         if self.step_index is None:
             self._init_step_index(timestep)
 
         # Upcast to avoid precision issues when computing prev_sample
         sample = sample.to(torch.float32)
 
-        dt = self.sigmas[self.step_index + 1] - self.sigmas[self.step_index]
-
         if self.config.solver == "euler":
+            dt = self.sigmas[self.step_index + 1] - self.sigmas[self.step_index]
             prev_sample = sample + model_output.to(torch.float32) * dt
+        elif self.config.solver in ["heun", "midpoint"]:
+            prev_sample = self.two_stage_step(model_output.to(torch.float32), sample)
+        elif self.config.solver in ["dpmsolver++", "unipc"]:
+            prev_sample = self.multistep_step(model_output.to(torch.float32), sample)
         else:
             raise ValueError(
                 f"Solver {self.config.solver} not supported. Supported solvers: {self.supported_solver}"
@@ -232,5 +373,59 @@ class FlowMatchDiscreteScheduler(SchedulerMixin, ConfigMixin):
 
         return FlowMatchDiscreteSchedulerOutput(prev_sample=prev_sample)
 
+    def two_stage_step(self, derivative, sample):
+        i, stage = self.stage_plan[self.step_index]
+        dt = self.sigmas[i + 1] - self.sigmas[i]
+
+        if stage == 0:
+            has_second_stage = self.step_index + 1 < len(self.stage_plan) and self.stage_plan[self.step_index + 1][1] == 1
+            if not has_second_stage:
+                return sample + derivative * dt
+            self.prev_derivative, self.prev_sample = derivative, sample
+            if self.config.solver == "heun":
+                return sample + derivative * dt
+            return sample + derivative * (dt / 2)
+
+        if self.config.solver == "heun":
+            derivative = (self.prev_derivative + derivative) / 2
+        prev_sample = self.prev_sample + derivative * dt
+        self.prev_derivative, self.prev_sample = None, None
+        return prev_sample
+
+    @staticmethod
+    def combine(coeffs, tensors):
+        out = None
+        for name, tensor in tensors.items():
+            c = coeffs.get(name, 0.0)
+            if c == 0.0 or tensor is None:
+                continue
+            out = tensor * c if out is None else out.add_(tensor, alpha=c)
+        return out
+
+    def multistep_step(self, velocity, sample):
+        i = self.step_index
+        coeffs = self.multistep_coefficients[i]
+        ## data prediction x0 = x - noise_level * d(x)/d(noise_level)
+        sign = 1.0 if self.config.reverse else -1.0
+        model_output = sample - velocity * (sign * self.noise_level(self.sigmas_host[i]))
+
+        if self.config.solver == "unipc" and self.prev_sample is not None:
+            ## correct the sample with the model output evaluated at it, using the previous step's coefficients
+            sample = self.combine(self.multistep_coefficients[i - 1]['corrector'], {
+                'sample': self.prev_sample,
+                'model_output': self.model_outputs[-1],
+                'prev_model_output': self.model_outputs[-2] if len(self.model_outputs) > 1 else None,
+                'next_model_output': model_output,
+            })
+
+        self.model_outputs = (self.model_outputs + [model_output])[-2:]
+        self.prev_sample = sample
+
+        return self.combine(coeffs, {
+            'sample': sample,
+            'model_output': model_output,
+            'prev_model_output': self.model_outputs[0] if coeffs['order'] == 2 else None,
+        })
+
     def __len__(self):
         return self.config.num_train_timesteps
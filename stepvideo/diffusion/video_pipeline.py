@@ -9,10 +9,14 @@ import torch
 from diffusers.pipelines.pipeline_utils import DiffusionPipeline
 from diffusers.utils import BaseOutput
 import asyncio
+import time
 
 from stepvideo.modules.model import StepVideoModel
+from stepvideo.modules.cache import TeaCache, BlockCache
+from stepvideo.parallel import is_sequence_parallel_leader, get_cfg_parallel_world_size, get_cfg_parallel_rank, get_cfg_group
+from stepvideo.comm_codec import parse_comm_codecs
 from stepvideo.diffusion.scheduler import FlowMatchDiscreteScheduler
-from stepvideo.utils import VideoProcessor
+from stepvideo.utils import VideoProcessor, PromptEmbeddingCache, ImageLatentCache
 from torchvision import transforms
 from PIL import Image as PILImage
 
@@ -22,7 +26,7 @@ import os
 def call_api_gen(url, api, port=8080):
     url =f"http://{url}:{port}/{api}-api"
     import aiohttp
-    async def _fn(samples, *args, **kwargs):
+    async def _fn(samples, *args, session=None, **kwargs):
         if api=='vae':
             data = {
                     "samples": samples,
@@ -38,15 +42,20 @@ def call_api_gen(url, api, port=8080):
         else:
             raise Exception(f"Not supported api: {api}...")
         
-        async with aiohttp.ClientSession() as sess:
+        async def _request(sess):
             data_bytes = pickle.dumps(data)
             async with sess.get(url, data=data_bytes, timeout=12000) as response:
                 result = bytearray()
                 while not response.content.at_eof():
                     chunk = await response.content.read(1024)
                     result += chunk
-                response_data = pickle.loads(result)
-        return response_data
+                return pickle.loads(result)
+
+        ## reuse the caller's session (and its connection pool) when given
+        if session is not None:
+            return await _request(session)
+        async with aiohttp.ClientSession() as sess:
+            return await _request(sess)
         
     return _fn
 
@@ -56,6 +65,7 @@ def call_api_gen(url, api, port=8080):
 @dataclass
 class StepVideoPipelineOutput(BaseOutput):
     video: Union[torch.Tensor, np.ndarray]
+    stats: Optional[Dict[str, Any]] = None
     
 
 class StepVideoPipeline(DiffusionPipeline):
@@ -95,6 +105,8 @@ class StepVideoPipeline(DiffusionPipeline):
         self.vae_scale_factor_temporal = self.vae.temporal_compression_ratio if getattr(self, "vae", None) else 8
         self.vae_scale_factor_spatial = self.vae.spatial_compression_ratio if getattr(self, "vae", None) else 16
         self.video_processor = VideoProcessor(save_path, name_suffix)
+        self.prompt_cache = PromptEmbeddingCache()
+        self.latent_cache = ImageLatentCache()
         
         self.vae_url = vae_url
         self.caption_url = caption_url
@@ -102,7 +114,20 @@ class StepVideoPipeline(DiffusionPipeline):
     
     def setup_pipeline(self, args):
         self.args = args
+        if args.flow_solver != self.scheduler.config.solver:
+            self.scheduler = FlowMatchDiscreteScheduler.from_config(self.scheduler.config, solver=args.flow_solver)
         self.video_processor = VideoProcessor(self.args.save_path, self.args.name_suffix)
+        self.prompt_cache = PromptEmbeddingCache(args.prompt_cache_size) if args.prompt_cache_size > 0 else None
+        self.latent_cache = ImageLatentCache(
+            args.latent_cache_size,
+            cache_dir=args.latent_cache_dir,
+            max_disk_bytes=None if args.latent_cache_disk_gb is None else int(args.latent_cache_disk_gb * 1024**3),
+        ) if args.latent_cache_size > 0 or args.latent_cache_dir is not None else None
+        self.transformer.set_sequence_parallel_attention(
+            args.sp_head_groups,
+            record_timings=args.sp_attention_timing,
+            comm_codecs=parse_comm_codecs(args.sp_comm_codec),
+        )
         self.setup_api(args.vae_url, args.caption_url)
         return self
 
@@ -116,18 +141,49 @@ class StepVideoPipeline(DiffusionPipeline):
     
     def encode_prompt(
         self,
-        prompt: str,
+        prompt: Union[str, List[str]],
         neg_magic: str = '',
         pos_magic: str = '',
     ):
         device = self._execution_device
-        prompts = [prompt+pos_magic]
+        prompt_embeds, clip_embedding, prompt_attention_mask = asyncio.run(
+            self.encode_prompt_async(prompt, neg_magic=neg_magic, pos_magic=pos_magic)
+        )
+        return prompt_embeds.to(device), clip_embedding.to(device), prompt_attention_mask.to(device)
+
+    async def encode_prompt_async(
+        self,
+        prompt: Union[str, List[str]],
+        neg_magic: str = '',
+        pos_magic: str = '',
+        session=None,
+    ):
+        prompt = [prompt] if isinstance(prompt, str) else prompt
+        prompts = [p+pos_magic for p in prompt]
         bs = len(prompts)
         prompts += [neg_magic]*bs
         
-        data = asyncio.run(self.caption(prompts))
-        prompt_embeds, prompt_attention_mask, clip_embedding = data['y'].to(device), data['y_mask'].to(device), data['clip_embedding'].to(device)
-
+        if self.prompt_cache is None:
+            data = await self.caption(prompts, session=session)
+            return data['y'], data['clip_embedding'], data['y_mask']
+        return await self.encode_prompt_cached(prompts, neg_magic, session=session)
+
+    async def encode_prompt_cached(self, prompts: List[str], neg_magic: str = '', session=None):
+        ## only texts missing from the cache go to the caption server, in one request
+        cached = {text: self.prompt_cache.get(self.caption_url, text) for text in dict.fromkeys(prompts)}
+        missing = [text for text, entry in cached.items() if entry is None]
+        if len(missing) > 0:
+            data = await self.caption(missing, session=session)
+            for i, text in enumerate(missing):
+                cached[text] = self.prompt_cache.put(
+                    self.caption_url,
+                    text,
+                    data['y'][i:i+1],
+                    data['y_mask'][i:i+1],
+                    data['clip_embedding'][i:i+1],
+                    pin=text == neg_magic,
+                )
+        prompt_embeds, prompt_attention_mask, clip_embedding = self.prompt_cache.collate([cached[text] for text in prompts])
         return prompt_embeds, clip_embedding, prompt_attention_mask
 
     def decode_vae(self, samples):
@@ -176,7 +232,12 @@ class StepVideoPipeline(DiffusionPipeline):
         if generator is None:
             generator = torch.Generator(device=self._execution_device)
 
-        latents = torch.randn(shape, generator=generator, device=device, dtype=dtype)
+        if isinstance(generator, list):
+            latents = torch.cat([
+                torch.randn((1, *shape[1:]), generator=g, device=device, dtype=dtype) for g in generator
+            ])
+        else:
+            latents = torch.randn(shape, generator=generator, device=device, dtype=dtype)
         return latents
 
     
@@ -221,17 +282,7 @@ class StepVideoPipeline(DiffusionPipeline):
         return video
 
 
-    def prepare_condition_hidden_states(
-        self, 
-        img: Union[str, PILImage.Image, torch.Tensor]=None, 
-        batch_size: int = 1,
-        num_channels_latents: int = 64,
-        height: int = 544,
-        width: int = 992,
-        num_frames: int = 204,
-        dtype: Optional[torch.dtype] = None,
-        device: Optional[torch.device] = None
-    ):
+    def load_image(self, img: Union[str, PILImage.Image, torch.Tensor]):
         if isinstance(img, str):
             assert os.path.exists(img)
             img = PILImage.open(img) 
@@ -240,18 +291,193 @@ class StepVideoPipeline(DiffusionPipeline):
             img_tensor = transforms.ToTensor()(img.convert('RGB'))*2-1
         else:
             img_tensor = img
+        return img_tensor
+
+    def resize_first_images(self, imgs, height: int, width: int):
+        ## in shape (b, f=1, c, h, w)
+        return torch.stack([
+            self.resize_to_desired_aspect_ratio(self.load_image(img)[None], aspect_size=[(height, width)]) for img in imgs
+        ])
+
+    async def encode_first_images(
+        self, 
+        img: Union[str, PILImage.Image, torch.Tensor, List[Union[str, PILImage.Image, torch.Tensor]]]=None, 
+        batch_size: int = 1,
+        height: int = 544,
+        width: int = 992,
+        num_frames: int = 204,
+        session=None,
+    ):
+        imgs = img if isinstance(img, (list, tuple)) else [img]
+        if len(imgs) not in [1, batch_size]:
+            raise ValueError(
+                f"You have passed {len(imgs)} first images, but requested a batch size of {batch_size}."
+            )
             
         num_frames, width, height = self.check_inputs(num_frames, width, height)
             
-        img_tensor = self.resize_to_desired_aspect_ratio(img_tensor[None], aspect_size=[(height, width)])[None]
+        if self.latent_cache is None:
+            keys = [None] * len(imgs)
+            latents = [None] * len(imgs)
+        else:
+            keys = [self.latent_cache.key(img, height, width, num_frames, encoder=self.vae_url) for img in imgs]
+            latents = [self.latent_cache.get(key) for key in keys]
+        missing = [i for i, latent in enumerate(latents) if latent is None]
+
+        if len(missing) > 0:
+            ## one vae-encode request for all uncached first images, resized off the event loop
+            img_tensor = await asyncio.to_thread(self.resize_first_images, [imgs[i] for i in missing], height, width)
+            encoded = await self.vae_encode(img_tensor, session=session)
+            for j, i in enumerate(missing):
+                latents[i] = encoded[j:j+1]
+                if self.latent_cache is not None:
+                    self.latent_cache.put(keys[i], latents[i])
+
+        img_emb = torch.cat(latents)
+        if len(imgs) == 1:
+            img_emb = img_emb.repeat(batch_size, 1,1,1,1)
+        return img_emb
 
-        img_emb = self.encode_vae(img_tensor).repeat(batch_size, 1,1,1,1).to(device)
+    def prepare_condition_hidden_states(
+        self, 
+        img: Union[str, PILImage.Image, torch.Tensor, List[Union[str, PILImage.Image, torch.Tensor]]]=None, 
+        batch_size: int = 1,
+        num_channels_latents: int = 64,
+        height: int = 544,
+        width: int = 992,
+        num_frames: int = 204,
+        dtype: Optional[torch.dtype] = None,
+        device: Optional[torch.device] = None,
+        img_emb: Optional[torch.Tensor] = None,
+    ):
+        if img_emb is None:
+            img_emb = asyncio.run(self.encode_first_images(img, batch_size, height, width, num_frames))
+        img_emb = img_emb.to(device=device, dtype=dtype)
         
-        padding_tensor = torch.zeros((batch_size, max(num_frames//17*3, 1)-1, num_channels_latents, int(height) // self.vae_scale_factor_spatial, int(width) // self.vae_scale_factor_spatial,), device=device)
-        condition_hidden_states = torch.cat([img_emb, padding_tensor], dim=1) 
+        ## only the first frame is conditioned, the zero padding frames contribute nothing to the patch embedding,
+        ## and the embeds broadcast over the CFG copies of the batch
+        condition_embeds = self.transformer.embed_condition(img_emb)
+        return condition_embeds
+
+    @torch.inference_mode()
+    def prepare_sampling_state(
+        self,
+        batch_size: int,
+        num_channels_latents: int,
+        height: int,
+        width: int,
+        num_frames: int,
+        num_inference_steps: int,
+        time_shift: float,
+        motion_score: float,
+        device: Optional[torch.device] = None,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
+        latents: Optional[torch.Tensor] = None,
+        scheduler: Optional[FlowMatchDiscreteScheduler] = None,
+    ):
+        """Sets the timesteps and prepares the initial noise and the timestep embedding table."""
+        scheduler = scheduler or self.scheduler
+        scheduler.set_timesteps(
+            num_inference_steps=num_inference_steps,
+            time_shift=time_shift,
+            device=device
+        )
+        timestep_table = self.transformer.prepare_timestep_embeddings(scheduler.timesteps, motion_score)
+        latents = self.prepare_latents(
+            batch_size,
+            num_channels_latents,
+            height,
+            width,
+            num_frames,
+            torch.bfloat16,
+            device,
+            generator,
+            latents,
+        )
+        return latents, timestep_table
+
+    async def encode_inputs(
+        self,
+        prompt: Union[str, List[str]],
+        first_image,
+        neg_magic: str,
+        pos_magic: str,
+        batch_size: int,
+        height: int,
+        width: int,
+        num_frames: int,
+        session=None,
+    ):
+        """Remote encoding of a request: the caption and vae-encode requests are in flight concurrently."""
+        if session is None:
+            import aiohttp
+            async with aiohttp.ClientSession() as session:
+                return await self.encode_inputs(
+                    prompt, first_image, neg_magic, pos_magic, batch_size, height, width, num_frames, session=session
+                )
+        (prompt_embeds, clip_embedding, prompt_attention_mask), img_emb = await asyncio.gather(
+            self.encode_prompt_async(prompt, neg_magic=neg_magic, pos_magic=pos_magic, session=session),
+            self.encode_first_images(first_image, batch_size, height, width, num_frames, session=session),
+        )
+        return prompt_embeds, clip_embedding, prompt_attention_mask, img_emb
+
+    async def prepare_inputs(
+        self,
+        prompt: Union[str, List[str]],
+        first_image,
+        neg_magic: str,
+        pos_magic: str,
+        batch_size: int,
+        num_videos_per_prompt: int,
+        height: int,
+        width: int,
+        num_frames: int,
+        num_inference_steps: int,
+        time_shift: float,
+        motion_score: float,
+        device: Optional[torch.device] = None,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
+        latents: Optional[torch.Tensor] = None,
+        scheduler: Optional[FlowMatchDiscreteScheduler] = None,
+        encoded_inputs: Optional[Tuple[torch.Tensor, ...]] = None,
+    ):
+        """
+        Conditioning stage of a request: the remote encoding runs while the noise latents and the timestep
+        embeddings are prepared in a worker thread. Given `encoded_inputs` (the outputs of `encode_inputs`),
+        no remote request is made.
+        """
+        ## the current CUDA stream is per thread: the worker uses the stream of the caller, e.g. the side
+        ## stream of a prefetching PipelinedJobRunner
+        stream = torch.cuda.current_stream() if torch.cuda.is_available() else None
+
+        def prepare_sampling_state(*args):
+            with torch.cuda.stream(stream):
+                return self.prepare_sampling_state(*args)
+
+        sampling_state = asyncio.to_thread(
+            prepare_sampling_state,
+            batch_size * num_videos_per_prompt,
+            self.transformer.config.in_channels,
+            height,
+            width,
+            num_frames,
+            num_inference_steps,
+            time_shift,
+            motion_score,
+            device,
+            generator,
+            latents,
+            scheduler,
+        )
+        if encoded_inputs is not None:
+            latents, timestep_table = await sampling_state
+            return (*encoded_inputs, latents, timestep_table)
 
-        condition_hidden_states = condition_hidden_states.repeat(2, 1,1,1,1) ## for CFG
-        return condition_hidden_states.to(dtype)
+        encoded_inputs, (latents, timestep_table) = await asyncio.gather(
+            self.encode_inputs(prompt, first_image, neg_magic, pos_magic, batch_size, height, width, num_frames),
+            sampling_state,
+        )
+        return (*encoded_inputs, latents, timestep_table)
 
     @torch.inference_mode()
     def __call__(
@@ -265,13 +491,19 @@ class StepVideoPipeline(DiffusionPipeline):
         time_shift: float = 13.0,
         neg_magic: str = "",
         pos_magic: str = "",
+        cfg_interval: Optional[Tuple[float, float]] = None,
+        cfg_truncation: float = 1.0,
         num_videos_per_prompt: Optional[int] = 1,
         generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
+        seed: Optional[Union[int, List[int]]] = None,
         latents: Optional[torch.Tensor] = None,
-        first_image: Union[str, PILImage.Image, torch.Tensor] = None,
+        first_image: Union[str, PILImage.Image, torch.Tensor, List[Union[str, PILImage.Image, torch.Tensor]]] = None,
         motion_score: float = 2.0,
+        max_kv_cache_bytes: Optional[int] = None,
+        step_cache: Optional[TeaCache] = None,
+        block_cache: Optional[BlockCache] = None,
         output_type: Optional[str] = "mp4",
-        output_file_name: Optional[str] = "",
+        output_file_name: Optional[Union[str, List[str]]] = "",
         return_dict: bool = True,
     ):
         r"""
@@ -296,21 +528,43 @@ class StepVideoPipeline(DiffusionPipeline):
                 Paper](https://arxiv.org/pdf/2205.11487.pdf). Guidance scale is enabled by setting `guidance_scale >
                 1`. Higher guidance scale encourages to generate images that are closely linked to the text `prompt`,
                 usually at the expense of lower image quality. 
+            cfg_interval (`Tuple[float, float]`, *optional*):
+                Only apply classifier-free guidance on steps that start at a timestep in `[low, high]`. The remaining
+                steps run the transformer on the conditional branch only. Both evaluations of a two-stage solver
+                step share the decision.
+            cfg_truncation (`float`, defaults to `1.0`):
+                Only apply classifier-free guidance on the first `cfg_truncation` fraction of the solver steps.
             num_videos_per_prompt (`int`, *optional*, defaults to 1):
-                The number of images to generate per prompt.
+                The number of videos to generate per prompt. The prompt and the first image are encoded once and
+                shared by all samples of a prompt, which only differ in their initial noise.
             generator (`torch.Generator` or `List[torch.Generator]`, *optional*):
                 A [`torch.Generator`](https://pytorch.org/docs/stable/generated/torch.Generator.html) to make
                 generation deterministic.
+            seed (`int` or `List[int]`, *optional*):
+                Seeds for one generator per sample, used when `generator` is not given. A single seed `s` gives the
+                samples the seeds `s, s+1, ...`.
             latents (`torch.Tensor`, *optional*):
                 Pre-generated noisy latents sampled from a Gaussian distribution, to be used as inputs for image
                 generation. Can be used to tweak the same generation with different prompts. If not provided, a latents
                 tensor is generated by sampling using the supplied random `generator`.
-            first_image (`str`, `PIL.Image`, `torch.Tensor`):
-                A path for the reference image
+            first_image (`str`, `PIL.Image`, `torch.Tensor` or a list of them):
+                A path for the reference image, or one reference image per prompt
+            max_kv_cache_bytes (`int`, *optional*):
+                Memory budget for the cross-attention K/V that are computed once and reused by every denoising
+                step. Blocks that do not fit are recomputed at every step. `None` caches all blocks.
+            step_cache ([`TeaCache`], *optional*):
+                Opt-in policy that skips the transformer blocks on steps whose modulated input barely changed and
+                reuses the residual of the last full evaluation. It is reset for this request and its statistics
+                are returned in `stats["step_cache"]`.
+            block_cache ([`BlockCache`], *optional*):
+                Opt-in partial-compute mode that runs only the first and last blocks on most steps and reuses the
+                cached residual of the middle blocks. Its statistics, including the peak cache memory, are returned
+                in `stats["block_cache"]`.
             output_type (`str`, *optional*, defaults to `"pil"`):
                 The output format of the generated image. Choose between `PIL.Image` or `np.array`.
-            output_file_name(`str`, *optional*`):
-                The output mp4 file name.
+            output_file_name(`str` or `List[str]`, *optional*`):
+                The output mp4 file name, or one file name per sample. A single name gets a `-{index}` suffix
+                per sample when the batch holds more than one video.
             return_dict (`bool`, *optional*, defaults to `True`):
                 Whether or not to return a [`StepVideoPipelineOutput`] instead of a plain tuple.
 
@@ -323,65 +577,225 @@ class StepVideoPipeline(DiffusionPipeline):
                 indicating whether the corresponding generated image contains "not-safe-for-work" (nsfw) content.
         """
 
-        # 1. Check inputs. Raise error if not correct
+        inputs = self.prepare_request(
+            prompt=prompt,
+            first_image=first_image,
+            height=height,
+            width=width,
+            num_frames=num_frames,
+            num_inference_steps=num_inference_steps,
+            time_shift=time_shift,
+            neg_magic=neg_magic,
+            pos_magic=pos_magic,
+            num_videos_per_prompt=num_videos_per_prompt,
+            generator=generator,
+            seed=seed,
+            latents=latents,
+            motion_score=motion_score,
+        )
+        latents, stats = self.denoise(
+            inputs,
+            guidance_scale=guidance_scale,
+            cfg_interval=cfg_interval,
+            cfg_truncation=cfg_truncation,
+            max_kv_cache_bytes=max_kv_cache_bytes,
+            step_cache=step_cache,
+            block_cache=block_cache,
+        )
+
+        if is_sequence_parallel_leader():
+            if not output_type == "latent":
+                video = self.postprocess(
+                    latents,
+                    output_type=output_type,
+                    output_file_name=output_file_name,
+                    batch_size=inputs['batch_size'],
+                    num_videos_per_prompt=num_videos_per_prompt,
+                )
+            else:
+                video = latents
+
+            # Offload all models
+            self.maybe_free_model_hooks()
+
+            if not return_dict:
+                return (video, )
+
+            return StepVideoPipelineOutput(video=video, stats=stats)
+
+    @torch.inference_mode()
+    def prepare_request(
+        self,
+        prompt: Union[str, List[str]] = None,
+        first_image: Union[str, PILImage.Image, torch.Tensor, List[Union[str, PILImage.Image, torch.Tensor]]] = None,
+        height: int = 544,
+        width: int = 992,
+        num_frames: int = 102,
+        num_inference_steps: int = 50,
+        time_shift: float = 13.0,
+        neg_magic: str = "",
+        pos_magic: str = "",
+        num_videos_per_prompt: int = 1,
+        generator: Optional[Union[torch.Generator, List[torch.Generator]]] = None,
+        seed: Optional[Union[int, List[int]]] = None,
+        latents: Optional[torch.Tensor] = None,
+        motion_score: float = 2.0,
+        scheduler: Optional[FlowMatchDiscreteScheduler] = None,
+        encoded_inputs: Optional[Tuple[torch.Tensor, ...]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Conditioning stage of [`StepVideoPipeline.__call__`]: remote prompt and first-image encoding, timesteps and
+        initial noise. With its own `scheduler`, it can run for the next request while the current one denoises.
+        `encoded_inputs` skips the remote encoding, e.g. on ranks that received it from rank 0.
+        """
         device = self._execution_device
 
-        # 2. Define call parameters
         if prompt is not None and isinstance(prompt, str):
             batch_size = 1
         elif prompt is not None and isinstance(prompt, list):
             batch_size = len(prompt)
         else:
-            batch_size = prompt_embeds.shape[0]
+            raise ValueError("`prompt` should be a string or a list of strings.")
+
+        if generator is None and seed is not None:
+            seeds = [seed + i for i in range(batch_size * num_videos_per_prompt)] if isinstance(seed, int) else seed
+            generator = [torch.Generator(device=device).manual_seed(s) for s in seeds]
+        scheduler = scheduler or self.scheduler
+        conditioning_start = time.perf_counter()
+        prompt_embeds, prompt_embeds_2, prompt_attention_mask, img_emb, latents, timestep_table = asyncio.run(
+            self.prepare_inputs(
+                prompt,
+                first_image,
+                neg_magic,
+                pos_magic,
+                batch_size,
+                num_videos_per_prompt,
+                height,
+                width,
+                num_frames,
+                num_inference_steps,
+                time_shift,
+                motion_score,
+                device,
+                generator,
+                latents,
+                scheduler,
+                encoded_inputs,
+            )
+        )
+        return {
+            'prompt_embeds': prompt_embeds,
+            'prompt_embeds_2': prompt_embeds_2,
+            'prompt_attention_mask': prompt_attention_mask,
+            'img_emb': img_emb,
+            'latents': latents,
+            'timestep_table': timestep_table,
+            'scheduler': scheduler,
+            'motion_score': motion_score,
+            'batch_size': batch_size,
+            'num_videos_per_prompt': num_videos_per_prompt,
+            'conditioning_time': time.perf_counter() - conditioning_start,
+        }
 
+    @torch.inference_mode()
+    def denoise(
+        self,
+        inputs: Dict[str, Any],
+        guidance_scale: float = 9.0,
+        cfg_interval: Optional[Tuple[float, float]] = None,
+        cfg_truncation: float = 1.0,
+        max_kv_cache_bytes: Optional[int] = None,
+        step_cache: Optional[TeaCache] = None,
+        block_cache: Optional[BlockCache] = None,
+        callback: Optional[Callable[[int, int], None]] = None,
+    ):
+        """
+        Denoising stage of [`StepVideoPipeline.__call__`] on the outputs of `prepare_request`. `callback` is called
+        with the number of finished steps and the total number of steps after every step.
+        """
+        device = self._execution_device
+        scheduler = inputs['scheduler']
+        latents = inputs['latents']
+        timestep_table = inputs['timestep_table']
+        motion_score = inputs['motion_score']
+        num_videos_per_prompt = inputs['num_videos_per_prompt']
         do_classifier_free_guidance = guidance_scale > 1.0
 
-        # 3. Encode input prompt
-        prompt_embeds, prompt_embeds_2, prompt_attention_mask = self.encode_prompt(
-            prompt=prompt,
-            neg_magic=neg_magic,
-            pos_magic=pos_magic,
-        )
+        # Select the steps that run both CFG branches. Guidance is decided per solver step, from the timestep the
+        # step starts at, so both evaluations of a two-stage (heun, midpoint) step agree
+        timesteps = scheduler.timesteps.tolist()
+        step_start_timesteps = scheduler.sigmas[:-1].tolist()
+        guided_steps = [
+            do_classifier_free_guidance
+            and j < cfg_truncation * len(step_start_timesteps)
+            and (cfg_interval is None or cfg_interval[0] <= t <= cfg_interval[1])
+            for j, t in enumerate(step_start_timesteps)
+        ]
+        ## one entry per model evaluation
+        cfg_steps = [guided_steps[j] for j in scheduler.solver_step_indices()]
+        ## with cfg parallelism, each branch runs on its own group and only the noise predictions are exchanged
+        cfg_parallel = do_classifier_free_guidance and get_cfg_parallel_world_size() == 2
+        cfg_rank = get_cfg_parallel_rank() if cfg_parallel else 0
 
         transformer_dtype = self.transformer.dtype
-        prompt_embeds = prompt_embeds.to(transformer_dtype)
-        prompt_attention_mask = prompt_attention_mask.to(transformer_dtype)
-        prompt_embeds_2 = prompt_embeds_2.to(transformer_dtype)
-
-        # 4. Prepare timesteps
-        self.scheduler.set_timesteps(
-            num_inference_steps=num_inference_steps,
-            time_shift=time_shift,
-            device=device
+        prompt_embeds = inputs['prompt_embeds'].to(device=device, dtype=transformer_dtype)
+        prompt_attention_mask = inputs['prompt_attention_mask'].to(device=device, dtype=transformer_dtype)
+        prompt_embeds_2 = inputs['prompt_embeds_2'].to(device=device, dtype=transformer_dtype)
+        num_prompts = len(prompt_embeds)//2
+        if cfg_parallel:
+            ## each group only conditions on its half of the [prompt, neg_magic] batch; steps without guidance
+            ## run on the conditional group alone
+            rows = slice(cfg_rank * num_prompts, (cfg_rank + 1) * num_prompts)
+            prompt_embeds, prompt_attention_mask, prompt_embeds_2 = (
+                x[rows] for x in (prompt_embeds, prompt_attention_mask, prompt_embeds_2)
+            )
+        conditioning = self.transformer.prepare_conditioning(
+            prompt_embeds,
+            prompt_attention_mask,
+            prompt_embeds_2,
+            max_kv_cache_bytes=max_kv_cache_bytes,
         )
+        ## the conditional half of the [prompt, neg_magic] conditioning, for steps without guidance
+        cond_conditioning = conditioning.select_batch(slice(0, num_prompts))
 
-        # 5. Prepare latent variables
-        num_channels_latents = self.transformer.config.in_channels
-        latents = self.prepare_latents(
-            batch_size * num_videos_per_prompt,
-            num_channels_latents,
-            height,
-            width,
-            num_frames,
-            torch.bfloat16,
-            device,
-            generator,
-            latents,
-        )
-        condition_hidden_states = self.prepare_condition_hidden_states(
-            first_image, 
-            batch_size * num_videos_per_prompt,
-            num_channels_latents,
-            height,
-            width,
-            num_frames,
+        condition_embeds = self.prepare_condition_hidden_states(
+            batch_size=inputs['batch_size'],
             dtype=torch.bfloat16,
-            device=device)
-
-        # 7. Denoising loop
-        with self.progress_bar(total=num_inference_steps) as progress_bar:
-            for i, t in enumerate(self.scheduler.timesteps):
-                latent_model_input = torch.cat([latents] * 2) if do_classifier_free_guidance else latents
+            device=device,
+            img_emb=inputs['img_emb'])
+        if num_videos_per_prompt > 1:
+            ## a view shared by the samples of each prompt: (b, fc, l, d) -> (b, n, fc, l, d)
+            condition_embeds = condition_embeds.unsqueeze(1).expand(-1, num_videos_per_prompt, *condition_embeds.shape[1:])
+
+        ## the unconditional group only runs the steps with guidance
+        run_steps = cfg_steps if cfg_parallel and cfg_rank == 1 else [True] * len(cfg_steps)
+        if step_cache is not None:
+            step_cache.reset(num_steps=sum(run_steps))
+        if block_cache is not None:
+            block_cache.reset()
+
+        # Denoising loop
+        with self.progress_bar(total=len(scheduler.timesteps)) as progress_bar:
+            for i, t in enumerate(scheduler.timesteps):
+                use_cfg = cfg_steps[i]
+                if not run_steps[i]:
+                    ## the conditional prediction of the conditional group, so the latents stay identical
+                    noise_pred = get_cfg_group().broadcast(
+                        torch.empty(latents.shape, dtype=transformer_dtype, device=latents.device), src=0
+                    )
+                    latents = scheduler.step(model_output=noise_pred, timestep=t, sample=latents)
+                    progress_bar.update()
+                    if callback is not None:
+                        callback(i + 1, len(timesteps))
+                    continue
+                if cfg_parallel and cfg_rank == 1 and i > 0 and not run_steps[i - 1]:
+                    ## residuals from before the steps without guidance are stale
+                    if step_cache is not None:
+                        step_cache.invalidate()
+                    if block_cache is not None:
+                        block_cache.invalidate()
+
+                latent_model_input = torch.cat([latents] * 2) if use_cfg and not cfg_parallel else latents
                 latent_model_input = latent_model_input.to(transformer_dtype)
                 # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
                 timestep = t.expand(latent_model_input.shape[0]).to(latent_model_input.dtype)
@@ -389,41 +803,80 @@ class StepVideoPipeline(DiffusionPipeline):
                 noise_pred = self.transformer(
                     hidden_states=latent_model_input,
                     timestep=timestep,
-                    encoder_hidden_states=prompt_embeds,
-                    encoder_attention_mask=prompt_attention_mask,
-                    encoder_hidden_states_2=prompt_embeds_2,
-                    condition_hidden_states=condition_hidden_states,
+                    condition_embeds=condition_embeds,
                     motion_score=motion_score,
+                    conditioning=conditioning if use_cfg else cond_conditioning,
+                    timestep_embeds=timestep_table[i],
+                    step_cache=step_cache,
+                    block_cache=block_cache,
                     return_dict=False,
                 )
+                if cfg_parallel and use_cfg:
+                    ## (cond, uncond) predictions of the two groups
+                    noise_pred_text, noise_pred_uncond = get_cfg_group().all_gather(noise_pred.contiguous()[None], dim=0)
+                elif cfg_parallel:
+                    get_cfg_group().broadcast(noise_pred.contiguous(), src=0)
                 # perform guidance
-                if do_classifier_free_guidance:
-                    noise_pred_text, noise_pred_uncond = noise_pred.chunk(2)
+                if use_cfg:
+                    if not cfg_parallel:
+                        noise_pred_text, noise_pred_uncond = noise_pred.chunk(2)
                     noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
 
                 # compute the previous noisy sample x_t -> x_t-1
-                latents = self.scheduler.step(
+                latents = scheduler.step(
                     model_output=noise_pred,
                     timestep=t,
                     sample=latents
                 )
                 
                 progress_bar.update()
-
-        if not torch.distributed.is_initialized() or int(torch.distributed.get_rank())==0:
-            if not output_type == "latent":
-                video = self.decode_vae(latents)
-                video = self.video_processor.postprocess_video(video, output_file_name=output_file_name, output_type=output_type)
-            else:
-                video = latents
-
-            # Offload all models
-            self.maybe_free_model_hooks()
-
-            if not return_dict:
-                return (video, )
-
-            return StepVideoPipelineOutput(video=video)
-        
-
-        
\ No newline at end of file
+                if callback is not None:
+                    callback(i + 1, len(timesteps))
+
+        stats = {
+            'num_steps': len(guided_steps),
+            'num_cfg_steps': sum(guided_steps),
+            'num_model_evaluations': len(cfg_steps),
+            'cfg_parallel': cfg_parallel,
+            'kv_cache': conditioning.memory_stats(),
+            'conditioning_time': inputs['conditioning_time'],
+        }
+        if self.prompt_cache is not None:
+            stats['prompt_cache'] = self.prompt_cache.stats()
+        if self.latent_cache is not None:
+            stats['latent_cache'] = self.latent_cache.stats()
+        del conditioning, cond_conditioning
+        if step_cache is not None:
+            stats['step_cache'] = step_cache.stats()
+            step_cache.reset()
+        if block_cache is not None:
+            stats['block_cache'] = block_cache.stats()
+            block_cache.reset()
+        return latents, stats
+
+    def postprocess(
+        self,
+        latents: torch.Tensor,
+        output_type: str = "mp4",
+        output_file_name: Optional[Union[str, List[str]]] = "",
+        batch_size: int = 1,
+        num_videos_per_prompt: int = 1,
+    ):
+        """Decoding stage of [`StepVideoPipeline.__call__`]: remote vae decode and one output file per sample."""
+        ## one vae-decode request for the whole batch, one output file per sample
+        videos = self.decode_vae(latents)
+        if isinstance(output_file_name, str):
+            output_file_name = [output_file_name] if len(videos) == 1 else [
+                f"{output_file_name}-{i}" for i in range(len(videos))
+            ]
+        elif len(output_file_name) == batch_size and num_videos_per_prompt > 1:
+            output_file_name = [
+                f"{name}-{j}" for name in output_file_name for j in range(num_videos_per_prompt)
+            ]
+        video = [
+            self.video_processor.postprocess_video(v[None], output_file_name=name, output_type=output_type)
+            for v, name in zip(videos, output_file_name)
+        ]
+        if len(video) == 1:
+            video = video[0]
+        return video
@@ -1,6 +1,8 @@
+import time
 import torch
 import torch.nn as nn
 from einops import rearrange
+from stepvideo.parallel import get_sp_group, get_sp_group_override, get_native_parallel_state
 
 try:
     from xfuser.core.long_ctx_attention import xFuserLongContextAttention
@@ -16,7 +18,7 @@ class Attention(nn.Module):
         if attn_type == 'torch':
             return self.torch_attn_func
         elif attn_type == 'parallel':
-            return self.parallel_attn_func
+            return SequenceParallelAttention(self.torch_attn_func)
         else:
             raise Exception('Not supported attention type...')
 
@@ -34,29 +36,269 @@ class Attention(nn.Module):
         if attn_mask is not None and attn_mask.dtype != torch.bool:
             attn_mask = attn_mask.to(q.dtype)
             
-        if attn_mask is not None and attn_mask.ndim == 3:   ## no head
-            n_heads = q.shape[2]
-            attn_mask = attn_mask.unsqueeze(1).repeat(1, n_heads, 1, 1)
+        if attn_mask is not None and attn_mask.ndim == 2:   ## key padding only, (b, kv)
+            attn_mask = attn_mask[:, None, None]
+        elif attn_mask is not None and attn_mask.ndim == 3:   ## no head, broadcast instead of repeating
+            attn_mask = attn_mask.unsqueeze(1)
         
         q, k, v = map(lambda x: rearrange(x, 'b s h d -> b h s d'), (q, k, v))
         x = torch.nn.functional.scaled_dot_product_attention(
             q, k, v, attn_mask=attn_mask, dropout_p=drop_rate, is_causal=causal
         )
         x = rearrange(x, 'b h s d -> b s h d')
-        return x        
+        return x
 
-    def parallel_attn_func(
-        self,
-        q,
-        k,
-        v,
-        causal=False,
-        **kwargs
-    ):
-        assert xFuserLongContextAttention is not None; 'to use sequence parallel attention, xFuserLongContextAttention should be imported...'
-        hybrid_seq_parallel_attn = xFuserLongContextAttention()
-        x = hybrid_seq_parallel_attn(
-            None, q,k,v, causal=causal
+
+def _attention_with_lse_chunked(q, k, v, key_mask=None, query_chunk_size=1024):
+    ## float32 scores of `query_chunk_size` queries at a time, instead of the whole (b, h, s_q, s_k) matrix
+    xs, lses = [], []
+    for q_chunk in q.split(query_chunk_size, dim=1):
+        scores = torch.einsum('bqhd,bkhd->bhqk', q_chunk.float(), k.float()) * q.shape[-1]**-0.5
+        if key_mask is not None:
+            scores = scores.masked_fill(~key_mask[:, None, None, :], float('-inf'))
+        lse = torch.logsumexp(scores, dim=-1)
+        xs.append(torch.einsum('bhqk,bkhd->bqhd', torch.exp(scores - lse[..., None]).nan_to_num(0.0), v.float()))
+        lses.append(rearrange(lse, 'b h q -> b q h')[..., None])
+    return torch.cat(xs, dim=1), torch.cat(lses, dim=1)
+
+
+def attention_with_lse(q, k, v, key_mask=None, query_chunk_size=1024):
+    """
+    Full attention in (b, s, h, d) layout, returning the output and its log-sum-exp in (b, s, h, 1) in float32.
+    Keys outside the optional `key_mask` in shape (1 or b, s_kv) are ignored; queries without any valid key
+    get a zero output and a log-sum-exp of -inf.
+
+    On CUDA, the fused memory-efficient SDPA kernel computes the log-sum-exp along with the output. Otherwise
+    the queries are processed in chunks of `query_chunk_size`.
+    """
+    if key_mask is not None and key_mask.shape[0] == 1:
+        ## the padding mask is shared by the batch: drop the padded keys instead of masking them
+        valid = key_mask[0].nonzero().squeeze(-1)
+        if valid.numel() == 0:
+            return (
+                q.new_zeros(q.shape, dtype=torch.float32),
+                q.new_full((*q.shape[:3], 1), float('-inf'), dtype=torch.float32),
+            )
+        if valid.numel() < k.shape[1]:
+            k, v = k.index_select(1, valid), v.index_select(1, valid)
+        key_mask = None
+
+    if key_mask is None and q.is_cuda:
+        x, lse = torch.ops.aten._scaled_dot_product_efficient_attention(
+            *(rearrange(t, 'b s h d -> b h s d') for t in (q, k, v)), None, True
+        )[:2]
+        ## the kernel pads the log-sum-exp of the queries to its block size
+        lse = lse[..., :q.shape[1]]
+        return rearrange(x, 'b h s d -> b s h d').float(), rearrange(lse, 'b h q -> b q h')[..., None].float()
+    return _attention_with_lse_chunked(q, k, v, key_mask, query_chunk_size)
+
+
+def ring_attention(q, k, v, ring_group, causal=False, key_mask=None):
+    """
+    Attention of the local queries over the keys/values of every rank of `ring_group`: k/v chunks travel
+    around the ring, the transfer of the next chunk overlaps the attention on the current one, and the
+    partial outputs are merged with their log-sum-exp. A `key_mask` of the local keys travels with them.
+    """
+    assert not causal; 'ring attention only supports full attention...'
+    if key_mask is not None:
+        key_mask = key_mask.to(k.dtype)   ## sent as floats like k and v
+    x, lse = None, None
+    for step in range(ring_group.world_size):
+        if step < ring_group.world_size - 1:
+            (next_k, next_v, *next_mask), requests = ring_group.send_recv_next(
+                [k, v] if key_mask is None else [k, v, key_mask]
+            )
+        block_x, block_lse = attention_with_lse(q, k, v, key_mask > 0 if key_mask is not None else None)
+        if x is None:
+            x, lse = block_x, block_lse
+        else:
+            new_lse = torch.logaddexp(lse, block_lse)
+            ## chunks made only of padding have a log-sum-exp of -inf and no weight
+            x = x * torch.exp(lse - new_lse).nan_to_num(0.0) + block_x * torch.exp(block_lse - new_lse).nan_to_num(0.0)
+            lse = new_lse
+        if step < ring_group.world_size - 1:
+            for request in requests:
+                request.wait()
+            k, v = next_k, next_v
+            key_mask = next_mask[0] if key_mask is not None else None
+    return x.to(q.dtype)
+
+
+class AttentionTimer:
+    r"""
+    Per-call timing of a sequence parallel attention: the total time of the call and the time spent waiting
+    for the ulysses all-to-alls, i.e. the communication that is not hidden behind compute. On CUDA the times
+    are taken with events on the compute stream and only resolved in `stats`, so recording does not
+    synchronize.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.current = None
+
+    @staticmethod
+    def now(device):
+        if device.type == 'cuda':
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    @staticmethod
+    def elapsed_ms(start, end):
+        if isinstance(start, float):
+            return (end - start) * 1000
+        return start.elapsed_time(end)
+
+    def start(self, device):
+        self.device = device
+        self.current = (self.now(device), [])
+
+    def wait(self, pending):
+        wait_start = self.now(self.device)
+        output = pending.wait()
+        self.current[1].append((wait_start, self.now(self.device)))
+        return output
+
+    def stop(self):
+        start, waits = self.current
+        self.calls.append((start, self.now(self.device), waits))
+        self.current = None
+
+    def reset(self):
+        self.calls = []
+
+    def stats(self):
+        if len(self.calls) > 0 and self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+        totals = [self.elapsed_ms(start, end) for start, end, _ in self.calls]
+        waits = [sum(self.elapsed_ms(a, b) for a, b in call_waits) for _, _, call_waits in self.calls]
+        num_calls = max(len(self.calls), 1)
+        return {
+            'num_calls': len(self.calls),
+            'total_ms': sum(totals) / num_calls,
+            'exposed_comm_ms': sum(waits) / num_calls,
+            'compute_ms': (sum(totals) - sum(waits)) / num_calls,
+        }
+
+
+class SequenceParallelAttention:
+    r"""
+    Sequence parallel self-attention of one block, created once with the block.
+
+    On a sub-group set by `sequence_parallel_group` or under the native engine, heads are exchanged for
+    sequence with an all-to-all over the ulysses group (`(b, s/n, h, d) -> (b, s, h/n, d)`), the full sequence
+    is attended locally or with ring attention over the ring group, and the result is exchanged back. Both
+    only use torch.distributed, so they also run under gloo on CPU. Otherwise the xfuser hybrid attention is
+    used, built on the first call and reused afterwards.
+
+    With `num_head_groups > 1`, the native path is pipelined over groups of heads (see `pipelined_attn`), so the
+    all-to-alls run while the projections and the attention of the neighbouring groups are computed.
+
+    `qkv_codec` and `out_codec` optionally compress the activations of the native all-to-alls of q/k/v and of the
+    attention output (see `stepvideo.comm_codec`).
+
+    When the sequence does not split evenly, `attn_mask` is the key-padding mask in shape (1, s/n) of the
+    local tokens and is gathered along with the keys. The xfuser attention has no mask, so padded sequences
+    attend the local queries over the keys gathered from the whole sequence parallel group instead.
+    """
+
+    def __init__(self, local_attn):
+        self.local_attn = local_attn
+        self.xfuser_attn = None
+        self.num_head_groups = 1
+        self.timer = None
+        self.qkv_codec = None
+        self.out_codec = None
+
+    @staticmethod
+    def native_groups():
+        """`(ulysses_group, ring_group)` of the native path, or `None` under xfuser."""
+        override = get_sp_group_override()
+        if override is not None:
+            return override, None
+        state = get_native_parallel_state()
+        if state is not None:
+            return state.ulysses_group, state.ring_group
+        return None
+
+    def can_pipeline(self, num_heads):
+        groups = self.native_groups()
+        return (
+            self.num_head_groups > 1
+            and groups is not None
+            and num_heads % self.num_head_groups == 0
+            and (num_heads // self.num_head_groups) % groups[0].world_size == 0
         )
-        return x
 
+    def __call__(self, q, k, v, causal=False, attn_mask=None, **kwargs):
+        groups = self.native_groups()
+        if groups is not None:
+            return self.ulysses_ring_attn(q, k, v, *groups, causal=causal, key_mask=attn_mask)
+
+        if attn_mask is not None:
+            return self.gathered_attn(q, k, v, get_sp_group(), causal=causal, key_mask=attn_mask)
+        if self.xfuser_attn is None:
+            assert xFuserLongContextAttention is not None; 'to use sequence parallel attention, xFuserLongContextAttention should be imported...'
+            self.xfuser_attn = xFuserLongContextAttention()
+        return self.xfuser_attn(None, q, k, v, causal=causal)
+
+    def wait(self, pending):
+        return self.timer.wait(pending) if self.timer is not None else pending.wait()
+
+    @staticmethod
+    def gather_key_mask(key_mask, group):
+        ## masks travel as floats, bool collectives are not supported by every backend
+        return group.all_gather(key_mask.float(), dim=-1) > 0
+
+    def gathered_attn(self, q, k, v, sp_group, causal=False, key_mask=None):
+        k, v = (sp_group.all_gather(x.contiguous(), dim=1) for x in (k, v))
+        return self.local_attn(q, k, v, attn_mask=self.gather_key_mask(key_mask, sp_group), causal=causal)
+
+    def attend(self, q, k, v, ring_group=None, causal=False, key_mask=None):
+        if ring_group is None or ring_group.world_size == 1:
+            return self.local_attn(q, k, v, attn_mask=key_mask, causal=causal)
+        return ring_attention(q, k, v, ring_group, causal=causal, key_mask=key_mask)
+
+    def ulysses_ring_attn(self, q, k, v, ulysses_group, ring_group=None, causal=False, key_mask=None):
+        q, k, v = [ulysses_group.all_to_all_async(x, scatter_dim=2, gather_dim=1, codec=self.qkv_codec) for x in (q, k, v)]
+        q, k, v = (self.wait(x) for x in (q, k, v))
+        if key_mask is not None:
+            key_mask = self.gather_key_mask(key_mask, ulysses_group)
+        x = self.attend(q, k, v, ring_group, causal=causal, key_mask=key_mask)
+        return self.wait(ulysses_group.all_to_all_async(x, scatter_dim=1, gather_dim=2, codec=self.out_codec))
+
+    def pipelined_attn(self, project_qkv, project_out, num_heads, causal=False, attn_mask=None):
+        """
+        Self-attention including its projections, pipelined over `num_head_groups` groups of heads:
+        `project_qkv(heads)` returns the local `(q, k, v)` of the heads in the slice `heads`, and
+        `project_out(x, heads)` their contribution to the output projection.
+
+        The q/k/v all-to-all of group i+1 is started before the attention of group i, so it runs during that
+        attention, and the output all-to-all of group i runs during the output projection of group i-1 and
+        the attention of group i+1.
+        """
+        ulysses_group, ring_group = self.native_groups()
+        heads_per_group = num_heads // self.num_head_groups
+        head_groups = [slice(i, i + heads_per_group) for i in range(0, num_heads, heads_per_group)]
+
+        def send(heads):
+            return [ulysses_group.all_to_all_async(x, scatter_dim=2, gather_dim=1, codec=self.qkv_codec) for x in project_qkv(heads)]
+
+        def receive(output, heads, pending):
+            x = project_out(self.wait(pending), heads)
+            return x if output is None else output + x
+
+        key_mask = self.gather_key_mask(attn_mask, ulysses_group) if attn_mask is not None else None
+        output = None
+        sent = send(head_groups[0])
+        received = []
+        for i, heads in enumerate(head_groups):
+            next_sent = send(head_groups[i + 1]) if i + 1 < len(head_groups) else None
+            q, k, v = (self.wait(x) for x in sent)
+            x = self.attend(q, k, v, ring_group, causal=causal, key_mask=key_mask)
+            received.append((heads, ulysses_group.all_to_all_async(x, scatter_dim=1, gather_dim=2, codec=self.out_codec)))
+            if len(received) > 1:
+                output = receive(output, *received.pop(0))
+            sent = next_sent
+        return receive(output, *received.pop(0))
@@ -44,7 +44,56 @@ class SelfAttention(Attention):
     def apply_rope3d(self, x, fhw_positions, rope_ch_split, parallel=True):
         x = self.rope_3d(x, fhw_positions, rope_ch_split, parallel)
         return x
+
+    def apply_qk_norm_rope3d(self, xqkv, fhw_positions, rope_ch_split, parallel=True):
+        """
+        Fused q/k RMSNorm + RoPE3D on the packed (..., n_heads, 3*head_dim) projection: q and k are
+        normalized and rotated together as one (..., n_heads, 2, head_dim) view.
+        """
+        xqk = xqkv[..., :2*self.head_dim].unflatten(-1, (2, self.head_dim))
+        
+        weight = torch.stack([self.q_norm.weight, self.k_norm.weight])
+        xqk = self.q_norm._norm(xqk.float()).type_as(xqk) * weight
+
+        cos, sin, perm = self.rope_3d.get_rope_table(fhw_positions, rope_ch_split, xqk.device, xqk.dtype, parallel)
+        xqk = self.rope_3d.apply_rope_table(xqk, cos[:, :, None], sin[:, :, None], perm)
+        return xqk[..., 0, :], xqk[..., 1, :]
+        
+    def project_qkv(self, x, rope_positions=None, heads: slice = None):
+        """q, k, v in shape (b, s, h, d) of the heads in the slice `heads` (all heads if `None`)."""
+        if heads is None:
+            xqkv = self.wqkv(x)
+            num_heads = self.n_heads
+        else:
+            rows = slice(heads.start*3*self.head_dim, heads.stop*3*self.head_dim)
+            bias = self.wqkv.bias[rows] if self.wqkv.bias is not None else None
+            xqkv = torch.nn.functional.linear(x, self.wqkv.weight[rows], bias)
+            num_heads = heads.stop - heads.start
+        xqkv = xqkv.view(*x.shape[:-1], num_heads, 3*self.head_dim)
+
+        xq, xk, xv = torch.split(xqkv, [self.head_dim]*3, dim=-1)  ## seq_len, n, dim
+    
+        if self.with_qk_norm and self.with_rope:
+            xq, xk = self.apply_qk_norm_rope3d(xqkv, rope_positions, self.rope_ch_split, parallel=self.parallel)
+        else:
+            if self.with_qk_norm:
+                xq = self.q_norm(xq)
+                xk = self.k_norm(xk)
         
+            if self.with_rope:
+                xq = self.apply_rope3d(xq, rope_positions, self.rope_ch_split, parallel=self.parallel)
+                xk = self.apply_rope3d(xk, rope_positions, self.rope_ch_split, parallel=self.parallel)
+        return xq, xk, xv
+
+    def project_out(self, output, heads: slice = None):
+        """`wo` applied to the attention output in shape (b, s, h, d) of the heads in `heads`, the bias only with the first head."""
+        output = rearrange(output, 'b s h d -> b s (h d)')
+        if heads is None:
+            return self.wo(output)
+        columns = slice(heads.start*self.head_dim, heads.stop*self.head_dim)
+        bias = self.wo.bias if self.wo.bias is not None and heads.start == 0 else None
+        return torch.nn.functional.linear(output, self.wo.weight[:, columns], bias)
+
     def forward(
         self, 
         x,
@@ -53,30 +102,31 @@ class SelfAttention(Attention):
         rope_positions=None,
         attn_mask=None
     ):
-        xqkv = self.wqkv(x) 
-        xqkv = xqkv.view(*x.shape[:-1], self.n_heads, 3*self.head_dim)
+        timer = self.core_attention.timer if self.parallel else None
+        if timer is not None:
+            timer.start(x.device)
 
-        xq, xk, xv = torch.split(xqkv, [self.head_dim]*3, dim=-1)  ## seq_len, n, dim
-    
-        if self.with_qk_norm:
-            xq = self.q_norm(xq)
-            xk = self.k_norm(xk)
-    
-        if self.with_rope:
-            xq = self.apply_rope3d(xq, rope_positions, self.rope_ch_split, parallel=self.parallel)
-            xk = self.apply_rope3d(xk, rope_positions, self.rope_ch_split, parallel=self.parallel)
-            
-        output = self.core_attention(
-                    xq,
-                    xk,
-                    xv,
-                    cu_seqlens=cu_seqlens,
-                    max_seqlen=max_seqlen,
-                    attn_mask=attn_mask
-                )
-        output = rearrange(output, 'b s h d -> b s (h d)')
-        output = self.wo(output)
-        
+        if self.parallel and self.core_attention.can_pipeline(self.n_heads):
+            output = self.core_attention.pipelined_attn(
+                lambda heads: self.project_qkv(x, rope_positions, heads),
+                self.project_out,
+                self.n_heads,
+                attn_mask=attn_mask
+            )
+        else:
+            xq, xk, xv = self.project_qkv(x, rope_positions)
+            output = self.core_attention(
+                        xq,
+                        xk,
+                        xv,
+                        cu_seqlens=cu_seqlens,
+                        max_seqlen=max_seqlen,
+                        attn_mask=attn_mask
+                    )
+            output = self.project_out(output)
+
+        if timer is not None:
+            timer.stop()
         return output
     
     
@@ -97,23 +147,40 @@ class CrossAttention(Attention):
         
         self.core_attention = self.attn_processor(attn_type=attn_type)
 
+    def prepare_kv(self, encoder_hidden_states: torch.Tensor):
+        xkv = self.wkv(encoder_hidden_states)
+        xkv = xkv.view(*xkv.shape[:-1], self.n_heads, 2*self.head_dim)
+
+        xk, xv = torch.split(xkv, [self.head_dim]*2, dim=-1)  ## seq_len, n, dim
+    
+        if self.with_qk_norm:
+            xk = self.k_norm(xk)
+        return xk, xv
+
     def forward(
             self, 
             x: torch.Tensor,
             encoder_hidden_states: torch.Tensor,
-            attn_mask=None
+            attn_mask=None,
+            kv_cache=None
         ):
         xq = self.wq(x) 
         xq = xq.view(*xq.shape[:-1], self.n_heads, self.head_dim)
         
-        xkv = self.wkv(encoder_hidden_states)
-        xkv = xkv.view(*xkv.shape[:-1], self.n_heads, 2*self.head_dim)
-
-        xk, xv = torch.split(xkv, [self.head_dim]*2, dim=-1)  ## seq_len, n, dim
+        if kv_cache is None:
+            xk, xv = self.prepare_kv(encoder_hidden_states)
+        else:
+            xk, xv = kv_cache
     
         if self.with_qk_norm:
             xq = self.q_norm(xq)
-            xk = self.k_norm(xk)
+
+        ## several samples per text condition (e.g. multiple seeds per prompt): fold them into the query
+        ## sequence, so that the shared k/v are attended without being repeated across samples
+        bsz, seqlen = xq.shape[:2]
+        num_samples = bsz // xk.shape[0]
+        if num_samples > 1:
+            xq = xq.reshape(xk.shape[0], num_samples*seqlen, *xq.shape[2:])
 
         output = self.core_attention(
                     xq,
@@ -122,7 +189,7 @@ class CrossAttention(Attention):
                     attn_mask=attn_mask
                 )
         
-        output = rearrange(output, 'b s h d -> b s (h d)')
+        output = rearrange(output, 'b s h d -> b s (h d)').reshape(bsz, seqlen, -1)
         output = self.wo(output)
         
         return output
@@ -243,6 +310,11 @@ class StepVideoTransformerBlock(nn.Module):
 
         self.scale_shift_table = nn.Parameter(torch.randn(6, dim) /dim**0.5)
 
+    def modulated_input(self, q: torch.Tensor, timestep: torch.Tensor):
+        """The timestep-modulated input of the self-attention."""
+        shift_msa, scale_msa = (self.scale_shift_table[None, :2] + timestep.reshape(-1, 6, self.dim)[:, :2]).chunk(2, dim=1)
+        return modulate(self.norm1(q), scale_msa, shift_msa)
+
     @torch.no_grad()
     def forward(
         self,
@@ -251,6 +323,8 @@ class StepVideoTransformerBlock(nn.Module):
         timestep: Optional[torch.LongTensor] =  None,
         attn_mask = None,
         rope_positions: list = None, 
+        kv_cache = None,
+        self_attn_mask = None,
     ) -> torch.Tensor:
         shift_msa, scale_msa, gate_msa, shift_mlp, scale_mlp, gate_mlp = (
             torch.clone(chunk) for chunk in (self.scale_shift_table[None] + timestep.reshape(-1, 6, self.dim)).chunk(6, dim=1)
@@ -260,7 +334,8 @@ class StepVideoTransformerBlock(nn.Module):
 
         attn_q = self.attn1(
             scale_shift_q,
-            rope_positions=rope_positions
+            rope_positions=rope_positions,
+            attn_mask=self_attn_mask
         )
 
         q = gate(attn_q, gate_msa) + q
@@ -268,7 +343,8 @@ class StepVideoTransformerBlock(nn.Module):
         attn_q = self.attn2(
                 q,
                 kv,
-                attn_mask
+                attn_mask,
+                kv_cache=kv_cache
             )
 
         q = attn_q + q
@@ -303,6 +379,27 @@ class PatchEmbed(nn.Module):
             in_channels, embed_dim, kernel_size=(patch_size, patch_size), stride=patch_size, bias=bias
         )
 
+    def project(self, latent, channels: slice = None, with_bias: bool = True):
+        """
+        Applies `proj` restricted to the input `channels`. The projection is linear, so the contributions
+        of disjoint channel groups can be computed separately and summed.
+        """
+        weight = self.proj.weight if channels is None else self.proj.weight[:, channels]
+        bias = self.proj.bias if with_bias else None
+        latent = torch.nn.functional.conv2d(latent, weight, bias, stride=self.proj.stride).to(latent.dtype)
+        if self.flatten:
+            latent = latent.flatten(2).transpose(1, 2)  # BCHW -> BNC
+        return latent
+
+    def project_tokens(self, tokens, channels: slice = None, with_bias: bool = True):
+        """
+        Applies `proj` to already patchified `tokens` in shape (..., c * p * p), so that any subset of the
+        patches can be embedded on its own.
+        """
+        weight = self.proj.weight if channels is None else self.proj.weight[:, channels]
+        bias = self.proj.bias if with_bias else None
+        return torch.nn.functional.linear(tokens, weight.reshape(weight.shape[0], -1), bias).to(tokens.dtype)
+
     def forward(self, latent):
         latent = self.proj(latent).to(latent.dtype)   
         if self.flatten:
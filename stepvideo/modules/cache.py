@@ -0,0 +1,233 @@
+import torch
+from typing import Callable, List, Optional
+
+
+class TeaCache:
+    r"""
+    Step-level transformer output cache for the denoising loop (TeaCache, https://arxiv.org/abs/2411.19108).
+
+    At every step the relative L1 change of the timestep-modulated input of the first transformer block is
+    accumulated since the last full evaluation. While it stays below `threshold`, the transformer blocks are
+    skipped and the residual (blocks output minus blocks input) of the last full evaluation is reused, or
+    linearly extrapolated from the last two full evaluations.
+
+    One instance is a per-request policy: the pipeline calls `reset` before the denoising loop and reads
+    `stats` afterwards. Under sequence parallelism every rank caches only its own shard, and the distance
+    is all-reduced so that all ranks take the same decision.
+
+    Args:
+        threshold (`float`):
+            Accumulated relative L1 distance below which a step is skipped.
+        error_budget (`float`, *optional*):
+            Upper bound for the sum of the accumulated distances of all skipped steps of a request. No more
+            steps are skipped once it is spent.
+        max_skip_steps (`int`, defaults to 3):
+            Maximum number of consecutive skipped steps.
+        mode (`str`, defaults to `"reuse"`):
+            `"reuse"` adds the last residual, `"extrapolate"` extrapolates it from the last two.
+        num_warmup_steps (`int`, defaults to 1):
+            Number of leading steps that are always computed.
+        num_final_steps (`int`, defaults to 1):
+            Number of trailing steps that are always computed.
+        coefficients (`List[float]`, *optional*):
+            Polynomial (highest degree first) rescaling the raw distance, as fitted per model by TeaCache.
+    """
+
+    supported_modes = ["reuse", "extrapolate"]
+
+    def __init__(
+        self,
+        threshold: float = 0.1,
+        error_budget: Optional[float] = None,
+        max_skip_steps: int = 3,
+        mode: str = "reuse",
+        num_warmup_steps: int = 1,
+        num_final_steps: int = 1,
+        coefficients: Optional[List[float]] = None,
+    ):
+        if mode not in self.supported_modes:
+            raise ValueError(f"Mode {mode} not supported. Supported modes: {self.supported_modes}")
+        self.threshold = threshold
+        self.error_budget = error_budget
+        self.max_skip_steps = max_skip_steps
+        self.mode = mode
+        self.num_warmup_steps = num_warmup_steps
+        self.num_final_steps = num_final_steps
+        self.coefficients = coefficients
+        self.reset()
+
+    def reset(self, num_steps: Optional[int] = None):
+        self.num_steps = num_steps
+        self.step = 0
+        self.skip = False
+        self.accumulated_distance = 0.0
+        self.spent_error = 0.0
+        self.num_consecutive_skips = 0
+        self.skipped_steps = []
+        self.previous_input = None
+        self.residuals = []   ## [(step, residual)] of the last full evaluations, newest last
+
+    def invalidate(self):
+        """Drops the cached input and residuals, so the next step is computed, keeping the step count and stats."""
+        self.previous_input = None
+        self.residuals = []
+        self.accumulated_distance = 0.0
+        self.num_consecutive_skips = 0
+
+    def rescale(self, distance: float):
+        if self.coefficients is None:
+            return distance
+        value = 0.0
+        for c in self.coefficients:
+            value = value * distance + c
+        return value
+
+    @torch.no_grad()
+    def update(self, modulated_input: torch.Tensor, all_reduce: Optional[Callable] = None):
+        """
+        Decides whether the current step can be skipped. Must be called exactly once per transformer
+        forward, before the blocks run.
+        """
+        step = self.step
+        self.step += 1
+
+        force_compute = (
+            self.previous_input is None
+            or self.previous_input.shape != modulated_input.shape
+            or step < self.num_warmup_steps
+            or (self.num_steps is not None and step >= self.num_steps - self.num_final_steps)
+            or self.num_consecutive_skips >= self.max_skip_steps
+            or len(self.residuals) == 0
+            or self.residuals[-1][1].shape != modulated_input.shape
+        )
+
+        if self.previous_input is not None and self.previous_input.shape == modulated_input.shape:
+            sums = torch.stack([
+                (modulated_input - self.previous_input).abs().sum().float(),
+                self.previous_input.abs().sum().float(),
+            ])
+            if all_reduce is not None:
+                sums = all_reduce(sums)
+            diff, norm = sums.tolist()
+            self.accumulated_distance += self.rescale(diff / max(norm, 1e-12))
+        self.previous_input = modulated_input
+
+        within_budget = self.error_budget is None or self.spent_error + self.accumulated_distance <= self.error_budget
+        self.skip = not force_compute and self.accumulated_distance < self.threshold and within_budget
+
+        if self.skip:
+            self.spent_error += self.accumulated_distance
+            self.num_consecutive_skips += 1
+            self.skipped_steps.append(step)
+        else:
+            self.accumulated_distance = 0.0
+            self.num_consecutive_skips = 0
+        return self.skip
+
+    def store(self, residual: torch.Tensor):
+        keep = 2 if self.mode == "extrapolate" else 1
+        self.residuals = (self.residuals + [(self.step - 1, residual)])[-keep:]
+
+    def apply(self, hidden_states: torch.Tensor):
+        last_step, residual = self.residuals[-1]
+        if self.mode == "extrapolate" and len(self.residuals) == 2:
+            prev_step, prev_residual = self.residuals[0]
+            ratio = (self.step - 1 - last_step) / (last_step - prev_step)
+            residual = residual + (residual - prev_residual) * ratio
+        return hidden_states + residual
+
+    @property
+    def cached_bytes(self):
+        tensors = [r for _, r in self.residuals]
+        if self.previous_input is not None:
+            tensors.append(self.previous_input)
+        return sum(t.numel() * t.element_size() for t in tensors)
+
+    def stats(self):
+        return {
+            'threshold': self.threshold,
+            'error_budget': self.error_budget,
+            'spent_error': self.spent_error,
+            'mode': self.mode,
+            'num_steps': self.step,
+            'num_computed_steps': self.step - len(self.skipped_steps),
+            'num_skipped_steps': len(self.skipped_steps),
+            'skipped_steps': list(self.skipped_steps),
+            'cached_bytes': self.cached_bytes,
+        }
+
+
+class BlockCache:
+    r"""
+    Block-range residual cache across denoising steps (DeepCache, https://arxiv.org/abs/2312.00858).
+
+    The first `num_head_blocks` and the last `num_tail_blocks` transformer blocks run at every step. The
+    residual of the blocks in between is cached on refresh steps and reused until it is refreshed again
+    every `interval` steps. Under sequence parallelism every rank caches only its own shard.
+
+    Args:
+        num_head_blocks (`int`, defaults to 8):
+            Number of leading blocks computed at every step.
+        num_tail_blocks (`int`, defaults to 8):
+            Number of trailing blocks computed at every step.
+        interval (`int`, defaults to 3):
+            The middle blocks are recomputed every `interval` steps.
+    """
+
+    def __init__(self, num_head_blocks: int = 8, num_tail_blocks: int = 8, interval: int = 3):
+        if interval < 1:
+            raise ValueError(f"interval should be a positive integer, got {interval}")
+        self.num_head_blocks = num_head_blocks
+        self.num_tail_blocks = num_tail_blocks
+        self.interval = interval
+        self.reset()
+
+    def reset(self):
+        self.step = 0
+        self.refresh = True
+        self.residual = None
+        self.num_refreshed_steps = 0
+        self.num_reused_steps = 0
+        self.peak_bytes = 0
+
+    def invalidate(self):
+        """Drops the cached residual, so the next step refreshes it."""
+        self.residual = None
+
+    def cached_range(self, num_blocks: int):
+        return range(self.num_head_blocks, max(num_blocks - self.num_tail_blocks, self.num_head_blocks))
+
+    def update(self, hidden_states: torch.Tensor):
+        """
+        Decides whether the middle blocks are recomputed at this step. Must be called exactly once per
+        transformer forward that runs the blocks.
+        """
+        self.refresh = (
+            self.residual is None
+            or self.residual.shape != hidden_states.shape
+            or self.step % self.interval == 0
+        )
+        if self.refresh:
+            self.residual = None
+            self.num_refreshed_steps += 1
+        else:
+            self.num_reused_steps += 1
+        self.step += 1
+        return self.refresh
+
+    def store(self, residual: torch.Tensor):
+        self.residual = residual
+        self.peak_bytes = max(self.peak_bytes, residual.numel() * residual.element_size())
+
+    def apply(self, hidden_states: torch.Tensor):
+        return hidden_states + self.residual
+
+    def stats(self):
+        return {
+            'num_head_blocks': self.num_head_blocks,
+            'num_tail_blocks': self.num_tail_blocks,
+            'interval': self.interval,
+            'num_refreshed_steps': self.num_refreshed_steps,
+            'num_reused_steps': self.num_reused_steps,
+            'peak_bytes': self.peak_bytes,
+        }
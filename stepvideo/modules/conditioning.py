@@ -0,0 +1,117 @@
+import torch
+from typing import List, Optional, Tuple
+
+
+class ConditioningContext:
+    r"""
+    Per-request text conditioning shared by every denoising step.
+
+    Holds the projected caption/clip embeddings, the key-padding mask and the normalized cross-attention
+    K/V of the first `num_cached_blocks` transformer blocks. Blocks without a cached entry recompute
+    their K/V from `encoder_hidden_states` at every step.
+    """
+
+    def __init__(
+        self,
+        encoder_hidden_states: torch.Tensor,
+        attn_mask: torch.Tensor,
+        kv_cache: Optional[List[Tuple[torch.Tensor, torch.Tensor]]] = None,
+        num_blocks: int = 0,
+    ):
+        self.encoder_hidden_states = encoder_hidden_states
+        self.attn_mask = attn_mask
+        self.kv_cache = kv_cache or []
+        self.num_blocks = num_blocks
+
+    def get_kv(self, block_idx: int):
+        if block_idx < len(self.kv_cache):
+            return self.kv_cache[block_idx]
+        return None
+
+    def select_batch(self, index: slice):
+        """A view of the context restricted to the samples in `index`, e.g. the conditional half of a CFG batch."""
+        return ConditioningContext(
+            self.encoder_hidden_states[index],
+            self.attn_mask[index],
+            [(k[index], v[index]) for k, v in self.kv_cache],
+            num_blocks=self.num_blocks,
+        )
+
+    @staticmethod
+    def _pad_seq(t: torch.Tensor, length: int, dim: int):
+        if t.shape[dim] == length:
+            return t
+        shape = list(t.shape)
+        shape[dim] = length
+        out = t.new_zeros(shape)
+        out.narrow(dim, 0, t.shape[dim]).copy_(t)
+        return out
+
+    @classmethod
+    def cat(cls, contexts: List["ConditioningContext"]):
+        """
+        Concatenates contexts along the batch. Text tokens are right-padded to the longest context and masked
+        out; only the blocks cached by every context stay cached.
+        """
+        max_kv_seqlen = max(c.encoder_hidden_states.shape[1] for c in contexts)
+        num_cached_blocks = min(c.num_cached_blocks for c in contexts)
+        return cls(
+            torch.cat([cls._pad_seq(c.encoder_hidden_states, max_kv_seqlen, 1) for c in contexts]),
+            torch.cat([cls._pad_seq(c.attn_mask, max_kv_seqlen, -1) for c in contexts]),
+            [
+                tuple(torch.cat([cls._pad_seq(c.kv_cache[i][j], max_kv_seqlen, 1) for c in contexts]) for j in range(2))
+                for i in range(num_cached_blocks)
+            ],
+            num_blocks=contexts[0].num_blocks,
+        )
+
+    @property
+    def num_cached_blocks(self):
+        return len(self.kv_cache)
+
+    @staticmethod
+    def _nbytes(t: torch.Tensor):
+        return t.numel() * t.element_size()
+
+    @property
+    def cached_bytes(self):
+        return sum(self._nbytes(k) + self._nbytes(v) for k, v in self.kv_cache)
+
+    @property
+    def bytes_per_block(self):
+        if len(self.kv_cache) > 0:
+            k, v = self.kv_cache[0]
+            return self._nbytes(k) + self._nbytes(v)
+        return 2 * self._nbytes(self.encoder_hidden_states)
+
+    def memory_stats(self):
+        return {
+            'num_blocks': self.num_blocks,
+            'num_cached_blocks': self.num_cached_blocks,
+            'num_recomputed_blocks': self.num_blocks - self.num_cached_blocks,
+            'bytes_per_block': self.bytes_per_block,
+            'cached_bytes': self.cached_bytes,
+            'encoder_bytes': self._nbytes(self.encoder_hidden_states),
+        }
+
+
+class TimestepEmbeddingTable:
+    r"""
+    AdaLN-single outputs `(timestep, embedded_timestep)` for every scheduled timestep of a request.
+
+    Indexing with a step index (or a tensor of per-sample step indices) returns the rows the denoising
+    loop feeds to the transformer instead of re-embedding the timestep and motion score at every step.
+    """
+
+    def __init__(self, timesteps: torch.Tensor, timestep: torch.Tensor, embedded_timestep: torch.Tensor):
+        self.timesteps = timesteps
+        self.timestep = timestep
+        self.embedded_timestep = embedded_timestep
+
+    def __len__(self):
+        return len(self.timesteps)
+
+    def __getitem__(self, index):
+        if isinstance(index, int):
+            index = slice(index, index+1)
+        return self.timestep[index], self.embedded_timestep[index]
@@ -10,15 +10,27 @@
 # The above copyright notice and this permission notice shall be included in all
 # copies or substantial portions of the Software.
 # ==============================================================================
-from typing import Any, Dict, Optional, Union
+from typing import Any, Dict, Optional, Tuple, Union
+from collections import OrderedDict
 import torch
 from torch import nn
 import os
-from einops import rearrange, repeat
+from einops import rearrange
 from stepvideo.modules.blocks import StepVideoTransformerBlock, PatchEmbed
+from stepvideo.modules.attentions import SequenceParallelAttention, AttentionTimer
+from stepvideo.comm_codec import CommCodec
+from stepvideo.modules.conditioning import ConditioningContext, TimestepEmbeddingTable
 
 from stepvideo.utils import with_empty_init
-from stepvideo.parallel import parallel_forward
+from stepvideo.parallel import (
+    get_sp_group,
+    get_sequence_parallel_range,
+    get_sequence_parallel_shard_size,
+    get_sequence_parallel_valid_mask,
+    gather_sequence,
+    shard_sequence,
+)
+from stepvideo.modules.cache import TeaCache, BlockCache
 
 from stepvideo.modules.normalization import (
         PixArtAlphaTextProjection,
@@ -99,25 +111,159 @@ class StepVideoModel(ModelMixin, ConfigMixin):
         )
         
         self.parallel = attention_type=='parallel'
+        
+        self.timestep_embedding_cache = OrderedDict()
+        self.timestep_embedding_cache_size = 8
+        
+        self.gather_codec = None
 
-    def patchfy(self, hidden_states, condition_hidden_states=None):
+    def patchfy(self, hidden_states, condition_hidden_states=None, condition_embeds=None, token_range=None):
+        """
+        Embeds `hidden_states` in shape (b, f, c, h, w) into tokens in shape (b, f*l, d). With `token_range`,
+        only the tokens `[start, end)` of the flattened sequence are embedded, i.e. the shard of this rank.
+        """
         if condition_hidden_states is not None:
             hidden_states = torch.cat([hidden_states, condition_hidden_states], dim=2)
 
-        hidden_states = rearrange(hidden_states, 'b f c h w -> (b f) c h w')
-        hidden_states = self.pos_embed(hidden_states)
+        hidden_states = rearrange(
+            hidden_states, 'b f c (h p) (w q) -> b (f h w) (c p q)', p=self.patch_size, q=self.patch_size
+        )
+        start, end = token_range if token_range is not None else (0, hidden_states.shape[1])
+        hidden_states = hidden_states[:, start:end]
+        if condition_embeds is None:
+            hidden_states = self.pos_embed.project_tokens(hidden_states)
+        else:
+            hidden_states = self.pos_embed.project_tokens(hidden_states, channels=slice(0, self.config.in_channels))
+            ## condition embeds cover the leading frames and broadcast over the (cfg) copies of the batch
+            *batch_dims, num_condition_frames, len_frame, _ = condition_embeds.shape
+            num_condition_tokens = min(end, num_condition_frames * len_frame) - start
+            if num_condition_tokens > 0:
+                condition_embeds = condition_embeds.flatten(-3, -2)[..., start:start + num_condition_tokens, :]
+                shape = hidden_states.shape
+                hidden_states = hidden_states.view(-1, *batch_dims, *shape[1:])
+                hidden_states[..., :num_condition_tokens, :] += condition_embeds
+                hidden_states = hidden_states.view(shape)
         return hidden_states
 
-    def prepare_attn_mask(self, encoder_attention_mask, encoder_hidden_states, q_seqlen):
+    @torch.inference_mode()
+    def embed_condition(self, condition_hidden_states: torch.Tensor):
+        """
+        Computes the condition half of the patch embedding once per request. `condition_hidden_states`
+        in shape (..., f, c, h, w) only needs to hold the leading non-zero condition frames, since zero
+        frames contribute nothing to the (bias-free) condition projection.
+        """
+        *batch_dims, frame, channels, height, width = condition_hidden_states.shape
+        condition_embeds = self.pos_embed.project(
+            condition_hidden_states.reshape(-1, channels, height, width),
+            channels=slice(self.config.in_channels, None),
+            with_bias=False,
+        )
+        return condition_embeds.reshape(*batch_dims, frame, *condition_embeds.shape[1:])
+
+    def set_sequence_parallel_attention(
+        self,
+        num_head_groups: int = 1,
+        record_timings: bool = False,
+        comm_codecs: Optional[Dict[str, Optional[CommCodec]]] = None,
+    ):
+        """
+        Pipelines the native sequence parallel self-attention of every block over `num_head_groups` groups of
+        heads, and optionally records its per-block timings (see `sequence_parallel_attention_timings`).
+        `comm_codecs` compresses the `qkv` and `attn_out` all-to-alls and the output `gather`, see
+        `stepvideo.comm_codec.parse_comm_codecs`.
+        """
+        comm_codecs = comm_codecs or {}
+        self.gather_codec = comm_codecs.get('gather')
+        for block in self.transformer_blocks:
+            attn = block.attn1.core_attention
+            if isinstance(attn, SequenceParallelAttention):
+                attn.num_head_groups = num_head_groups
+                attn.timer = AttentionTimer() if record_timings else None
+                attn.qkv_codec = comm_codecs.get('qkv')
+                attn.out_codec = comm_codecs.get('attn_out')
+
+    def sequence_parallel_attention_timings(self):
+        """Mean total, exposed communication and compute time of the self-attention of every block, in ms."""
+        timings = []
+        for i, block in enumerate(self.transformer_blocks):
+            attn = block.attn1.core_attention
+            if isinstance(attn, SequenceParallelAttention) and attn.timer is not None:
+                timings.append({'block': i, 'num_head_groups': attn.num_head_groups, **attn.timer.stats()})
+        return timings
+
+    @torch.inference_mode()
+    def prepare_timestep_embeddings(self, timesteps: torch.Tensor, motion_score: float = None) -> TimestepEmbeddingTable:
+        """
+        Embeds all scheduled `timesteps` together with `motion_score` in one batch. Tables are kept in a small
+        LRU cache keyed by the schedule, so requests sharing the same steps/time shift/motion score reuse them.
+        """
+        dtype = self.dtype
+        key = (tuple(timesteps.tolist()), motion_score, timesteps.device, dtype)
+        if key in self.timestep_embedding_cache:
+            self.timestep_embedding_cache.move_to_end(key)
+            return self.timestep_embedding_cache[key]
+
+        timesteps = timesteps.to(dtype)
+        if self.use_additional_conditions:
+            added_cond_kwargs = {
+                "motion_score": torch.tensor([motion_score], device=timesteps.device, dtype=dtype).repeat(len(timesteps)),
+            }
+        else:
+            added_cond_kwargs = {}
+        timestep, embedded_timestep = self.adaln_single(
+            timesteps, added_cond_kwargs=added_cond_kwargs
+        )
+        table = TimestepEmbeddingTable(timesteps, timestep, embedded_timestep)
+
+        self.timestep_embedding_cache[key] = table
+        while len(self.timestep_embedding_cache) > self.timestep_embedding_cache_size:
+            self.timestep_embedding_cache.popitem(last=False)
+        return table
+
+    def prepare_attn_mask(self, encoder_attention_mask, encoder_hidden_states):
         kv_seqlens = encoder_attention_mask.sum(dim=1).int()
-        mask = torch.zeros([len(kv_seqlens), q_seqlen, max(kv_seqlens)], dtype=torch.bool, device=encoder_attention_mask.device)
-        encoder_hidden_states = encoder_hidden_states[:,: max(kv_seqlens)]
-        for i, kv_len in enumerate(kv_seqlens):
-            mask[i, :, :kv_len] = 1
-        return encoder_hidden_states, mask
+        max_kv_seqlen = int(kv_seqlens.max())
+        encoder_hidden_states = encoder_hidden_states[:,: max_kv_seqlen]
+        ## key-padding mask in shape (b, 1, 1, kv), broadcast over heads and queries
+        mask = torch.arange(max_kv_seqlen, device=kv_seqlens.device)[None] < kv_seqlens[:, None]
+        return encoder_hidden_states, mask[:, None, None]
+
+    @torch.inference_mode()
+    def prepare_conditioning(
+        self,
+        encoder_hidden_states: torch.Tensor,
+        encoder_attention_mask: torch.Tensor,
+        encoder_hidden_states_2: Optional[torch.Tensor] = None,
+        max_kv_cache_bytes: Optional[int] = None,
+    ) -> ConditioningContext:
+        """
+        Projects the text conditioning once per request and caches the cross-attention K/V of as many
+        blocks as fit into `max_kv_cache_bytes` (all blocks if `None`, none if `0`).
+        """
+        encoder_hidden_states = self.caption_projection(self.caption_norm(encoder_hidden_states))
+        
+        if encoder_hidden_states_2 is not None and hasattr(self, 'clip_projection'):
+            clip_embedding = self.clip_projection(encoder_hidden_states_2)
+            encoder_hidden_states = torch.cat([clip_embedding, encoder_hidden_states], dim=1)
+
+        encoder_hidden_states, attn_mask = self.prepare_attn_mask(encoder_attention_mask, encoder_hidden_states)
+        
+        num_blocks = len(self.transformer_blocks)
+        if max_kv_cache_bytes is None:
+            num_cached_blocks = num_blocks
+        else:
+            ## k and v of one block have the same size as two copies of the projected encoder states
+            bytes_per_block = 2 * encoder_hidden_states.numel() * encoder_hidden_states.element_size()
+            num_cached_blocks = min(num_blocks, max_kv_cache_bytes // bytes_per_block)
+
+        kv_cache = []
+        for block in self.transformer_blocks[:num_cached_blocks]:
+            xk, xv = block.attn2.prepare_kv(encoder_hidden_states)
+            kv_cache.append((xk, xv.contiguous()))
+
+        return ConditioningContext(encoder_hidden_states, attn_mask, kv_cache, num_blocks=num_blocks)
         
         
-    @parallel_forward
     def block_forward(
         self,
         hidden_states,
@@ -125,18 +271,51 @@ class StepVideoModel(ModelMixin, ConfigMixin):
         timestep=None,
         rope_positions=None,
         attn_mask=None,
-        parallel=True
+        parallel=True,
+        conditioning=None,
+        step_cache=None,
+        block_cache=None,
+        valid_mask=None
     ):
+        if step_cache is not None:
+            modulated_input = self.transformer_blocks[0].modulated_input(hidden_states, timestep)
+            if valid_mask is not None:   ## padding tokens must not count towards the step distance
+                modulated_input = modulated_input * valid_mask[..., None]
+            all_reduce = get_sp_group().all_reduce if parallel else None
+            if step_cache.update(modulated_input, all_reduce=all_reduce):
+                return step_cache.apply(hidden_states)
+            blocks_input = hidden_states
+
+        if block_cache is not None:
+            refresh = block_cache.update(hidden_states)
+            cached_blocks = block_cache.cached_range(len(self.transformer_blocks))
 
         for i, block in enumerate(self.transformer_blocks):
+            if block_cache is not None and i in cached_blocks:
+                if i == cached_blocks.start:
+                    if refresh:
+                        cached_blocks_input = hidden_states
+                    else:
+                        hidden_states = block_cache.apply(hidden_states)
+                if not refresh:
+                    continue
+
             hidden_states = block(
                 hidden_states,
                 encoder_hidden_states,
                 timestep=timestep,
                 attn_mask=attn_mask,
-                rope_positions=rope_positions
+                rope_positions=rope_positions,
+                kv_cache=conditioning.get_kv(i) if conditioning is not None else None,
+                self_attn_mask=valid_mask
             )
 
+            if block_cache is not None and refresh and i == cached_blocks.stop - 1:
+                block_cache.store(hidden_states - cached_blocks_input)
+
+        if step_cache is not None:
+            step_cache.store(hidden_states - blocks_input)
+
         return hidden_states
         
 
@@ -151,68 +330,87 @@ class StepVideoModel(ModelMixin, ConfigMixin):
         encoder_attention_mask: Optional[torch.Tensor] = None,
         fps: torch.Tensor=None,
         condition_hidden_states: torch.Tensor = None,
+        condition_embeds: torch.Tensor = None,
         motion_score: torch.Tensor=None,
+        conditioning: Optional[ConditioningContext] = None,
+        timestep_embeds: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        step_cache: Optional[TeaCache] = None,
+        block_cache: Optional[BlockCache] = None,
         return_dict: bool = True,
     ):
         assert hidden_states.ndim==5; "hidden_states's shape should be (bsz, f, ch, h ,w)"
 
         bsz, frame, _, height, width = hidden_states.shape
         height, width = height // self.patch_size, width // self.patch_size
+        
+        ## under sequence parallelism every rank embeds, transforms and projects out only its own tokens,
+        ## zero-padded to the same shard size on every rank and masked out of the self-attention
+        seqlen = frame * height * width
+        token_range = get_sequence_parallel_range(seqlen) if self.parallel else None
+        hidden_states = self.patchfy(hidden_states, condition_hidden_states, condition_embeds, token_range=token_range)
+        valid_mask = None
+        if self.parallel:
+            num_padding = get_sequence_parallel_shard_size(seqlen) - hidden_states.shape[1]
+            if num_padding > 0:
+                hidden_states = torch.nn.functional.pad(hidden_states, (0, 0, 0, num_padding))
+            valid_mask = get_sequence_parallel_valid_mask(seqlen, device=hidden_states.device)
                 
-        hidden_states = self.patchfy(hidden_states, condition_hidden_states) 
-        len_frame = hidden_states.shape[1]
-                
-        if self.use_additional_conditions:
-            added_cond_kwargs = {
-                "motion_score": torch.tensor([motion_score], device=hidden_states.device, dtype=hidden_states.dtype).repeat(bsz),
-            }    
+        if timestep_embeds is not None:
+            ## rows of a precomputed TimestepEmbeddingTable, one per sample or shared by the batch
+            timestep, embedded_timestep = (emb.expand(bsz, -1) for emb in timestep_embeds)
         else:
-            added_cond_kwargs = {}
-        
-        timestep, embedded_timestep = self.adaln_single(
-            timestep, added_cond_kwargs=added_cond_kwargs
-        )
+            if self.use_additional_conditions:
+                added_cond_kwargs = {
+                    ## a scalar motion score, or one per sample
+                    "motion_score": torch.as_tensor(motion_score, device=hidden_states.device, dtype=hidden_states.dtype).reshape(-1).expand(bsz),
+                }    
+            else:
+                added_cond_kwargs = {}
+            
+            timestep, embedded_timestep = self.adaln_single(
+                timestep, added_cond_kwargs=added_cond_kwargs
+            )
 
-        encoder_hidden_states = self.caption_projection(self.caption_norm(encoder_hidden_states))
-        
-        if encoder_hidden_states_2 is not None and hasattr(self, 'clip_projection'):
-            clip_embedding = self.clip_projection(encoder_hidden_states_2)
-            encoder_hidden_states = torch.cat([clip_embedding, encoder_hidden_states], dim=1)
+        if conditioning is None:
+            conditioning = self.prepare_conditioning(
+                encoder_hidden_states, encoder_attention_mask, encoder_hidden_states_2, max_kv_cache_bytes=0
+            )
 
-        hidden_states = rearrange(hidden_states, '(b f) l d->  b (f l) d', b=bsz, f=frame, l=len_frame).contiguous()
-        encoder_hidden_states, attn_mask = self.prepare_attn_mask(encoder_attention_mask, encoder_hidden_states, q_seqlen=frame*len_frame)
+        attn_mask = conditioning.attn_mask
+        if self.parallel and attn_mask is not None and attn_mask.shape[-2] != 1:   ## key-padding masks broadcast over queries
+            attn_mask = shard_sequence(attn_mask, seqlen)
         
         hidden_states = self.block_forward(
             hidden_states,
-            encoder_hidden_states,
+            conditioning.encoder_hidden_states,
             timestep=timestep,
             rope_positions=[frame, height, width],
             attn_mask=attn_mask,
-            parallel=self.parallel
+            parallel=self.parallel,
+            conditioning=conditioning,
+            step_cache=step_cache,
+            block_cache=block_cache,
+            valid_mask=valid_mask
         )
         
-        hidden_states = rearrange(hidden_states, 'b (f l) d -> (b f) l d', b=bsz, f=frame, l=len_frame)
-        
-        embedded_timestep = repeat(embedded_timestep, 'b d -> (b f) d', f=frame).contiguous()
-        
+        ## the modulation is shared by all tokens of a sample
         shift, scale = (self.scale_shift_table[None] + embedded_timestep[:, None]).chunk(2, dim=1)
         hidden_states = self.norm_out(hidden_states)
         # Modulation
         hidden_states = hidden_states * (1 + scale) + shift
         hidden_states = self.proj_out(hidden_states)
+
+        if self.parallel:
+            ## gather the (p * p * out_channels)-channel outputs instead of the inner_dim hidden states
+            hidden_states = gather_sequence(hidden_states, seqlen, codec=self.gather_codec)
         
         # unpatchify
-        hidden_states = hidden_states.reshape(
-            shape=(-1, height, width, self.patch_size, self.patch_size, self.out_channels)
-        )
-        
-        hidden_states = rearrange(hidden_states, 'n h w p q c -> n c h p w q')
-        output = hidden_states.reshape(
-            shape=(-1, self.out_channels, height * self.patch_size, width * self.patch_size)
+        output = rearrange(
+            hidden_states,
+            'b (f h w) (p q c) -> b f c (h p) (w q)',
+            f=frame, h=height, w=width, p=self.patch_size, q=self.patch_size,
         )
 
-        output = rearrange(output, '(b f) c h w -> b f c h w', f=frame)
-
         if return_dict:
             return {'x': output}
         return output
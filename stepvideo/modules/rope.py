@@ -1,5 +1,7 @@
+from collections import OrderedDict
+
 import torch
-from stepvideo.parallel import get_sequence_parallel_world_size, get_sequence_parallel_rank
+from stepvideo.parallel import get_sequence_parallel_world_size, get_sequence_parallel_rank, shard_sequence
 
 
 class RoPE1D:
@@ -48,6 +50,11 @@ class RoPE1D:
 
 
 class RoPE3D(RoPE1D):
+    ## per-token rotary tables, shared by the RoPE3D instances of all transformer blocks; an LRU over the
+    ## most recent resolutions and sequence parallel layouts, as each table spans the full sequence shard
+    table_cache = OrderedDict()
+    table_cache_size = 4
+
     def __init__(self, freq=1e4, F0=1.0, scaling_factor=1.0):
         super(RoPE3D, self).__init__(freq, F0, scaling_factor)
         self.position_cache = {}
@@ -62,6 +69,49 @@ class RoPE3D(RoPE1D):
             self.position_cache[f"{f}-{h}-{w}"] = torch.cartesian_prod(x, y, z).view(1, f*h*w, 3).expand(bsz, -1, 3)
         return self.position_cache[f"{f}-{h}-{w}"]
      
+    def get_rope_table(self, rope_positions, ch_split, device, dtype, parallel=False):
+        """
+        Returns ready-to-apply `(cos, sin, perm)` for the tokens of this sequence-parallel rank, covering
+        the full head dim. `sin` carries the sign of `rotate_half` and `perm` its channel permutation for
+        every split, so RoPE3D becomes `tokens * cos + tokens[..., perm] * sin`.
+        """
+        f, h, w = rope_positions
+        if parallel:
+            rank, world_size = get_sequence_parallel_rank(), get_sequence_parallel_world_size()
+        else:
+            rank, world_size = 0, 1
+
+        key = (f, h, w, rank, world_size, dtype, device, tuple(ch_split), self.base)
+        if key in self.table_cache:
+            self.table_cache.move_to_end(key)
+            return self.table_cache[key]
+
+        mesh_grid = self.get_mesh_3d(rope_positions, bsz=1)[0]
+        ## padding tokens of the last shard get position 0, they are masked out of the attention
+        mesh = (shard_sequence(mesh_grid, f*h*w, dim=0) if parallel else mesh_grid).to(device)
+
+        cos_sin, perm, sign = [], [], []
+        offset = 0
+        for i, D in enumerate(ch_split):
+            cos, sin = self.get_cos_sin(D, int(mesh_grid.max()) + 1, device, dtype)
+            cos_sin.append((cos[mesh[:, i]], sin[mesh[:, i]]))
+            half = D // 2
+            perm.append(torch.cat([torch.arange(half, D), torch.arange(0, half)]) + offset)
+            sign.append(torch.cat([-torch.ones(half), torch.ones(half)]))
+            offset += D
+
+        cos = torch.cat([c for c, _ in cos_sin], dim=-1)[:, None, :]   ## (ntokens, 1, dim), broadcast over heads
+        sin = torch.cat([s for _, s in cos_sin], dim=-1)[:, None, :] * torch.cat(sign).to(device=device, dtype=dtype)
+        table = (cos, sin, torch.cat(perm).to(device))
+        self.table_cache[key] = table
+        while len(self.table_cache) > self.table_cache_size:
+            self.table_cache.popitem(last=False)
+        return table
+
+    @staticmethod
+    def apply_rope_table(tokens, cos, sin, perm):
+        return (tokens * cos) + (tokens[..., perm] * sin)
+
     def __call__(self, tokens, rope_positions, ch_split, parallel=False):
         """
         input:
@@ -72,19 +122,7 @@ class RoPE3D(RoPE1D):
         """
         assert sum(ch_split) == tokens.size(-1); 
 
-        mesh_grid = self.get_mesh_3d(rope_positions, bsz=tokens.shape[0])
-        out = []
-        for i, (D, x) in enumerate(zip(ch_split, torch.split(tokens, ch_split, dim=-1))):
-            cos, sin = self.get_cos_sin(D, int(mesh_grid.max()) + 1, tokens.device, tokens.dtype)
-            
-            if parallel:
-                mesh = torch.chunk(mesh_grid[:, :, i], get_sequence_parallel_world_size(),dim=1)[get_sequence_parallel_rank()].clone()
-            else:
-                mesh = mesh_grid[:, :, i].clone()
-            x = self.apply_rope1d(x, mesh.to(tokens.device), cos, sin)
-            out.append(x)
-            
-        tokens = torch.cat(out, dim=-1)
-        return tokens
+        cos, sin, perm = self.get_rope_table(rope_positions, ch_split, tokens.device, tokens.dtype, parallel)
+        return self.apply_rope_table(tokens, cos, sin, perm)
     
 
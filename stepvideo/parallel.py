@@ -1,46 +1,331 @@
+import contextlib
+import os
 import torch.distributed as dist
-import xfuser
 import torch
 
+from stepvideo.comm_codec import compressed_all_gather
+
+try:
+    import xfuser
+except ImportError:
+    xfuser = None
+
+
+def initialize_parall_group(ring_degree, ulysses_degree, data_parallel_degree=1, engine="xfuser", backend=None, cfg_degree=1):
+    """
+    Initializes data parallel replicas of `ring_degree * ulysses_degree` sequence parallel ranks each. The
+    `"native"` engine only uses torch.distributed and also runs on CPU processes under gloo.
+
+    With `cfg_degree=2`, every replica has two sequence parallel groups, one per classifier free guidance
+    branch, that only exchange their noise predictions.
+    """
+    if cfg_degree not in [1, 2]:
+        raise ValueError(f"cfg_degree should be 1 or 2, got {cfg_degree}")
+    if engine == "xfuser" and xfuser is None:
+        raise ImportError("xfuser is not installed, use the native sequence parallel engine instead.")
+    backend = backend or ("nccl" if torch.cuda.is_available() else "gloo")
+    dist.init_process_group(backend)
+    if backend == "nccl":
+        torch.cuda.set_device(int(os.environ.get("LOCAL_RANK", dist.get_rank())))
+
+    if engine == "native":
+        global _NATIVE_STATE
+        _NATIVE_STATE = NativeParallelState(ring_degree, ulysses_degree, data_parallel_degree, cfg_degree)
+        return
 
-def initialize_parall_group(ring_degree, ulysses_degree):
-    dist.init_process_group("nccl")
     xfuser.core.distributed.init_distributed_environment(
         rank=dist.get_rank(), 
         world_size=dist.get_world_size()
     )
     
+    ## data parallel replicas are independent sequence parallel groups
     xfuser.core.distributed.initialize_model_parallel(
-        sequence_parallel_degree=ulysses_degree,
+        data_parallel_degree=data_parallel_degree,
+        classifier_free_guidance_degree=cfg_degree,
+        sequence_parallel_degree=ring_degree*ulysses_degree,
         ring_degree=ring_degree,
         ulysses_degree=ulysses_degree,
     )
-    torch.cuda.set_device(dist.get_rank())
 
 def get_parallel_group():
+    if _NATIVE_STATE is not None:
+        return _NATIVE_STATE.world_group
     return xfuser.core.distributed.get_world_group()
 
+class SequenceParallelGroup:
+    """
+    A sequence parallel group over a subset of the ranks, built on a plain torch.distributed process group.
+    It provides the collectives of xfuser's group coordinator that are used here, plus `all_to_all`.
+    """
+
+    def __init__(self, ranks, backend=None):
+        self.ranks = list(ranks)
+        self.world_size = len(self.ranks)
+        ## new_group is collective: every rank of the world has to create every group
+        self.device_group = dist.new_group(self.ranks, backend=backend)
+        self.rank_in_group = self.ranks.index(dist.get_rank()) if dist.get_rank() in self.ranks else -1
+
+    def __contains__(self, rank):
+        return rank in self.ranks
+
+    @property
+    def local_rank(self):
+        return int(os.environ.get("LOCAL_RANK", dist.get_rank()))
+
+    @property
+    def next_rank(self):
+        return self.ranks[(self.rank_in_group + 1) % self.world_size]
+
+    @property
+    def prev_rank(self):
+        return self.ranks[(self.rank_in_group - 1) % self.world_size]
+
+    def send_recv_next(self, tensors):
+        """
+        Sends `tensors` to the next rank of the ring and starts receiving the ones of the previous rank. Returns
+        the receive buffers and the pending requests.
+        """
+        recv = [torch.empty_like(t) for t in tensors]
+        ops = [dist.P2POp(dist.isend, t.contiguous(), self.next_rank, group=self.device_group) for t in tensors]
+        ops += [dist.P2POp(dist.irecv, r, self.prev_rank, group=self.device_group) for r in recv]
+        return recv, dist.batch_isend_irecv(ops)
+
+    def all_gather(self, input_: torch.Tensor, dim: int = -1):
+        if self.world_size == 1:
+            return input_
+        outputs = [torch.empty_like(input_) for _ in range(self.world_size)]
+        dist.all_gather(outputs, input_.contiguous(), group=self.device_group)
+        return torch.cat(outputs, dim=dim)
+
+    def broadcast(self, input_: torch.Tensor, src: int = 0):
+        """Broadcasts `input_` in place from the rank at position `src` of the group."""
+        if self.world_size > 1:
+            dist.broadcast(input_, src=self.ranks[src], group=self.device_group)
+        return input_
+
+    def all_reduce(self, input_: torch.Tensor):
+        if self.world_size > 1:
+            dist.all_reduce(input_, group=self.device_group)
+        return input_
+
+    def all_to_all(self, input_: torch.Tensor, scatter_dim: int, gather_dim: int, codec=None):
+        """Scatters `scatter_dim` over the ranks and gathers their chunks along `gather_dim`."""
+        return self.all_to_all_async(input_, scatter_dim, gather_dim, codec=codec).wait()
+
+    def all_to_all_async(self, input_: torch.Tensor, scatter_dim: int, gather_dim: int, codec=None):
+        """
+        Starts `all_to_all` without waiting for it, so that compute can run meanwhile. With a `codec`, every
+        chunk is encoded on its own and the payloads and scales are sent instead of the activations.
+
+        The equal-size chunks are stacked into one buffer and exchanged with `all_to_all_single`, the only
+        all-to-all gloo implements, so the engine also runs on CPU.
+        """
+        if self.world_size == 1:
+            return PendingAllToAll([], [input_], gather_dim)
+        chunks = input_.chunk(self.world_size, dim=scatter_dim)
+        if codec is None:
+            input_buffer = torch.stack(chunks)
+            output_buffer, work = self.all_to_all_single_async(input_buffer)
+            return PendingAllToAll([work], output_buffer.unbind(0), gather_dim, input_buffer)
+
+        payloads, scales = zip(*(codec.encode(t) for t in chunks))
+        payloads, scales = torch.stack(payloads), torch.stack(scales)
+        output_payloads, payload_work = self.all_to_all_single_async(payloads)
+        output_scales, scale_work = self.all_to_all_single_async(scales)
+
+        def decode():
+            return [codec.decode(p, s, input_.dtype) for p, s in zip(output_payloads.unbind(0), output_scales.unbind(0))]
+
+        return PendingAllToAll([payload_work, scale_work], None, gather_dim, (payloads, scales), decode=decode)
+
+    def all_to_all_single_async(self, input_: torch.Tensor):
+        """Sends `input_[i]` to the `i`-th rank of the group; `output[i]` is received from it."""
+        output = torch.empty_like(input_)
+        work = dist.all_to_all_single(output, input_, group=self.device_group, async_op=True)
+        return output, work
+
+
+class PendingAllToAll:
+    """An all-to-all in flight; `wait` returns its output."""
+
+    def __init__(self, works, outputs, gather_dim, inputs=None, decode=None):
+        self.works = works
+        self.outputs = outputs
+        self.gather_dim = gather_dim
+        ## the inputs have to stay alive until the transfer is done
+        self.inputs = inputs
+        self.decode = decode
+
+    def wait(self):
+        for work in self.works:
+            work.wait()
+        self.inputs = None
+        outputs = self.decode() if self.decode is not None else self.outputs
+        if len(outputs) == 1:
+            return outputs[0]
+        return torch.cat(outputs, dim=self.gather_dim)
+
+
+class NativeParallelState:
+    """
+    Process groups of the native engine. A replica is made of `cfg_degree` sequence parallel groups, one per
+    guidance branch. Rank `r` of a branch is at ring position `r // ulysses_degree` and ulysses position
+    `r % ulysses_degree`: ulysses groups are contiguous, ring groups are strided.
+    """
+
+    def __init__(self, ring_degree, ulysses_degree, data_parallel_degree=1, cfg_degree=1):
+        world_size, rank = dist.get_world_size(), dist.get_rank()
+        sp_degree = ring_degree * ulysses_degree
+        replica_size = sp_degree * cfg_degree
+        if world_size != replica_size * data_parallel_degree:
+            raise ValueError(
+                f"world size {world_size} should be ring_degree * ulysses_degree * cfg_degree * data_parallel_degree, "
+                f"got {ring_degree} * {ulysses_degree} * {cfg_degree} * {data_parallel_degree}"
+            )
+        self.ring_degree = ring_degree
+        self.ulysses_degree = ulysses_degree
+        self.world_group = SequenceParallelGroup(range(world_size))
+        self.dp_group = self.cfg_group = None
+        self.sp_group = self.ulysses_group = self.ring_group = None
+        ## every rank creates every group, in the same order
+        for offset in range(replica_size):
+            group = SequenceParallelGroup(range(offset, world_size, replica_size))
+            if rank in group:
+                self.dp_group = group
+        for replica in range(data_parallel_degree):
+            for position in range(sp_degree):
+                base = replica * replica_size + position
+                group = SequenceParallelGroup(range(base, base + replica_size, sp_degree))
+                if rank in group:
+                    self.cfg_group = group
+            for branch in range(cfg_degree):
+                base = replica * replica_size + branch * sp_degree
+                group = SequenceParallelGroup(range(base, base + sp_degree))
+                if rank in group:
+                    self.sp_group = group
+                for ring_idx in range(ring_degree):
+                    group = SequenceParallelGroup(range(base + ring_idx*ulysses_degree, base + (ring_idx+1)*ulysses_degree))
+                    if rank in group:
+                        self.ulysses_group = group
+                for ulysses_idx in range(ulysses_degree):
+                    group = SequenceParallelGroup(range(base + ulysses_idx, base + sp_degree, ulysses_degree))
+                    if rank in group:
+                        self.ring_group = group
+
+
+_NATIVE_STATE = None
+
+## set by `sequence_parallel_group` to run a request on a sub-group instead of the group of initialize_parall_group
+_SP_GROUP_OVERRIDE = None
+
+@contextlib.contextmanager
+def sequence_parallel_group(group: SequenceParallelGroup):
+    global _SP_GROUP_OVERRIDE
+    previous, _SP_GROUP_OVERRIDE = _SP_GROUP_OVERRIDE, group
+    try:
+        yield group
+    finally:
+        _SP_GROUP_OVERRIDE = previous
+
+def get_sp_group_override():
+    return _SP_GROUP_OVERRIDE
+
+def get_native_parallel_state():
+    return _NATIVE_STATE
+
 def get_sequence_parallel_world_size():
+    if _SP_GROUP_OVERRIDE is not None:
+        return _SP_GROUP_OVERRIDE.world_size
+    if _NATIVE_STATE is not None:
+        return _NATIVE_STATE.sp_group.world_size
     return xfuser.core.distributed.parallel_state.get_sequence_parallel_world_size()
 
 def get_sequence_parallel_rank():
+    if _SP_GROUP_OVERRIDE is not None:
+        return _SP_GROUP_OVERRIDE.rank_in_group
+    if _NATIVE_STATE is not None:
+        return _NATIVE_STATE.sp_group.rank_in_group
     return xfuser.core.distributed.parallel_state.get_sequence_parallel_rank()
 
 def get_sp_group():
+    if _SP_GROUP_OVERRIDE is not None:
+        return _SP_GROUP_OVERRIDE
+    if _NATIVE_STATE is not None:
+        return _NATIVE_STATE.sp_group
     return xfuser.core.distributed.parallel_state.get_sp_group()
 
+def get_data_parallel_world_size():
+    if _NATIVE_STATE is not None:
+        return _NATIVE_STATE.dp_group.world_size
+    return xfuser.core.distributed.parallel_state.get_data_parallel_world_size()
+
+def get_data_parallel_rank():
+    if _NATIVE_STATE is not None:
+        return _NATIVE_STATE.dp_group.rank_in_group
+    return xfuser.core.distributed.parallel_state.get_data_parallel_rank()
+
+def get_cfg_parallel_world_size():
+    """Number of guidance branches run by separate groups, 1 on a request sub-group."""
+    if _SP_GROUP_OVERRIDE is not None:
+        return 1
+    if _NATIVE_STATE is not None:
+        return _NATIVE_STATE.cfg_group.world_size
+    return xfuser.core.distributed.parallel_state.get_classifier_free_guidance_world_size()
+
+def get_cfg_parallel_rank():
+    """Guidance branch of this rank, 0 for the conditional and 1 for the unconditional one."""
+    if _SP_GROUP_OVERRIDE is not None:
+        return 0
+    if _NATIVE_STATE is not None:
+        return _NATIVE_STATE.cfg_group.rank_in_group
+    return xfuser.core.distributed.parallel_state.get_classifier_free_guidance_rank()
+
+def get_cfg_group():
+    if _NATIVE_STATE is not None:
+        return _NATIVE_STATE.cfg_group
+    return xfuser.core.distributed.parallel_state.get_cfg_group()
+
+def is_sequence_parallel_leader():
+    ## the rank that talks to the remote vae and writes the outputs of its sequence parallel group
+    return not dist.is_initialized() or (get_sequence_parallel_rank() == 0 and get_cfg_parallel_rank() == 0)
+
+
+
+def get_sequence_parallel_shard_size(seqlen):
+    """
+    Number of tokens of every rank for a sequence of `seqlen` tokens. Sequences that do not split evenly are
+    padded at the end to `world_size * shard_size`, so every rank does the same work.
+    """
+    return -(-seqlen // get_sequence_parallel_world_size())
+
+def get_sequence_parallel_range(seqlen):
+    """Range `[start, end)` of the valid tokens of this rank; the shard holds `shard_size - (end - start)` padding tokens after them."""
+    shard_size = get_sequence_parallel_shard_size(seqlen)
+    start = min(get_sequence_parallel_rank() * shard_size, seqlen)
+    return start, min(start + shard_size, seqlen)
+
+def get_sequence_parallel_valid_mask(seqlen, device=None):
+    """
+    Key-padding mask in shape (1, shard_size) of the tokens of this rank, or `None` if the sequence splits
+    evenly and no rank holds padding.
+    """
+    if seqlen % get_sequence_parallel_world_size() == 0:
+        return None
+    start, end = get_sequence_parallel_range(seqlen)
+    return (torch.arange(get_sequence_parallel_shard_size(seqlen), device=device) < end - start)[None]
 
+def shard_sequence(input_: torch.Tensor, seqlen: int, dim: int = -2):
+    """The tokens of this rank along `dim`, zero-padded to the shard size."""
+    start, end = get_sequence_parallel_range(seqlen)
+    input_ = input_.narrow(dim, start, end - start)
+    num_padding = get_sequence_parallel_shard_size(seqlen) - (end - start)
+    if num_padding > 0:
+        shape = list(input_.shape)
+        shape[dim] = num_padding
+        input_ = torch.cat([input_, input_.new_zeros(shape)], dim=dim)
+    return input_
 
-def parallel_forward(fn_):
-    def wrapTheFunction(_, hidden_states, *args, **kwargs):
-        if kwargs['parallel']:            
-            hidden_states = torch.chunk(hidden_states, get_sequence_parallel_world_size(), dim=-2)[get_sequence_parallel_rank()]
-            kwargs['attn_mask'] = torch.chunk(kwargs['attn_mask'], get_sequence_parallel_world_size(), dim=-2)[get_sequence_parallel_rank()]
-        output = fn_(_, hidden_states, *args, **kwargs)
-        
-        if kwargs['parallel']:
-            output = get_sp_group().all_gather(output.contiguous(), dim=-2)
-        
-        return output
-     
-    return wrapTheFunction
\ No newline at end of file
+def gather_sequence(input_: torch.Tensor, seqlen: int, dim: int = -2, codec=None):
+    """Gathers the shards of all ranks along `dim`, optionally compressed by `codec`, and strips the padding."""
+    output = compressed_all_gather(get_sp_group(), input_, dim=dim, codec=codec)
+    return output.narrow(dim, 0, seqlen)
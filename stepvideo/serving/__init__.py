@@ -0,0 +1,3 @@
+from .batching import GenerationRequest, ContinuousBatchingScheduler
+from .runner import PipelinedJobRunner
+from .server import InferenceServer
@@ -0,0 +1,144 @@
+# Copyright 2025 StepFun Inc. All Rights Reserved.
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, List, Optional
+
+import torch.distributed as dist
+
+from stepvideo.parallel import SequenceParallelGroup, sequence_parallel_group, is_sequence_parallel_leader
+from stepvideo.serving.batching import GenerationRequest
+from stepvideo.serving.runner import StageTimer
+
+
+class AdaptiveParallelScheduler:
+    r"""
+    Runs requests on sequence parallel sub-groups sized from their token count, so that several small requests
+    (e.g. 17-frame previews) run at the same time on a few GPUs each while large ones get the whole world.
+
+    At construction, the world is tiled into aligned blocks of every allowed degree (degrees dividing both the
+    world size and the number of attention heads, so that Ulysses can split the heads). Each request gets the
+    smallest degree keeping its tokens per rank under `tokens_per_rank`, and is placed on the block of that
+    degree that frees up first under a `tokens**2 / degree` cost model. Every rank computes the same plan from
+    the same request list and runs its own requests by planned start time, so the ranks of a block always
+    enter the same request together.
+
+    Args:
+        tokens_per_rank (`int`, defaults to 4096):
+            Target number of video tokens per rank.
+        num_heads (`int`, defaults to 48):
+            Number of attention heads of the transformer.
+        vae_scale_factor_spatial (`int`, defaults to 16):
+            Spatial size of one video token in pixels.
+    """
+
+    def __init__(self, tokens_per_rank: int = 4096, num_heads: int = 48, vae_scale_factor_spatial: int = 16):
+        self.tokens_per_rank = tokens_per_rank
+        self.num_heads = num_heads
+        self.vae_scale_factor_spatial = vae_scale_factor_spatial
+        self.world_size = dist.get_world_size()
+        self.rank = dist.get_rank()
+        self.degrees = [d for d in range(1, self.world_size + 1) if self.world_size % d == 0 and num_heads % d == 0]
+        self.groups = {
+            d: [SequenceParallelGroup(range(start, start + d)) for start in range(0, self.world_size, d)]
+            for d in self.degrees
+        }
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.timers = {name: StageTimer(name) for name in ['conditioning', 'denoise', 'decode']}
+        self.degree_counts = Counter()
+        self.wall_time = 0.0
+
+    def num_tokens(self, request: GenerationRequest):
+        latent_frames = max(request.num_frames//17*3, 1)
+        height = max(request.height//16*16, 16) // self.vae_scale_factor_spatial
+        width = max(request.width//16*16, 16) // self.vae_scale_factor_spatial
+        return latent_frames * height * width
+
+    def choose_degree(self, num_tokens: int):
+        ## sequences that do not split evenly are padded, so any degree works
+        for d in self.degrees:
+            if -(-num_tokens // d) <= self.tokens_per_rank:
+                return d
+        return self.degrees[-1]
+
+    def plan(self, requests: List[GenerationRequest]):
+        """Returns `(request_index, degree, block_index, start)` for every request, identical on every rank."""
+        free_at = [0.0] * self.world_size
+        plan = []
+        for i, request in enumerate(requests):
+            num_tokens = self.num_tokens(request)
+            degree = self.choose_degree(num_tokens)
+            starts = [max(free_at[r] for r in group.ranks) for group in self.groups[degree]]
+            block = min(range(len(starts)), key=lambda b: (starts[b], b))
+            start = starts[block]
+            for r in self.groups[degree][block].ranks:
+                free_at[r] = start + num_tokens**2 / degree
+            plan.append((i, degree, block, start))
+        return plan
+
+    def run_request(self, request: GenerationRequest, group: SequenceParallelGroup, denoise_kwargs: Dict[str, Any]):
+        pipeline = self.pipeline
+        with sequence_parallel_group(group):
+            inputs = self.timers['conditioning'](
+                pipeline.prepare_request,
+                prompt=request.prompt,
+                first_image=request.first_image,
+                height=request.height,
+                width=request.width,
+                num_frames=request.num_frames,
+                num_inference_steps=request.num_inference_steps,
+                time_shift=request.time_shift,
+                neg_magic=request.neg_magic,
+                pos_magic=request.pos_magic,
+                seed=request.seed,
+                motion_score=request.motion_score,
+            )
+            latents, stats = self.timers['denoise'](
+                pipeline.denoise, inputs, guidance_scale=request.guidance_scale, **denoise_kwargs
+            )
+            stats['sequence_parallel_degree'] = group.world_size
+            if not is_sequence_parallel_leader():
+                return None
+            if request.output_type == "latent":
+                video = latents
+            else:
+                video = self.timers['decode'](
+                    pipeline.postprocess, latents, output_type=request.output_type, output_file_name=request.output_file_name
+                )
+        return {'request_id': request.request_id, 'video': video, 'stats': stats}
+
+    def run(
+        self,
+        pipeline,
+        requests: List[GenerationRequest],
+        on_result: Optional[Callable[[Dict[str, Any]], None]] = None,
+        **denoise_kwargs,
+    ) -> List[Dict[str, Any]]:
+        """
+        Runs the requests of this rank and returns the results of the requests it led. Every rank has to be
+        called with the same requests in the same order.
+        """
+        self.pipeline = pipeline
+        start = time.perf_counter()
+        results = []
+        own = [
+            (planned_start, i, degree, block) for i, degree, block, planned_start in self.plan(requests)
+            if self.rank in self.groups[degree][block]
+        ]
+        for _, i, degree, block in sorted(own):
+            self.degree_counts[degree] += 1
+            result = self.run_request(requests[i], self.groups[degree][block], denoise_kwargs)
+            if result is not None:
+                results.append(result)
+                if on_result is not None:
+                    on_result(result)
+        self.wall_time += time.perf_counter() - start
+        return results
+
+    def stats(self):
+        return {
+            'wall_time': self.wall_time,
+            'degrees': dict(self.degree_counts),
+            **{name: timer.stats(self.wall_time) for name, timer in self.timers.items()},
+        }
@@ -0,0 +1,266 @@
+# Copyright 2025 StepFun Inc. All Rights Reserved.
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import torch
+from PIL import Image as PILImage
+
+from stepvideo.diffusion.scheduler import FlowMatchDiscreteScheduler
+from stepvideo.modules.conditioning import ConditioningContext
+from stepvideo.parallel import is_sequence_parallel_leader
+
+
+@dataclass
+class GenerationRequest:
+    prompt: str
+    first_image: Union[str, PILImage.Image, torch.Tensor]
+    num_frames: int = 102
+    height: int = 544
+    width: int = 992
+    num_inference_steps: int = 50
+    guidance_scale: float = 9.0
+    time_shift: float = 13.0
+    motion_score: float = 5.0
+    seed: Optional[int] = None
+    pos_magic: str = ""
+    neg_magic: str = ""
+    output_type: str = "mp4"
+    output_file_name: str = ""
+    request_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+
+
+class ActiveRequest:
+    """Per-request denoising state inside a running batch."""
+
+    def __init__(self, request, latents, conditioning, condition_embeds, timestep_table):
+        self.request = request
+        self.latents = latents
+        self.conditioning = conditioning
+        self.condition_embeds = condition_embeds
+        self.timestep_table = timestep_table
+        self.step = 0
+
+    @property
+    def finished(self):
+        return self.step >= len(self.timestep_table)
+
+
+class BatchGroup:
+    """
+    Requests sharing the latent shape and the sigma schedule, denoised by one batched transformer forward per
+    step. The batch is laid out as [cond of every request, uncond of every request], and the merged
+    conditioning is rebuilt only when requests join or leave.
+    """
+
+    def __init__(self, key, scheduler: FlowMatchDiscreteScheduler):
+        self.key = key
+        self.scheduler = scheduler
+        self.members: List[ActiveRequest] = []
+        self.conditioning = None
+        self.condition_embeds = None
+
+    def __len__(self):
+        return len(self.members)
+
+    def rebuild(self):
+        if len(self.members) == 0:
+            self.conditioning, self.condition_embeds = None, None
+            return
+        cond = [m.conditioning.select_batch(slice(0, 1)) for m in self.members]
+        uncond = [m.conditioning.select_batch(slice(1, 2)) for m in self.members]
+        self.conditioning = ConditioningContext.cat(cond + uncond)
+        self.condition_embeds = torch.cat([m.condition_embeds for m in self.members])
+
+
+class ContinuousBatchingScheduler:
+    r"""
+    Serving-side scheduler that admits requests into running batches at step boundaries and retires finished ones.
+
+    Requests with the same latent shape and sigma schedule (`num_frames`, `height`, `width`, `num_inference_steps`,
+    `time_shift`) share transformer forwards even when they arrived at different times: every sample carries its
+    own step index, which selects its timestep embedding and its Euler step. Guidance scale, motion score and seed
+    may differ per request. Under sequence parallelism every rank must submit the same requests in the same order.
+
+    Per-sample steps need the euler solver, and every step runs both guidance branches of every request, so the
+    other solvers, the guidance schedule and the step and block caches are rejected rather than ignored.
+
+    Args:
+        pipeline ([`StepVideoPipeline`]):
+            The pipeline providing the transformer, the remote encoders and the video post-processing. Its
+            scheduler has to use the euler solver.
+        max_batch_size (`int`, defaults to 4):
+            Maximum number of requests in one batch group (the transformer batch is twice as large for CFG).
+        max_kv_cache_bytes (`int`, *optional*):
+            Cross-attention K/V budget of every request, see [`StepVideoPipeline.denoise`].
+        cfg_interval, cfg_truncation, step_cache, block_cache:
+            The other [`StepVideoPipeline.denoise`] arguments, accepted so that the same kwargs can be passed;
+            only their defaults are supported.
+    """
+
+    def __init__(
+        self,
+        pipeline,
+        max_batch_size: int = 4,
+        max_kv_cache_bytes: Optional[int] = None,
+        cfg_interval=None,
+        cfg_truncation: float = 1.0,
+        step_cache=None,
+        block_cache=None,
+    ):
+        solver = pipeline.scheduler.config.solver
+        if solver != "euler":
+            raise ValueError(f"Continuous batching needs per-sample steps, only supported by the euler solver, got {solver}")
+        if cfg_interval is not None or cfg_truncation != 1.0:
+            raise ValueError("Continuous batching applies guidance on every step, cfg_interval and cfg_truncation are not supported")
+        if step_cache is not None or block_cache is not None:
+            raise ValueError("Continuous batching does not support the step and block caches")
+        self.pipeline = pipeline
+        self.max_batch_size = max_batch_size
+        self.max_kv_cache_bytes = max_kv_cache_bytes
+        self.waiting = deque()
+        self.groups: Dict[Any, BatchGroup] = {}
+
+    def submit(self, request: GenerationRequest, encoded_inputs: Optional[Tuple[torch.Tensor, ...]] = None):
+        """Queues `request`; `encoded_inputs` (the outputs of `encode_inputs`) skips its remote encoding."""
+        self.waiting.append((request, encoded_inputs))
+        return request.request_id
+
+    def active_requests(self):
+        return [m for group in self.groups.values() for m in group.members]
+
+    def has_unfinished(self):
+        return len(self.waiting) > 0 or any(len(g) > 0 for g in self.groups.values())
+
+    def group_key(self, request: GenerationRequest):
+        num_frames, width, height = self.pipeline.check_inputs(request.num_frames, request.width, request.height)
+        return (num_frames, height, width, request.num_inference_steps, request.time_shift)
+
+    def get_group(self, key):
+        if key not in self.groups:
+            pipeline = self.pipeline
+            scheduler = FlowMatchDiscreteScheduler.from_config(pipeline.scheduler.config)
+            scheduler.set_timesteps(num_inference_steps=key[3], time_shift=key[4], device=pipeline._execution_device)
+            self.groups[key] = BatchGroup(key, scheduler)
+        return self.groups[key]
+
+    @torch.inference_mode()
+    def prepare(self, request: GenerationRequest, group: BatchGroup, encoded_inputs=None):
+        pipeline = self.pipeline
+        transformer = pipeline.transformer
+        device = pipeline._execution_device
+
+        ## the concurrent conditioning stage of the pipeline, on a scheduler of its own
+        inputs = pipeline.prepare_request(
+            prompt=request.prompt,
+            first_image=request.first_image,
+            height=request.height,
+            width=request.width,
+            num_frames=request.num_frames,
+            num_inference_steps=request.num_inference_steps,
+            time_shift=request.time_shift,
+            neg_magic=request.neg_magic,
+            pos_magic=request.pos_magic,
+            seed=request.seed,
+            motion_score=request.motion_score,
+            scheduler=FlowMatchDiscreteScheduler.from_config(group.scheduler.config),
+            encoded_inputs=encoded_inputs,
+        )
+        conditioning = transformer.prepare_conditioning(
+            inputs['prompt_embeds'].to(device=device, dtype=transformer.dtype),
+            inputs['prompt_attention_mask'].to(device=device, dtype=transformer.dtype),
+            inputs['prompt_embeds_2'].to(device=device, dtype=transformer.dtype),
+            max_kv_cache_bytes=self.max_kv_cache_bytes,
+        )
+        condition_embeds = pipeline.prepare_condition_hidden_states(
+            batch_size=1, dtype=transformer.dtype, device=device, img_emb=inputs['img_emb'],
+        )
+        latents = inputs['latents'].to(torch.float32)
+        return ActiveRequest(request, latents, conditioning, condition_embeds, inputs['timestep_table'])
+
+    def admit(self):
+        still_waiting = deque()
+        changed = set()
+        while len(self.waiting) > 0:
+            request, encoded_inputs = self.waiting.popleft()
+            group = self.get_group(self.group_key(request))
+            if len(group) >= self.max_batch_size:
+                still_waiting.append((request, encoded_inputs))
+                continue
+            group.members.append(self.prepare(request, group, encoded_inputs))
+            changed.add(group.key)
+        self.waiting = still_waiting
+        for key in changed:
+            self.groups[key].rebuild()
+
+    @torch.inference_mode()
+    def step_group(self, group: BatchGroup):
+        members = group.members
+        device = self.pipeline._execution_device
+        transformer_dtype = self.pipeline.transformer.dtype
+
+        step_index = torch.tensor([m.step for m in members], device=device)
+        latents = torch.cat([m.latents for m in members])
+        timestep_embeds = tuple(
+            torch.cat([m.timestep_table[m.step][j] for m in members] * 2) for j in range(2)
+        )
+        timestep = group.scheduler.timesteps[step_index].repeat(2).to(transformer_dtype)
+
+        noise_pred = self.pipeline.transformer(
+            hidden_states=torch.cat([latents] * 2).to(transformer_dtype),
+            timestep=timestep,
+            condition_embeds=group.condition_embeds,
+            conditioning=group.conditioning,
+            timestep_embeds=timestep_embeds,
+            return_dict=False,
+        )
+        noise_pred_text, noise_pred_uncond = noise_pred.chunk(2)
+        guidance_scale = torch.tensor([m.request.guidance_scale for m in members], device=device)
+        guidance_scale = guidance_scale.view(-1, *[1] * (noise_pred.ndim - 1))
+        noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+
+        latents = group.scheduler.step(
+            model_output=noise_pred, timestep=None, sample=latents, step_index=step_index
+        )
+        for m, m_latents in zip(members, latents.split(1)):
+            m.latents = m_latents
+            m.step += 1
+
+    def retire(self, group: BatchGroup):
+        finished = [m for m in group.members if m.finished]
+        if len(finished) == 0:
+            return []
+        group.members = [m for m in group.members if not m.finished]
+        group.rebuild()
+
+        results = []
+        for m in finished:
+            result = {'request_id': m.request.request_id, 'num_steps': m.step}
+            if is_sequence_parallel_leader():
+                if m.request.output_type == "latent":
+                    result['video'] = m.latents
+                else:
+                    video = self.pipeline.decode_vae(m.latents)
+                    result['video'] = self.pipeline.video_processor.postprocess_video(
+                        video, output_file_name=m.request.output_file_name, output_type=m.request.output_type
+                    )
+            results.append(result)
+        return results
+
+    def step(self):
+        """Admits waiting requests, runs one denoising step for every batch group and returns the finished requests."""
+        self.admit()
+        results = []
+        for group in list(self.groups.values()):
+            if len(group) == 0:
+                continue
+            self.step_group(group)
+            results += self.retire(group)
+        return results
+
+    def run_until_complete(self):
+        results = []
+        while self.has_unfinished():
+            results += self.step()
+        return results
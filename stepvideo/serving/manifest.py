@@ -0,0 +1,63 @@
+# Copyright 2025 StepFun Inc. All Rights Reserved.
+import glob
+import json
+import os
+from collections import Counter
+from typing import Any, Dict, List, Tuple
+
+
+image_extensions = [".png", ".jpg", ".jpeg", ".webp"]
+
+
+def load_benchmark_dir(root: str) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """
+    Jobs of a benchmark directory of `NNN.txt` prompts next to their `NNN.png` first images, e.g.
+    `benchmark/Step-Video-TI2V-Eval`. Returns the jobs and the prompt files without a first image.
+    """
+    jobs, missing = [], []
+    for prompt_path in sorted(glob.glob(os.path.join(root, "**", "*.txt"), recursive=True)):
+        stem = os.path.splitext(prompt_path)[0]
+        image_paths = [stem + ext for ext in image_extensions if os.path.exists(stem + ext)]
+        if len(image_paths) == 0:
+            missing.append(prompt_path)
+            continue
+        with open(prompt_path, encoding="utf-8") as f:
+            prompt = f.read().strip()
+        name = os.path.relpath(stem, root).replace(os.sep, "_")
+        jobs.append({'name': name, 'prompt': prompt, 'first_image': image_paths[0]})
+    return jobs, missing
+
+
+def load_jsonl(path: str) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """
+    Jobs of a JSONL file, one `{"prompt": ..., "first_image": ...}` object per line with an optional `name` and
+    sampling parameters. Relative image paths are resolved against the directory of the file.
+    """
+    jobs, missing = [], []
+    root = os.path.dirname(os.path.abspath(path))
+    with open(path, encoding="utf-8") as f:
+        for i, line in enumerate(f):
+            if len(line.strip()) == 0:
+                continue
+            job = json.loads(line)
+            job['first_image'] = os.path.join(root, job['first_image'])
+            job.setdefault('name', f"{os.path.splitext(os.path.basename(path))[0]}_{i:05d}")
+            if not os.path.exists(job['first_image']):
+                missing.append(job['first_image'])
+                continue
+            jobs.append(job)
+    return jobs, missing
+
+
+def load_manifest(paths: List[str]) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """Jobs of benchmark directories and JSONL files, in a deterministic order, with unique names."""
+    jobs, missing = [], []
+    for path in paths:
+        path_jobs, path_missing = load_benchmark_dir(path) if os.path.isdir(path) else load_jsonl(path)
+        jobs += path_jobs
+        missing += path_missing
+
+    duplicates = sorted(name for name, count in Counter(job['name'] for job in jobs).items() if count > 1)
+    if len(duplicates) > 0:
+        raise ValueError(f"Job names should be unique, got duplicates: {duplicates[:10]}")
+    return jobs, missing
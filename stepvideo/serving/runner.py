@@ -0,0 +1,181 @@
+# Copyright 2025 StepFun Inc. All Rights Reserved.
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import torch
+
+from stepvideo.diffusion.scheduler import FlowMatchDiscreteScheduler
+from stepvideo.modules.cache import TeaCache, BlockCache
+from stepvideo.parallel import is_sequence_parallel_leader
+from stepvideo.serving.batching import GenerationRequest
+
+
+class StageTimer:
+    """Busy time of one pipeline stage, accumulated over possibly concurrent workers."""
+
+    def __init__(self, name: str, num_workers: int = 1):
+        self.name = name
+        self.num_workers = num_workers
+        self.busy_time = 0.0
+        self.num_calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, fn, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.busy_time += time.perf_counter() - start
+                self.num_calls += 1
+
+    def stats(self, wall_time: float):
+        return {
+            'num_calls': self.num_calls,
+            'busy_time': self.busy_time,
+            'utilization': self.busy_time / (wall_time * self.num_workers) if wall_time > 0 else 0.0,
+        }
+
+
+class PipelinedJobRunner:
+    r"""
+    Runs a stream of [`GenerationRequest`]s through [`StepVideoPipeline`] with its three stages overlapped across
+    requests: while request N denoises, the conditioning of the next requests (caption and vae-encode requests,
+    initial noise, timestep embeddings) is prefetched in a background thread, and request N-1 is decoded and
+    written by a background decode worker.
+
+    Every prefetched request gets its own scheduler, so the denoising of the current request is never affected.
+    Prefetching runs on a side CUDA stream. Under sequence parallelism every rank must run the same requests in
+    the same order; only rank 0 decodes.
+
+    Args:
+        pipeline ([`StepVideoPipeline`]):
+            The pipeline providing the stage methods `prepare_request`, `denoise` and `postprocess`.
+        prefetch_depth (`int`, defaults to 1):
+            Number of requests whose conditioning is prepared ahead of the one denoising.
+        num_decode_workers (`int`, defaults to 1):
+            Number of concurrent decode-and-write workers.
+        cfg_interval, cfg_truncation, max_kv_cache_bytes, step_cache, block_cache:
+            Passed to [`StepVideoPipeline.denoise`] for every request.
+        on_result (`Callable`, *optional*):
+            Called by the decode worker with the result of every request as soon as it is written.
+    """
+
+    def __init__(
+        self,
+        pipeline,
+        prefetch_depth: int = 1,
+        num_decode_workers: int = 1,
+        cfg_interval=None,
+        cfg_truncation: float = 1.0,
+        max_kv_cache_bytes: Optional[int] = None,
+        step_cache: Optional[TeaCache] = None,
+        block_cache: Optional[BlockCache] = None,
+        on_result: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ):
+        self.pipeline = pipeline
+        self.on_result = on_result
+        self.prefetch_depth = max(prefetch_depth, 0)
+        self.num_decode_workers = num_decode_workers
+        self.denoise_kwargs = dict(
+            cfg_interval=cfg_interval,
+            cfg_truncation=cfg_truncation,
+            max_kv_cache_bytes=max_kv_cache_bytes,
+            step_cache=step_cache,
+            block_cache=block_cache,
+        )
+        self.is_decode_rank = is_sequence_parallel_leader()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.timers = {
+            'conditioning': StageTimer('conditioning'),
+            'denoise': StageTimer('denoise'),
+            'decode': StageTimer('decode', self.num_decode_workers),
+        }
+        self.denoise_wait_time = 0.0
+        self.wall_time = 0.0
+
+    def prepare(self, request: GenerationRequest):
+        pipeline = self.pipeline
+        scheduler = FlowMatchDiscreteScheduler.from_config(pipeline.scheduler.config)
+        stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+        with torch.cuda.stream(stream):
+            inputs = pipeline.prepare_request(
+                prompt=request.prompt,
+                first_image=request.first_image,
+                height=request.height,
+                width=request.width,
+                num_frames=request.num_frames,
+                num_inference_steps=request.num_inference_steps,
+                time_shift=request.time_shift,
+                neg_magic=request.neg_magic,
+                pos_magic=request.pos_magic,
+                seed=request.seed,
+                motion_score=request.motion_score,
+                scheduler=scheduler,
+            )
+        if stream is not None:
+            ## the denoising stream only consumes the inputs once they are ready
+            stream.synchronize()
+        return inputs
+
+    def decode(self, request: GenerationRequest, latents: torch.Tensor, stats: Dict[str, Any]):
+        if request.output_type == "latent":
+            video = latents
+        else:
+            video = self.pipeline.postprocess(
+                latents, output_type=request.output_type, output_file_name=request.output_file_name
+            )
+        result = {'request_id': request.request_id, 'video': video, 'stats': stats}
+        if self.on_result is not None:
+            self.on_result(result)
+        return result
+
+    def run(self, requests: Iterable[GenerationRequest]) -> List[Dict[str, Any]]:
+        """Runs all requests and returns their results, in order, once the last one is decoded."""
+        requests = iter(requests)
+        results = []
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=1) as prefetcher, \
+                ThreadPoolExecutor(max_workers=self.num_decode_workers) as decoder:
+            pending = deque()
+
+            def top_up():
+                while len(pending) < self.prefetch_depth + 1:
+                    request = next(requests, None)
+                    if request is None:
+                        return
+                    pending.append((request, prefetcher.submit(self.timers['conditioning'], self.prepare, request)))
+
+            top_up()
+            while len(pending) > 0:
+                request, future = pending.popleft()
+                wait_start = time.perf_counter()
+                inputs = future.result()
+                self.denoise_wait_time += time.perf_counter() - wait_start
+                top_up()
+
+                latents, stats = self.timers['denoise'](
+                    self.pipeline.denoise, inputs, guidance_scale=request.guidance_scale, **self.denoise_kwargs
+                )
+                del inputs
+                if self.is_decode_rank:
+                    ## hand over host copies, so the decode worker never touches the denoising stream
+                    results.append(decoder.submit(self.timers['decode'], self.decode, request, latents.cpu(), stats))
+                else:
+                    results.append(None)
+
+            results = [r.result() if r is not None else None for r in results]
+        self.wall_time += time.perf_counter() - start
+        return results
+
+    def stats(self):
+        return {
+            'wall_time': self.wall_time,
+            'denoise_wait_time': self.denoise_wait_time,
+            **{name: timer.stats(self.wall_time) for name, timer in self.timers.items()},
+        }
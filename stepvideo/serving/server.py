@@ -0,0 +1,388 @@
+# Copyright 2025 StepFun Inc. All Rights Reserved.
+import asyncio
+import base64
+import io
+import json
+import queue
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import Any, Dict, Optional
+
+import torch
+import torch.distributed as dist
+from PIL import Image as PILImage
+
+from stepvideo.serving.batching import ContinuousBatchingScheduler, GenerationRequest
+
+
+class InferenceServer:
+    r"""
+    Long-lived multi-job server around a sequence-parallel [`StepVideoPipeline`], launched with `torchrun`.
+
+    Rank 0 accepts jobs over a local HTTP interface, runs the remote caption and vae-encode requests once, and
+    broadcasts the job spec together with the encoded prompt and first-image latents to every rank over a
+    gloo control group. All ranks then prepare the noise from the job seed and run the denoising loop, while
+    the weights, the RoPE and timestep embedding tables and the client-side caches stay resident across jobs.
+    Rank 0 decodes finished jobs in a background worker, so the next job can start denoising right away.
+
+    With `--continuous_batching`, jobs are denoised together by a [`ContinuousBatchingScheduler`]: between two
+    steps, rank 0 encodes and broadcasts the jobs queued meanwhile, and they join the running batches.
+
+    Endpoints (rank 0):
+        `POST /generate`: JSON job with `prompt` and `first_image` (a path on the server) or `first_image_b64`,
+            plus optional sampling parameters. Returns the `job_id`.
+        `GET /status/<job_id>`: state (`queued`, `encoding`, `denoising`, `decoding`, `done`, `failed`), denoising
+            progress, output path and stats of a job. Finished jobs are forgotten after `--finished_job_ttl`
+            seconds, or once more than `--max_finished_jobs` have finished, and then return 404 like unknown ones.
+        `GET /events/<job_id>`: the same status as a server-sent event stream, until the job is done or failed.
+        `GET /status`: queue length, running job and counters of the server.
+        `POST /shutdown`: stops the server once the queued jobs are done.
+
+    Args:
+        pipeline ([`StepVideoPipeline`]):
+            The pipeline, with the transformer already on the device of this rank.
+        args (`argparse.Namespace`):
+            Parsed `stepvideo.config` arguments, providing the default sampling parameters.
+        denoise_kwargs (`dict`, *optional*):
+            Passed to [`StepVideoPipeline.denoise`] for every job, e.g. `step_cache` or `max_kv_cache_bytes`.
+    """
+
+    job_params = {
+        'num_frames': 'num_frames',
+        'height': 'height',
+        'width': 'width',
+        'num_inference_steps': 'infer_steps',
+        'guidance_scale': 'cfg_scale',
+        'time_shift': 'time_shift',
+        'motion_score': 'motion_score',
+        'seed': 'seed',
+        'pos_magic': 'pos_magic',
+        'neg_magic': 'neg_magic',
+        'num_videos_per_prompt': 'num_videos',
+    }
+
+    def __init__(self, pipeline, args, denoise_kwargs: Optional[Dict[str, Any]] = None):
+        self.pipeline = pipeline
+        self.args = args
+        self.denoise_kwargs = denoise_kwargs or {}
+        self.rank = dist.get_rank()
+        ## job specs travel over gloo, so idle ranks wait on the host and never hit the NCCL watchdog
+        self.control_group = dist.new_group(backend="gloo", timeout=timedelta(days=365))
+
+        self.jobs: Dict[str, Dict[str, Any]] = {}
+        ## finish time of the done and failed jobs still in `jobs`, oldest first
+        self.finished_jobs = OrderedDict()
+        self.num_finished = {'done': 0, 'failed': 0}
+        self.lock = threading.RLock()
+        self.queue = queue.Queue(maxsize=args.max_queued_jobs)
+        self.running_job = None
+        self.jobs_in_flight: Dict[str, Dict[str, Any]] = {}
+        self.start_time = time.time()
+        self.decoder = ThreadPoolExecutor(max_workers=1) if self.rank == 0 else None
+        self.batcher = ContinuousBatchingScheduler(
+            pipeline, max_batch_size=args.max_batch_jobs, **self.denoise_kwargs
+        ) if args.continuous_batching else None
+
+    def update(self, job_id: str, **status):
+        with self.lock:
+            if job_id not in self.jobs:
+                return
+            self.jobs[job_id].update(status, updated_at=time.time())
+            if status.get('state') in ['done', 'failed'] and job_id not in self.finished_jobs:
+                self.finished_jobs[job_id] = time.time()
+                self.num_finished[status['state']] += 1
+            self.evict_finished_jobs()
+
+    def evict_finished_jobs(self):
+        """Forgets the oldest finished jobs beyond `--max_finished_jobs` and those older than `--finished_job_ttl`."""
+        with self.lock:
+            expiry = time.time() - self.args.finished_job_ttl
+            while len(self.finished_jobs) > 0 and (
+                len(self.finished_jobs) > self.args.max_finished_jobs or next(iter(self.finished_jobs.values())) < expiry
+            ):
+                job_id, _ = self.finished_jobs.popitem(last=False)
+                self.jobs.pop(job_id, None)
+
+    def get_status(self, job_id: str):
+        with self.lock:
+            self.evict_finished_jobs()
+            return dict(self.jobs[job_id]) if job_id in self.jobs else None
+
+    def submit(self, payload: Dict[str, Any]):
+        if 'prompt' not in payload or ('first_image' not in payload and 'first_image_b64' not in payload):
+            raise ValueError("A job needs a `prompt` and a `first_image` or `first_image_b64`.")
+        job = {name: payload.get(name, getattr(self.args, arg)) for name, arg in self.job_params.items()}
+        if self.batcher is not None and job['num_videos_per_prompt'] != 1:
+            raise ValueError("Continuous batching generates one video per job.")
+        job_id = payload.get('job_id') or uuid.uuid4().hex
+        job.update(
+            type='generate',
+            job_id=job_id,
+            prompt=payload['prompt'],
+            first_image=payload.get('first_image'),
+            first_image_b64=payload.get('first_image_b64'),
+            output_file_name=payload.get('output_file_name') or f"{payload['prompt'][:50]}-{job_id[:8]}",
+        )
+        with self.lock:
+            if job_id in self.jobs:
+                raise ValueError(f"Job {job_id} already exists.")
+            self.jobs[job_id] = {'job_id': job_id, 'state': 'queued', 'submitted_at': time.time()}
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            with self.lock:
+                del self.jobs[job_id]
+            raise
+        return job_id
+
+    def build_app(self):
+        from flask import Flask, Response, jsonify, request
+
+        app = Flask(__name__)
+
+        @app.route("/generate", methods=["POST"])
+        def generate():
+            try:
+                job_id = self.submit(request.get_json(force=True))
+            except queue.Full:
+                return jsonify({'error': 'too many queued jobs'}), 503
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            return jsonify({'job_id': job_id})
+
+        @app.route("/status/<job_id>", methods=["GET"])
+        def job_status(job_id):
+            status = self.get_status(job_id)
+            if status is None:
+                return jsonify({'error': f'unknown or expired job {job_id}'}), 404
+            return jsonify(status)
+
+        @app.route("/events/<job_id>", methods=["GET"])
+        def job_events(job_id):
+            if self.get_status(job_id) is None:
+                return jsonify({'error': f'unknown or expired job {job_id}'}), 404
+
+            def stream():
+                last = None
+                while True:
+                    status = self.get_status(job_id)
+                    if status is None:
+                        return
+                    if status != last:
+                        yield f"data: {json.dumps(status)}\n\n"
+                        last = status
+                    if status['state'] in ['done', 'failed']:
+                        return
+                    time.sleep(0.5)
+
+            return Response(stream(), mimetype="text/event-stream")
+
+        @app.route("/status", methods=["GET"])
+        def server_status():
+            with self.lock:
+                self.evict_finished_jobs()
+                num_finished = dict(self.num_finished)
+                num_jobs = len(self.jobs)
+            return jsonify({
+                'uptime': time.time() - self.start_time,
+                'num_queued': self.queue.qsize(),
+                'running_job': self.running_job,
+                'num_done': num_finished['done'],
+                'num_failed': num_finished['failed'],
+                'num_tracked_jobs': num_jobs,
+            })
+
+        @app.route("/shutdown", methods=["POST"])
+        def shutdown():
+            self.queue.put({'type': 'shutdown'})
+            return jsonify({'state': 'shutting down'})
+
+        return app
+
+    def encode(self, job: Dict[str, Any]):
+        """Remote encoding of a job on rank 0; the outputs are broadcast with the job spec."""
+        first_image = job.pop('first_image_b64', None)
+        if first_image is not None:
+            first_image = PILImage.open(io.BytesIO(base64.b64decode(first_image)))
+        else:
+            first_image = job['first_image']
+        encoded_inputs = asyncio.run(self.pipeline.encode_inputs(
+            job['prompt'],
+            first_image,
+            job['neg_magic'],
+            job['pos_magic'],
+            1,
+            job['height'],
+            job['width'],
+            job['num_frames'],
+        ))
+        job['encoded_inputs'] = tuple(t.cpu() for t in encoded_inputs)
+        return job
+
+    def take_job(self, block: bool = True):
+        """
+        Takes the next job from the queue on rank 0 and encodes it. Returns None if its encoding failed, or if
+        the queue is empty and `block` is not set.
+        """
+        try:
+            job = self.queue.get(block=block)
+        except queue.Empty:
+            return None
+        if job['type'] != 'generate':
+            return job
+        self.update(job['job_id'], state='encoding')
+        try:
+            return self.encode(job)
+        except Exception as e:
+            traceback.print_exc()
+            self.update(job['job_id'], state='failed', error=f"encoding failed: {e}")
+            return None
+
+    def next_job(self):
+        """Blocks on rank 0 until a job is encoded (or a shutdown is requested) and broadcasts it to all ranks."""
+        job = None
+        while self.rank == 0 and job is None:
+            job = self.take_job()
+        spec = [job]
+        dist.broadcast_object_list(spec, src=0, group=self.control_group)
+        return spec[0]
+
+    def next_jobs(self, block: bool):
+        """
+        Encodes all queued jobs on rank 0, waiting for a first one if `block`, and broadcasts them to all ranks.
+        A shutdown request ends the list.
+        """
+        jobs = []
+        while self.rank == 0:
+            job = self.take_job(block=block and len(jobs) == 0)
+            if job is None:
+                if block and len(jobs) == 0:
+                    continue
+                break
+            jobs.append(job)
+            if job['type'] != 'generate':
+                break
+        spec = [jobs]
+        dist.broadcast_object_list(spec, src=0, group=self.control_group)
+        return spec[0]
+
+    def run_job(self, job: Dict[str, Any]):
+        job_id = job['job_id']
+        self.running_job = job_id
+        inputs = self.pipeline.prepare_request(
+            prompt=job['prompt'],
+            height=job['height'],
+            width=job['width'],
+            num_frames=job['num_frames'],
+            num_inference_steps=job['num_inference_steps'],
+            time_shift=job['time_shift'],
+            num_videos_per_prompt=job['num_videos_per_prompt'],
+            seed=job['seed'],
+            motion_score=job['motion_score'],
+            encoded_inputs=job['encoded_inputs'],
+        )
+
+        def callback(step, num_steps):
+            if self.rank == 0:
+                self.update(job_id, state='denoising', step=step, num_steps=num_steps)
+
+        latents, stats = self.pipeline.denoise(
+            inputs, guidance_scale=job['guidance_scale'], callback=callback, **self.denoise_kwargs
+        )
+        self.running_job = None
+        if self.rank == 0:
+            self.update(job_id, state='decoding')
+            self.decoder.submit(self.finish_job, job, latents.cpu(), stats)
+
+    def finish_job(self, job: Dict[str, Any], latents: torch.Tensor, stats: Dict[str, Any]):
+        try:
+            output = self.pipeline.postprocess(
+                latents,
+                output_file_name=job['output_file_name'],
+                num_videos_per_prompt=job['num_videos_per_prompt'],
+            )
+        except Exception as e:
+            traceback.print_exc()
+            self.update(job['job_id'], state='failed', error=f"decoding failed: {e}")
+            return
+        self.update(job['job_id'], state='done', output=output, stats=stats)
+
+    def run_serial(self):
+        """Serving loop running one job at a time."""
+        while True:
+            job = self.next_job()
+            if job is None or job['type'] == 'shutdown':
+                break
+            try:
+                self.run_job(job)
+            except Exception as e:
+                ## a failing rank leaves the others waiting in a collective, there is nothing to recover
+                if self.rank == 0:
+                    self.update(job['job_id'], state='failed', error=str(e))
+                raise
+
+    def run_batched(self):
+        """Serving loop of `--continuous_batching`: one denoising step of every batch per iteration."""
+        batcher = self.batcher
+        stopping = False
+        while not stopping or batcher.has_unfinished():
+            ## idle ranks block until a job arrives; otherwise only the jobs queued meanwhile are taken
+            jobs = [] if stopping else self.next_jobs(block=not batcher.has_unfinished())
+            for job in jobs:
+                if job['type'] == 'shutdown':
+                    stopping = True
+                    continue
+                request = GenerationRequest(
+                    prompt=job['prompt'],
+                    first_image=None,
+                    output_type="latent",
+                    output_file_name=job['output_file_name'],
+                    request_id=job['job_id'],
+                    **{name: job[name] for name in self.job_params if name != 'num_videos_per_prompt'},
+                )
+                batcher.submit(request, encoded_inputs=job['encoded_inputs'])
+                self.jobs_in_flight[job['job_id']] = job
+            if not batcher.has_unfinished():
+                continue
+
+            try:
+                results = batcher.step()
+            except Exception as e:
+                if self.rank == 0:
+                    for m in batcher.active_requests():
+                        self.update(m.request.request_id, state='failed', error=str(e))
+                raise
+            self.running_job = [m.request.request_id for m in batcher.active_requests()]
+            if self.rank == 0:
+                for m in batcher.active_requests():
+                    self.update(m.request.request_id, state='denoising', step=m.step, num_steps=len(m.timestep_table))
+            for result in results:
+                job = self.jobs_in_flight.pop(result['request_id'])
+                if self.rank == 0:
+                    stats = {'num_steps': result['num_steps'], 'continuous_batching': True}
+                    self.update(job['job_id'], state='decoding')
+                    self.decoder.submit(self.finish_job, job, result['video'].cpu(), stats)
+        self.running_job = None
+
+    def serve(self):
+        if self.rank == 0:
+            app = self.build_app()
+            threading.Thread(
+                target=app.run,
+                kwargs=dict(host=self.args.host, port=self.args.port, threaded=True, debug=False),
+                daemon=True,
+            ).start()
+            print(f"Inference server listening on http://{self.args.host}:{self.args.port}")
+
+        if self.batcher is not None:
+            self.run_batched()
+        else:
+            self.run_serial()
+
+        if self.decoder is not None:
+            self.decoder.shutdown(wait=True)
@@ -1,2 +1,3 @@
 from .utils import *
-from .video_process import *
\ No newline at end of file
+from .video_process import *
+from .cache import *
\ No newline at end of file
@@ -0,0 +1,298 @@
+import hashlib
+import os
+import threading
+import uuid
+import torch
+from collections import OrderedDict
+from typing import Dict, Hashable, List, Optional, Tuple, Union
+from PIL import Image as PILImage
+from diffusers.utils import logging
+
+
+logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
+
+
+__all__ = ["PromptEmbeddingCache", "ImageLatentCache"]
+
+
+def _nbytes(*tensors):
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class PromptEmbeddingCache:
+    r"""
+    In-process LRU cache of the caption server outputs `(y, y_mask, clip_embedding)`, one entry per text.
+    It is thread-safe, e.g. for a prefetching thread encoding the next request while the current one reads `stats`.
+
+    Entries are keyed by `(encoder, text)`, where `encoder` identifies the caption server, and are stored on the
+    CPU with the padded tokens of `y` trimmed away. Pinned entries (e.g. the constant negative prompt) are never
+    evicted and do not count towards `max_entries`.
+
+    Args:
+        max_entries (`int`, defaults to 256):
+            Maximum number of unpinned entries.
+        max_bytes (`int`, *optional*):
+            Maximum total size of the unpinned entries.
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: Optional[int] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.pinned = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.entries) + len(self.pinned)
+
+    def __contains__(self, key):
+        return key in self.pinned or key in self.entries
+
+    def get(self, encoder: Hashable, text: str):
+        key = (encoder, text)
+        with self.lock:
+            if key in self.pinned:
+                self.hits += 1
+                return self.pinned[key]
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(
+        self,
+        encoder: Hashable,
+        text: str,
+        y: torch.Tensor,
+        y_mask: torch.Tensor,
+        clip_embedding: torch.Tensor,
+        pin: bool = False,
+    ):
+        """Stores the outputs of one text, `y` in shape (1, l, d), `y_mask` in shape (1, l_clip + l)."""
+        len_clip = clip_embedding.shape[1]
+        ## text tokens are right-padded, keep only the valid ones
+        seqlen = int(y_mask[0, len_clip:].sum())
+        entry = (
+            y[:, :seqlen].clone(),
+            y_mask[:, :len_clip + seqlen].clone(),
+            clip_embedding.clone(),
+        )
+        key = (encoder, text)
+        with self.lock:
+            if pin:
+                self.entries.pop(key, None)
+                self.pinned[key] = entry
+                return entry
+            if key in self.pinned:
+                return self.pinned[key]
+
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            self.evict()
+            return entry
+
+    def pin(self, encoder: Hashable, text: str):
+        key = (encoder, text)
+        with self.lock:
+            if key in self.entries:
+                self.pinned[key] = self.entries.pop(key)
+
+    def evict(self):
+        with self.lock:
+            while len(self.entries) > self.max_entries or (
+                self.max_bytes is not None and len(self.entries) > 0 and self.unpinned_bytes > self.max_bytes
+            ):
+                self.entries.popitem(last=False)
+
+    def clear(self, include_pinned: bool = False):
+        with self.lock:
+            self.entries.clear()
+            if include_pinned:
+                self.pinned.clear()
+
+    @staticmethod
+    def collate(entries: List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]):
+        """Right-pads the trimmed entries to their longest text and stacks them along the batch."""
+        max_seqlen = max(y.shape[1] for y, _, _ in entries)
+        y = torch.cat([
+            torch.nn.functional.pad(y, (0, 0, 0, max_seqlen - y.shape[1])) for y, _, _ in entries
+        ])
+        y_mask = torch.cat([
+            torch.nn.functional.pad(mask, (0, max_seqlen - y.shape[1])) for y, mask, _ in entries
+        ])
+        clip_embedding = torch.cat([clip for _, _, clip in entries])
+        return y, y_mask, clip_embedding
+
+    @property
+    def unpinned_bytes(self):
+        with self.lock:
+            return sum(_nbytes(*entry) for entry in self.entries.values())
+
+    @property
+    def pinned_bytes(self):
+        with self.lock:
+            return sum(_nbytes(*entry) for entry in self.pinned.values())
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+                'num_entries': len(self.entries),
+                'num_pinned': len(self.pinned),
+                'bytes': self.unpinned_bytes + self.pinned_bytes,
+                'pinned_bytes': self.pinned_bytes,
+            }
+
+
+class ImageLatentCache:
+    r"""
+    Two-tier cache of the VAE latents of first images, keyed by the image content and the target size.
+
+    The memory tier is an LRU of CPU tensors. The optional disk tier stores one file per key under `cache_dir`,
+    survives restarts and can be shared by processes; the least recently used files are removed once it
+    exceeds `max_disk_bytes`. A disk hit is promoted to the memory tier. Both tiers are guarded by a lock
+    within the process.
+
+    Args:
+        max_entries (`int`, defaults to 64):
+            Maximum number of latents in memory.
+        cache_dir (`str`, *optional*):
+            Directory of the disk tier. No disk tier if not set.
+        max_disk_bytes (`int`, *optional*):
+            Maximum total size of the disk tier.
+    """
+
+    def __init__(self, max_entries: int = 64, cache_dir: Optional[str] = None, max_disk_bytes: Optional[int] = None):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(img: Union[str, PILImage.Image, torch.Tensor], height: int, width: int, num_frames: int, encoder: Hashable = None):
+        h = hashlib.sha256()
+        if isinstance(img, str):
+            with open(img, 'rb') as f:
+                h.update(f.read())
+        elif isinstance(img, PILImage.Image):
+            h.update(f"{img.mode}-{img.size}".encode())
+            h.update(img.tobytes())
+        else:
+            img = img.detach().cpu().contiguous()
+            h.update(f"{img.dtype}-{tuple(img.shape)}".encode())
+            h.update(img.reshape(-1).view(torch.uint8).numpy().tobytes())
+        h.update(f"{height}-{width}-{num_frames}-{encoder}".encode())
+        return h.hexdigest()
+
+    def path(self, key: str):
+        return os.path.join(self.cache_dir, f"{key}.pt")
+
+    def get(self, key: str):
+        with self.lock:
+            if key in self.entries:
+                self.memory_hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            if self.cache_dir is not None and os.path.exists(self.path(key)):
+                try:
+                    latent = torch.load(self.path(key), map_location='cpu', weights_only=True)
+                except Exception as e:   ## a partially written, corrupted or concurrently evicted file is a miss
+                    logger.warning(f"Failed to load cached latent {key}: {e}")
+                else:
+                    self.disk_hits += 1
+                    try:
+                        os.utime(self.path(key))
+                    except FileNotFoundError:
+                        pass
+                    self.put_memory(key, latent)
+                    return latent
+            self.misses += 1
+            return None
+
+    def put_memory(self, key: str, latent: torch.Tensor):
+        with self.lock:
+            self.entries[key] = latent
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def put(self, key: str, latent: torch.Tensor):
+        latent = latent.detach().cpu().clone()
+        with self.lock:
+            self.put_memory(key, latent)
+            if self.cache_dir is not None:
+                ## write-then-rename, so readers never see a partial file
+                tmp_path = f"{self.path(key)}.{uuid.uuid4().hex}.tmp"
+                torch.save(latent, tmp_path)
+                os.replace(tmp_path, self.path(key))
+                self.evict_disk()
+        return latent
+
+    def disk_files(self):
+        """`(path, mtime, size)` of the files of the disk tier, oldest first. Files removed meanwhile by another
+        process sharing the directory are skipped."""
+        if self.cache_dir is None:
+            return []
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.pt'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((path, stat.st_mtime, stat.st_size))
+        return sorted(files, key=lambda f: f[1])
+
+    def evict_disk(self):
+        if self.max_disk_bytes is None:
+            return
+        with self.lock:
+            files = self.disk_files()
+            total = sum(size for _, _, size in files)
+            for path, _, size in files:
+                if total <= self.max_disk_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    @property
+    def memory_bytes(self):
+        with self.lock:
+            return _nbytes(*self.entries.values())
+
+    @property
+    def disk_bytes(self):
+        return sum(size for _, _, size in self.disk_files())
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            stats = {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups > 0 else 0.0,
+                'num_entries': len(self.entries),
+                'memory_bytes': self.memory_bytes,
+            }
+        ## the disk tier may be shared by other processes, its size is read outside the lock
+        stats['disk_bytes'] = self.disk_bytes
+        return stats
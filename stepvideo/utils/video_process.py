@@ -47,4 +47,5 @@ class VideoProcessor:
             video_array = self.crop2standard540p(video_array)
 
         self.save_imageio_video(video_array, video_path)
-        print(f"Saved the generated video in {video_path}")
\ No newline at end of file
+        print(f"Saved the generated video in {video_path}")
+        return video_path
\ No newline at end of file
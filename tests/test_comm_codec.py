@@ -0,0 +1,56 @@
+import pytest
+import torch
+
+from stepvideo.comm_codec import CommCodec, Fp8Codec, Int8Codec, parse_comm_codecs
+
+
+def test_comm_codec_is_abstract():
+    with pytest.raises(TypeError):
+        CommCodec()
+
+
+@pytest.mark.parametrize("shape,scale_shape", [((2, 16, 4, 32), (2, 16, 4, 1)), ((2, 16, 24), (2, 16, 1))])
+def test_fp8_codec(shape, scale_shape):
+    torch.manual_seed(0)
+    ## magnitudes spread over the tokens
+    x = torch.randn(shape) * torch.logspace(-2, 2, shape[1]).reshape(1, -1, *([1] * (len(shape) - 2)))
+    codec = Fp8Codec()
+    payload, scale = codec.encode(x)
+    assert payload.dtype == torch.uint8 and payload.shape == x.shape
+    assert scale.shape == scale_shape
+    out = codec.decode(payload, scale, x.dtype)
+    assert out.dtype == x.dtype
+    ## at most 2^-4 of the largest magnitude of the token
+    bound = x.abs().amax(dim=-1, keepdim=True) * 2 ** -4
+    assert ((out - x).abs() <= bound * (1 + 1e-6)).all()
+
+
+@pytest.mark.parametrize("shape,scale_shape", [((2, 16, 4, 32), (2, 1, 4, 1)), ((2, 16, 24), (2, 1, 24))])
+def test_int8_codec(shape, scale_shape):
+    torch.manual_seed(0)
+    ## magnitudes spread over the heads or channels
+    x = torch.randn(shape) * torch.logspace(-2, 2, shape[2]).reshape(1, 1, -1, *([1] * (len(shape) - 3)))
+    codec = Int8Codec()
+    payload, scale = codec.encode(x)
+    assert payload.dtype == torch.int8 and payload.shape == x.shape
+    assert scale.shape == scale_shape
+    out = codec.decode(payload, scale, x.dtype)
+    assert out.dtype == x.dtype
+    ## at most half a step, 1/254 of the largest magnitude of the head or channel
+    dims = (1, 3) if x.ndim == 4 else (1,)
+    bound = x.abs().amax(dim=dims, keepdim=True) / 254
+    assert ((out - x).abs() <= bound * (1 + 1e-6)).all()
+
+
+def test_codec_of_zeros():
+    x = torch.zeros(1, 8, 2, 16)
+    for codec in [Fp8Codec(), Int8Codec()]:
+        assert (codec.decode(*codec.encode(x), x.dtype) == 0).all()
+
+
+def test_parse_comm_codecs():
+    codecs = parse_comm_codecs(["qkv=fp8", "gather=int8"])
+    assert isinstance(codecs["qkv"], Fp8Codec) and isinstance(codecs["gather"], Int8Codec)
+    assert codecs["attn_out"] is None
+    with pytest.raises(ValueError):
+        parse_comm_codecs(["qkv=fp4"])
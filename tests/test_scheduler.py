@@ -0,0 +1,117 @@
+import inspect
+import math
+
+import pytest
+import torch
+
+from stepvideo.diffusion.scheduler import FlowMatchDiscreteScheduler
+
+solvers = ["euler", "heun", "midpoint", "dpmsolver++", "unipc"]
+
+
+def integrate(scheduler, velocity, sample):
+    """Runs the sampling loop with `velocity(sample, t)` as the model; returns the samples after every step."""
+    trajectory = []
+    for t in scheduler.timesteps:
+        sample = scheduler.step(velocity(sample, t), t, sample)
+        trajectory.append(sample)
+    return trajectory
+
+
+def make_scheduler(solver, num_inference_steps, time_shift=1.0):
+    scheduler = FlowMatchDiscreteScheduler(solver=solver)
+    scheduler.set_timesteps(num_inference_steps, time_shift=time_shift, device="cpu")
+    return scheduler
+
+
+@pytest.mark.parametrize("solver", solvers)
+@pytest.mark.parametrize("time_shift", [1.0, 13.0])
+def test_straight_path_is_exact(solver, time_shift):
+    ## x = (1 - n) * x0 + n * noise has the constant velocity x0 - noise, which every solver integrates exactly
+    torch.manual_seed(0)
+    x0, noise = torch.randn(2, 16), torch.randn(2, 16)
+    scheduler = make_scheduler(solver, 10, time_shift)
+    out = integrate(scheduler, lambda x, t: x0 - noise, noise)[-1]
+    torch.testing.assert_close(out, x0, rtol=0, atol=1e-5)
+
+
+@pytest.mark.parametrize("solver,order", [("euler", 1), ("heun", 2), ("midpoint", 2)])
+def test_convergence_order(solver, order):
+    ## dx/dt = a * x from t = 0 to 1, x(1) = x(0) * exp(a); the error shrinks by 2^order per halved step
+    torch.manual_seed(0)
+    a, x = 0.8, torch.randn(4, 8)
+    errors = [
+        (integrate(make_scheduler(solver, n), lambda x, t: a * x, x)[-1] - x * math.exp(a)).abs().max().item()
+        for n in [20, 80]
+    ]
+    observed = math.log2(errors[0] / errors[1]) / 2
+    assert observed > order - 0.2, f"{solver}: observed order {observed:.2f}, expected {order}"
+
+
+@pytest.mark.parametrize("solver", ["dpmsolver++", "unipc"])
+def test_multistep_matches_diffusers(solver):
+    ## same solver on the same flow-matching schedule as the diffusers implementation, which takes the flow
+    ## `noise - x0`, i.e. the negated velocity
+    from diffusers import DPMSolverMultistepScheduler, UniPCMultistepScheduler
+
+    reference_cls, kwargs = {
+        "dpmsolver++": (DPMSolverMultistepScheduler, dict(algorithm_type="dpmsolver++")),
+        "unipc": (UniPCMultistepScheduler, {}),
+    }[solver]
+    if "use_flow_sigmas" not in inspect.signature(reference_cls.__init__).parameters:
+        pytest.skip("diffusers without flow-matching sigmas")
+
+    ## below 15 steps, diffusers also takes the last step with a first order update
+    num_steps = 8
+    ## starts below noise level 1, where the log-SNR is finite, so diffusers runs second order from the second step
+    noise_levels = torch.linspace(0.95, 0.0, num_steps + 1)
+    velocity = lambda x, t: 0.8 * x + torch.sin(3 * t)
+    torch.manual_seed(0)
+    x = torch.randn(2, 6)
+
+    scheduler = make_scheduler(solver, num_steps)
+    scheduler.sigmas = 1 - noise_levels
+    scheduler.timesteps = scheduler.sigmas[:-1]
+    scheduler.set_multistep_coefficients()
+    trajectory = integrate(scheduler, velocity, x)
+
+    reference = reference_cls(
+        use_flow_sigmas=True, prediction_type="flow_prediction", solver_order=2, lower_order_final=True,
+        final_sigmas_type="zero", **kwargs,
+    )
+    reference.set_timesteps(num_steps, device="cpu")
+    reference.sigmas = noise_levels.clone()
+    reference.timesteps = noise_levels[:-1] * reference.config.num_train_timesteps
+    sample = x
+    for i, t in enumerate(reference.timesteps):
+        sample = reference.step(-velocity(sample, 1 - noise_levels[i]), t, sample).prev_sample
+        torch.testing.assert_close(trajectory[i], sample, rtol=0, atol=1e-5)
+
+
+def test_solver_step_indices():
+    assert make_scheduler("euler", 4).solver_step_indices() == [0, 1, 2, 3]
+    ## heun takes its last step with euler
+    assert make_scheduler("heun", 4).solver_step_indices() == [0, 0, 1, 1, 2, 2, 3]
+    assert make_scheduler("midpoint", 4).solver_step_indices() == [0, 0, 1, 1, 2, 2, 3, 3]
+
+
+def test_per_sample_step_matches_scalar():
+    torch.manual_seed(0)
+    step_index = torch.tensor([0, 3, 3, 9])
+    sample, model_output = torch.randn(4, 2, 8), torch.randn(4, 2, 8)
+    scheduler = make_scheduler("euler", 10, time_shift=13.0)
+
+    batched = scheduler.step(model_output, None, sample, step_index=step_index)
+    assert scheduler.step_index is None
+    for i, index in enumerate(step_index.tolist()):
+        single = make_scheduler("euler", 10, time_shift=13.0)
+        single.set_begin_index(index)
+        expected = single.step(model_output[i:i+1], single.timesteps[index], sample[i:i+1])
+        torch.testing.assert_close(batched[i:i+1], expected, rtol=0, atol=0)
+
+
+@pytest.mark.parametrize("solver", ["heun", "midpoint", "dpmsolver++", "unipc"])
+def test_per_sample_step_needs_euler(solver):
+    scheduler = make_scheduler(solver, 10)
+    with pytest.raises(ValueError):
+        scheduler.step(torch.zeros(2, 4), None, torch.zeros(2, 4), step_index=torch.tensor([0, 1]))